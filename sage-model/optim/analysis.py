@@ -62,15 +62,33 @@ def chi2(obs, mod, err):
     #print(chi2)
     return chi2
 
-@npsum
 def studentT(obs, mod, err):
+    """Student-t score of a single particle, see studentT_batch"""
+    return studentT_batch(obs, mod, err)
+
+def chi2_batch(obs, mod, err):
+    """
+    The chi2 score of each row of (n_particles x n_points) mod and err arrays,
+    with obs either of the same shape or a single row shared by all particles
+    """
+    return np.sum(((mod - obs) / err)**2, axis=-1)
+
+def studentT_batch(obs, mod, err):
+    """
+    The Student-t score of each row of (n_particles x n_points) mod and err arrays,
+    with obs either of the same shape or a single row shared by all particles.
+    The log of the t-distribution is computed with gammaln, which (unlike gamma)
+    does not overflow for large degrees of freedom
+    """
+    obs, mod, err = np.broadcast_arrays(*(np.asarray(a, dtype=float) for a in (obs, mod, err)))
+
     # Ensure errors are valid
-    err = np.where(err == 0, np.std(obs), err)
+    err = np.where(err == 0, np.std(obs, axis=-1, keepdims=True), err)
     err = np.maximum(err, 1e-8)
 
-    # Calculate sigma and variance
+    # Calculate sigma and variance (of each particle)
     sigma = (obs - mod) / err
-    var = np.mean(sigma ** 2)
+    var = np.mean(sigma ** 2, axis=-1, keepdims=True)
     var = np.maximum(var, 1e-8)  # Just prevent division by zero
 
     # Calculate degrees of freedom (nu)
@@ -80,21 +98,29 @@ def studentT(obs, mod, err):
     x = (mod - obs) ** 2 / err
     safe_x = np.maximum(1 + x / nu, 1e-8)
 
-    # Calculate t using the Student's T-distribution formula
-    t = (
-        (scipy.special.gamma((nu + 1) / 2.0))
-        / ((nu * math.pi) ** 0.5 * scipy.special.gamma(nu / 2.0))
-        * safe_x ** (-1 * (nu + 1) / 2.0)
-    )
-
-    # Prevent log of zero
-    t = np.maximum(t, 1e-8)
+    # Log of the Student's T-distribution
+    log_t = (scipy.special.gammaln((nu + 1) / 2.0) - scipy.special.gammaln(nu / 2.0)
+             - 0.5 * np.log(nu * math.pi) - (nu + 1) / 2.0 * np.log(safe_x))
 
-    # Return the negative log of t
-    return -1.0 * np.log(t)
+    # Prevent log of zero, and return the negative log of t
+    return np.sum(-1.0 * np.maximum(log_t, math.log(1e-8)), axis=-1)
 
 
 stat_tests = {
     'student-t': studentT,
     'chi2': chi2
 }
+
+stat_tests_batch = {
+    'student-t': studentT_batch,
+    'chi2': chi2_batch
+}
+
+def score_batch(stat_test, data):
+    """
+    Scores all the particles of an iteration against all the constraints at once.
+    data has the (obs, mod, err) of each constraint, with mod and err (n_particles x n_points)
+    arrays. Returns the (n_particles x n_constraints) scores and the total score of each particle
+    """
+    scores = np.stack([stat_tests_batch[stat_test](obs, mod, err) for obs, mod, err in data], axis=-1)
+    return scores, np.sum(scores, axis=-1)
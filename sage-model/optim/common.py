@@ -191,6 +191,19 @@ def load_observation(obsdir, fname, cols):
     print("Loading observations from %s" % fname)
     return np.loadtxt(fname, usecols=cols, unpack=True)
 
+def load_track_screened(fx_file, n):
+    """Which particles of a PSO track_<iteration>_fx.npy file the surrogate screened out (never evaluated)"""
+    screened_file = fx_file[:-len('_fx.npy')] + '_screened.npy'
+    if not os.path.exists(screened_file):
+        return np.zeros(n, dtype=bool)
+    return np.load(screened_file)
+
+def load_track_fx(fx_file):
+    """The scores in a PSO track_<iteration>_fx.npy file, NaN for particles the surrogate screened out"""
+    fx = np.load(fx_file).astype(float)
+    fx[load_track_screened(fx_file, len(fx))] = np.nan
+    return fx
+
 def prepare_ax(ax, xmin, xmax, ymin, ymax, xtit, ytit, locators=(1, 1, 1, 1), fontsize=13):
 
     from matplotlib.ticker import MultipleLocator # type: ignore
@@ -15,7 +15,6 @@ import re
 from scipy.interpolate import interp1d # type: ignore
 import routines as r
 import h5py as h5 # type: ignore
-import pandas as pd # type: ignore
 from scipy.stats import binned_statistic # type: ignore
 import logging
 
@@ -54,9 +53,296 @@ zeros4 = lambda: np.empty(shape=(1), dtype=np.bool_)
 zeros5 = lambda: np.zeros(shape=(1, len(ssfrbins)))
 zeros6 = lambda: np.zeros(shape=(1, len(mbins2)))
 
+logger = logging.getLogger(__name__)
+
+# The snapshot each constraint is evaluated at (miniUchuu snapshot numbers)
+snapshot_map = {
+    'SMF_z0': [49],
+    'SMF_z02': [43],
+    'SMF_z05': [38],
+    'SMF_z08': [34],
+    'SMF_z10': [32], 
+    'SMF_z11': [31],
+    'SMF_z15': [27],
+    'SMF_z20': [23],
+    'SMF_z24': [20],
+    'SMF_z31': [16],
+    'SMF_z36': [14],
+    'SMF_z46': [11],
+    'SMF_z57': [9],
+    'SMF_z63': [8],
+    'SMF_z77': [6],
+    'SMF_z85': [5],
+    'SMF_z104': [3],
+    'BHMF_z0': [49],
+    'BHMF_z20': [23],
+    'BHBM_z0': [49],
+    'BHBM_z20': [23],
+    'HSMR_z0': [49]
+}
+
+def select_snapshot(name, z, snapshots, age_alist_file=None):
+    """
+    Selects, out of the snapshots being analysed, the one the constraint called name at redshift z
+    is evaluated at: its entry in snapshot_map, the only snapshot given, or else the one closest in redshift
+    (according to age_alist_file)
+    """
+    if not isinstance(snapshots, list):
+        return snapshots
+    if name in snapshot_map and snapshot_map[name][0] in snapshots:
+        return snapshot_map[name][0]
+    if len(snapshots) == 1:
+        return snapshots[0]
+    try:
+        alist = np.loadtxt(age_alist_file)
+        zsnaps = 1./alist[snapshots] - 1
+        return snapshots[int(np.argmin(np.abs(zsnaps - z[0])))]
+    except (OSError, TypeError, ValueError, IndexError):
+        logger.warning('Cannot work out the snapshot for %s, using snapshot %d', name, snapshots[-1])
+        return snapshots[-1]
+
+def read_model_galaxies(modeldir, snap_num, fields):
+    """
+    Reads the given fields of the model galaxies at snap_num (e.g. 'Snap_63').
+    modeldir is either the directory with the model_*.hdf5 files written by SAGE,
+    or the galaxies SAGE kept in memory (as returned by sage.get_memory_output)
+    """
+    return read_model_snapshots(modeldir, [snap_num], fields)[snap_num]
+
+def iter_model_snapshots(modeldir, snap_nums, fields):
+    """
+    Goes through the model galaxies at several snapshots one model file at a time,
+    yielding a dictionary with the galaxies of each snapshot in that file. The galaxies
+    SAGE kept in memory are yielded all at once
+    """
+    if isinstance(modeldir, dict):
+        yield {snap_num: {field: modeldir[snap_num][field] for field in fields} for snap_num in snap_nums}
+        return
+
+    # Get list of model files in directory
+    model_files = [f for f in os.listdir(modeldir) if f.startswith('model_') and f.endswith('.hdf5')]
+    model_files.sort()
+
+    for model_file in model_files if len(model_files) > 1 else ['model_0.hdf5']:
+        yield r.read_sage_hdf_snapshots(os.path.join(modeldir, model_file), snap_nums, fields=fields)
+
+def read_model_snapshots(modeldir, snap_nums, fields):
+    """
+    Same as read_model_galaxies, but for several snapshots at once, going only once
+    through each model file. Returns a dictionary with the galaxies of each snapshot
+    """
+    chunks = {snap_num: {field: [] for field in fields} for snap_num in snap_nums}
+    for Gs in iter_model_snapshots(modeldir, snap_nums, fields):
+        for snap_num, G in Gs.items():
+            for field in fields:
+                chunks[snap_num][field].append(G[field])
+
+    # A single copy at the end, rather than one per file
+    return {snap_num: {field: arrays[0] if len(arrays) == 1 else np.concatenate(arrays) for field, arrays in G.items()}
+            for snap_num, G in chunks.items()}
+
+def scatter_sample(x, y):
+    """The (diluted) galaxies shown in the scatter plots"""
+    w = np.where(y > 0.0)[0]
+    if(len(w) > dilute): w = sample(list(range(len(w))), dilute)
+    return x[w], y[w]
+
+def binned_percentile(x, y, bin_edges, q=50):
+    """
+    The q-th percentile(s) of y (as np.percentile) in each of the bins of x given by bin_edges,
+    NaN for empty bins. The galaxies are grouped by bin with a single (linear time) stable sort of
+    their bin numbers, and the percentiles of each bin then found with np.partition instead of
+    fully sorting it. Returns (nbins,) values for a single q, (nbins, len(q)) otherwise
+    """
+    nbins = len(bin_edges) - 1
+    y = np.asarray(y)
+    bins = np.searchsorted(bin_edges, x, side='right') - 1
+    inside = (bins >= 0) & (bins < nbins) & ~np.isnan(y)
+    bins, y = bins[inside], y[inside].astype(np.float64)
+    y = y[np.argsort(bins, kind='stable')]
+
+    counts = np.bincount(bins, minlength=nbins)
+    starts = np.cumsum(counts) - counts
+    qs = np.atleast_1d(q) / 100.
+    values = np.full((nbins, len(qs)), np.nan)
+    for i in np.nonzero(counts)[0]:
+        pos = qs * (counts[i] - 1)
+        lo = np.floor(pos).astype(np.int64)
+        hi = np.minimum(lo + 1, counts[i] - 1)
+        part = np.partition(y[starts[i]:starts[i] + counts[i]], np.union1d(lo, hi))
+        values[i] = part[lo] + (part[hi] - part[lo]) * (pos - lo)
+    return values[:, 0] if np.ndim(q) == 0 else values
+
+class ModelData(object):
+    """
+    The model galaxies of a single SAGE run, shared by all the constraints evaluated against it.
+    The histograms etc. the constraints need are computed while going once through the model
+    files (see _reduce), once per cosmology/volume. read gives the galaxies themselves
+    """
+
+    fields = ['StellarMass', 'BlackHoleMass', 'SfrBulge']
+    # The field each of the log masses used by the relations is computed from
+    mass_fields = {'BlackHoleMass': 'BlackHoleMass', 'BulgeMass': 'BulgeMass', 'HaloMass': 'Mvir', 'StellarMass': 'StellarMass'}
+    Nage = 14
+
+    def __init__(self, modeldir, snapshots=None, volume_fraction=1.0, relations=None):
+        """
+        snapshots are the snapshot numbers the constraints will ask for (if known),
+        all of them are then read together the first time any of them is needed.
+        volume_fraction is the fraction of the volume of the constraints (see vol_frac)
+        the run covered, if SAGE only processed some of the tree files.
+        relations are the Relation constraints that will be evaluated, if known: only the
+        galaxies (and log masses) these need are then kept, rather than all of them
+        """
+        self.modeldir = modeldir
+        self.volume_fraction = volume_fraction
+        self.relations = relations
+        self.snap_nums = [f'Snap_{snap}' for snap in (snapshots or [])]
+        self.plot_data = {}
+        self.dump_data = {}
+        self._galaxies = {}
+        self._derived = {}
+
+    def read(self, snap_num, fields):
+        """Reads the given fields at snap_num, only reading those that weren't read before"""
+        galaxies = self._galaxies.setdefault(snap_num, {})
+        missing = [field for field in fields if field not in galaxies]
+        if missing:
+            # Read the other expected snapshots in the same pass over the files
+            snap_nums = [snap_num] + [s for s in self.snap_nums if s != snap_num and
+                                      any(field not in self._galaxies.get(s, {}) for field in missing)]
+            for s, G in read_model_snapshots(self.modeldir, snap_nums, missing).items():
+                self._galaxies.setdefault(s, {}).update(G)
+        return {field: galaxies[field] for field in fields}
+
+    def get(self, snap_num, h0, Omega0, vol, age_alist_file):
+        """
+        Returns hist_smf, hist_bhmf, TimeBinEdge, SFRD_Age, BlackHoleMass, BulgeMass, HaloMass, StellarMass
+        for the galaxies at snap_num. The returned arrays are shared, don't modify them
+        """
+        key = (snap_num, h0, Omega0, vol, age_alist_file)
+        if key not in self._derived:
+            # Reduce the other expected snapshots in the same pass over the files
+            snap_nums = [snap_num] + [s for s in self.snap_nums if s != snap_num and (s,) + key[1:] not in self._derived]
+            for s, derived in self._reduce(snap_nums, h0, Omega0, vol, age_alist_file).items():
+                self._derived[(s,) + key[1:]] = derived
+        return self._derived[key]
+
+    @staticmethod
+    def _log_mass(mass, h0):
+        mass = np.log10(mass * 1e10 / h0)
+        mass[~np.isfinite(mass)] = -20
+        return mass
+
+    def _reduce(self, snap_nums, h0, Omega0, vol, age_alist_file):
+        """
+        Goes once through the model files, updating the mass function histograms and the star
+        formation history of each snapshot with the galaxies of each file as it is read. Of the
+        log masses of each file only those the relations at the snapshot use are kept, and only
+        for the galaxies they use (see Relation.used); the rest is dropped before the next file
+        is read. The log masses no relation uses are None
+        """
+        relations = {s: None if self.relations is None else [c for c in self.relations if f'Snap_{c.snapshot}' == s]
+                     for s in snap_nums}
+        kept = {s: list(self.mass_fields) if relations[s] is None else
+                   sorted({name for c in relations[s] for name in (c.x_field, c.y_field)})
+                for s in snap_nums}
+        fields = self.fields + sorted({self.mass_fields[name] for names in kept.values() for name in names} - set(self.fields))
+
+        hist_smf = {s: np.zeros(len(mbins) - 1, dtype=np.int64) for s in snap_nums}
+        hist_bhmf = {s: np.zeros(len(mbins2) - 1, dtype=np.int64) for s in snap_nums}
+        SfrBulge = {s: 0. for s in snap_nums}
+        ngals = {s: 0 for s in snap_nums}
+        masses = {s: {name: [] for name in kept[s]} for s in snap_nums}
+
+        for Gs in iter_model_snapshots(self.modeldir, snap_nums, fields):
+            for s, G in Gs.items():
+                m = {'StellarMass': self._log_mass(G['StellarMass'], h0),
+                     'BlackHoleMass': self._log_mass(G['BlackHoleMass'], h0)}
+                hist_smf[s] += np.histogram(m['StellarMass'], bins=mbins)[0]
+                hist_bhmf[s] += np.histogram(m['BlackHoleMass'], bins=mbins2)[0]
+                SfrBulge[s] = SfrBulge[s] + np.sum(G['SfrBulge'], axis=0)
+                ngals[s] += len(m['StellarMass'])
+                if not kept[s]:
+                    continue
+
+                for name in kept[s]:
+                    if name not in m:
+                        m[name] = self._log_mass(G[self.mass_fields[name]], h0)
+                if relations[s] is not None:
+                    used = np.zeros(len(m['StellarMass']), dtype=bool)
+                    for c in relations[s]:
+                        used |= c.used(m[c.x_field], m[c.y_field])
+                    m = {name: m[name][used] for name in kept[s]}
+                for name in kept[s]:
+                    masses[s][name].append(m[name])
+
+        TimeBinEdge, dT = self._time_bins(h0, Omega0, age_alist_file)
+        derived = {}
+        for s in snap_nums:
+            m = {name: arrays[0] if len(arrays) == 1 else np.concatenate(arrays) for name, arrays in masses[s].items()}
+            logger.debug('%d galaxies at %s, %d kept for the relations', ngals[s], s, len(next(iter(m.values()), [])))
+            derived[s] = self._finish(hist_smf[s], hist_bhmf[s], SfrBulge[s], TimeBinEdge, dT, h0, vol) + \
+                         tuple(m.get(name) for name in ('BlackHoleMass', 'BulgeMass', 'HaloMass', 'StellarMass'))
+        return derived
+
+    def _time_bins(self, h0, Omega0, age_alist_file):
+        """The edges (in lookback time) and widths of the age bins"""
+        Nage = self.Nage
+
+        # get the edges of the age bins
+        # Load and convert scale factors to redshifts
+        alist = np.loadtxt(age_alist_file)
+        if Nage >= len(alist)-1:
+            alist = alist[::-1]
+            RedshiftBinEdge = 1./alist - 1  # Convert scale factors to redshifts
+        else:
+            indices_float = np.arange(Nage+1) * (len(alist)-1.0) / Nage
+            indices = indices_float.astype(np.int32)
+            alist = alist[indices][::-1]
+            RedshiftBinEdge = 1./alist - 1  # Convert scale factors to redshifts
+
+        TimeBinEdge = r.get_cosmology(h0, Omega0, 1.0-Omega0).z2tL(RedshiftBinEdge)
+        
+        dT = np.diff(TimeBinEdge) # time step for each bin
+        return TimeBinEdge, dT
+
+    def _finish(self, hist_smf, hist_bhmf, SfrBulge, TimeBinEdge, dT, h0, vol):
+        """hist_smf, hist_bhmf, TimeBinEdge and SFRD_Age from the galaxy counts and summed SfrBulge of a snapshot"""
+        hist_smf = hist_smf / dm / vol
+        hist_bhmf = hist_bhmf / dm2 / vol
+
+        TimeBinCentre = TimeBinEdge[:-1] + 0.5*dT
+#        m, lifetime, returned_mass_fraction_integrated, ncum_SN = r.return_fraction_and_SN_ChabrierIMF()
+#        eff_recycle = np.interp(TimeBinCentre, lifetime[::-1], returned_mass_fraction_integrated[::-1])
+        SFRbyAge = SfrBulge*1e10/h0 / (dT*1e9)
+
+
+        #########################
+        # take logs
+        ind = (hist_smf > 0.)
+        hist_smf[ind] = np.log10(hist_smf[ind])
+        hist_smf[~ind] = -20
+        ind = (hist_bhmf > 0.)
+        hist_bhmf[ind] = np.log10(hist_bhmf[ind])
+        hist_bhmf[~ind] = -20
+        SFRD_Age = np.log10(SFRbyAge/vol)
+        SFRD_Age[~np.isfinite(SFRD_Age)] = -20
+        
+        # have moved where this was in the code. Don't understand its purpose
+        hist_bhmf = hist_bhmf[np.newaxis]
+        hist_smf = hist_smf[np.newaxis]
+
+        return hist_smf, hist_bhmf, TimeBinEdge, SFRD_Age
+
 class Constraint(object):
     """Base classes for constraint objects"""
 
+    # 'all' plots every evaluation as it happens, 'best' only keeps the plot data
+    # in the ModelData (see execution.save_plot_data) so it can be plotted later on,
+    # and 'none' doesn't plot at all
+    plot_mode = 'all'
+
     def __init__(self, snapshot=None, sim=None, boxsize=None, vol_frac=None, age_alist_file=None, Omega0=None, h0=None, output_dir=None):
         self.redshift_table = None
         self.weight = 1
@@ -92,105 +378,31 @@ class Constraint(object):
             self.vol = (boxsize/h0)**3 * vol_frac
             self.age_alist_file = age_alist_file
 
-    def _load_model_data(self, modeldir, subvols):
-        # Allow snapshots to be a list
-        if not isinstance(self.snapshot, list):
-            self.snapshot = [self.snapshot]
-            
-        data_by_snapshot = {}
-        for snap in self.snapshot:
-            if len(subvols) > 1:
-                subvols = ["multiple_batches"]
-
-            # Histograms we are interested in
-            hist_smf = zeros3()
-            hist_bhmf = zeros6()
-
-            seed(2222)
-            fields = ['StellarMass', 'BlackHoleMass', 'Len', 'SfrBulge', 'BulgeMass', 'Mvir']
-            Nage = 14
-            snap_num = f'Snap_{snap}'
-
-            # Get list of model files in directory
-        model_files = [f for f in os.listdir(modeldir) if f.startswith('model_') and f.endswith('.hdf5')]
-        model_files.sort()
-
-        if len(model_files) > 1:
-            combined_properties = {}
-            for model_file in model_files:
-                G = r.read_sage_hdf(os.path.join(modeldir, model_file), snap_num=snap_num, fields=fields)
-                
-                # Combine properties
-                for field in fields:
-                    if field not in combined_properties:
-                        combined_properties[field] = G[field]
-                    else:
-                        combined_properties[field] = np.concatenate((combined_properties[field], G[field]))
-            
-            G = combined_properties
-            print('Number of galaxies: ', len(G['StellarMass']))
-        else:
-            G = r.read_sage_hdf(os.path.join(modeldir, 'model_0.hdf5'), snap_num=snap_num, fields=fields)
-            print('Number of galaxies: ', len(G['StellarMass']))
-
-        # Process properties - Use self.h0 instead of h0
-        BlackHoleMass = np.log10(G['BlackHoleMass'] * 1e10 / self.h0)
-        BlackHoleMass[~np.isfinite(BlackHoleMass)] = -20
-        BulgeMass = np.log10(G['BulgeMass'] * 1e10 / self.h0)
-        BulgeMass[~np.isfinite(BulgeMass)] = -20
-        HaloMass = np.log10(G['Mvir'] * 1e10 / self.h0)
-        HaloMass[~np.isfinite(HaloMass)] = -20
-        StellarMass = np.log10(G['StellarMass'] * 1e10 / self.h0)
-        StellarMass[~np.isfinite(StellarMass)] = -20
-
-        logSM = np.log10(G['StellarMass'] * 1e10 / self.h0)
-        logSM[~np.isfinite(logSM)] = -20
-        hist_smf, _ = np.histogram(logSM, bins=mbins)
-        hist_smf = hist_smf / dm / self.vol
-
-        logBHM = np.log10(G['BlackHoleMass'] * 1e10 / self.h0)
-        logBHM[~np.isfinite(logBHM)] = -20
-        hist_bhmf, _ = np.histogram(logBHM, bins=mbins2)
-        hist_bhmf = hist_bhmf / dm2 / self.vol
-            
-        # get the edges of the age bins
-        # Load and convert scale factors to redshifts
-        alist = np.loadtxt(self.age_alist_file)
-        if Nage >= len(alist)-1:
-            alist = alist[::-1]
-            RedshiftBinEdge = 1./alist - 1  # Convert scale factors to redshifts
-        else:
-            indices_float = np.arange(Nage+1) * (len(alist)-1.0) / Nage
-            indices = indices_float.astype(np.int32)
-            alist = alist[indices][::-1]
-            RedshiftBinEdge = 1./alist - 1  # Convert scale factors to redshifts
+        # Each constraint is only evaluated at its own snapshot
+        self.snapshot = select_snapshot(self.__class__.__name__, self.z, snapshot, self.age_alist_file)
 
-        TimeBinEdge = np.array([r.z2tL(redshift, self.h0, self.Omega0, 1.0-self.Omega0) for redshift in RedshiftBinEdge])
-        
-        dT = np.diff(TimeBinEdge) # time step for each bin
-        TimeBinCentre = TimeBinEdge[:-1] + 0.5*dT
-#        m, lifetime, returned_mass_fraction_integrated, ncum_SN = r.return_fraction_and_SN_ChabrierIMF()
-#        eff_recycle = np.interp(TimeBinCentre, lifetime[::-1], returned_mass_fraction_integrated[::-1])
-        SFRbyAge = np.sum(G['SfrBulge'], axis=0)*1e10/self.h0 / (dT*1e9)
+    def _load_model_data(self, modeldir, subvols):
+        # modeldir can also be a ModelData shared with the other constraints
+        if not isinstance(modeldir, ModelData):
+            modeldir = ModelData(modeldir)
 
+        seed(2222)
+        snap_num = f'Snap_{self.snapshot}'
 
-        #########################
-        # take logs
-        ind = (hist_smf > 0.)
-        hist_smf[ind] = np.log10(hist_smf[ind])
-        hist_smf[~ind] = -20
-        ind = (hist_bhmf > 0.)
-        hist_bhmf[ind] = np.log10(hist_bhmf[ind])
-        hist_bhmf[~ind] = -20
-        SFRD_Age = np.log10(SFRbyAge/self.vol)
-        SFRD_Age[~np.isfinite(SFRD_Age)] = -20
-        
-        # have moved where this was in the code. Don't understand its purpose
-        hist_bhmf = hist_bhmf[np.newaxis]
-        hist_smf = hist_smf[np.newaxis]
+        vol = self.vol * modeldir.volume_fraction
+        return (self.h0, self.Omega0) + modeldir.get(snap_num, self.h0, self.Omega0, vol, self.age_alist_file)
 
-        return self.h0, self.Omega0, hist_smf, hist_bhmf, TimeBinEdge, SFRD_Age, BlackHoleMass, BulgeMass, HaloMass, StellarMass
+    def _get_obs_x_y_err(self):
+        """get_obs_x_y_err, computed only once per constraint (the observations don't change during a run)"""
+        if getattr(self, '_obs_x_y_err', None) is None:
+            self._obs_x_y_err = self.get_obs_x_y_err()
+        return self._obs_x_y_err
 
+    def _get_sage_x_y(self):
+        """get_sage_x_y, computed only once per constraint"""
+        if getattr(self, '_sage_x_y', None) is None:
+            self._sage_x_y = self.get_sage_x_y()
+        return self._sage_x_y
 
     def load_observation(self, *args, **kwargs):
         obsdir = os.path.normpath(os.path.abspath(os.path.join(__file__, '..')))#, '..', 'data')))
@@ -280,7 +492,7 @@ class Constraint(object):
         return
 
     def plot_bhbm(self, x_obs, y_obs, y_mod, x_sage, y_sage, BlackHoleMass, BulgeMass, output_dir):
-        """Plot Black Hole-Bulge Mass relation comparison"""
+        """Plot Black Hole-Bulge Mass relation comparison, the galaxies are those given by scatter_sample"""
         plt.figure()
         ax = plt.subplot(111)
         #print(x_sage,y_sage)
@@ -288,9 +500,7 @@ class Constraint(object):
         plt.plot(x_sage, y_sage, c='k', label='SAGE')
         plt.plot(x_obs, y_obs, c='r', label="Observation")
 
-        w = np.where(BlackHoleMass > 0.0)[0]
-        if(len(w) > dilute): w = sample(list(range(len(w))), dilute)
-        plt.scatter(BulgeMass[w], BlackHoleMass[w], s=0.5, c='orange', alpha=0.6, label='SAGE galaxies')
+        plt.scatter(BulgeMass, BlackHoleMass, s=0.5, c='orange', alpha=0.6, label='SAGE galaxies')
 
         class_name = self.__class__.__name__
 
@@ -313,7 +523,7 @@ class Constraint(object):
         return
 
     def plot_hsmr(self, x_obs, y_obs, y_mod, x_sage, y_sage, HaloMass, StellarMass, output_dir):
-        """Plot Black Hole-Bulge Mass relation comparison"""
+        """Plot Halo-Stellar Mass relation comparison, the galaxies are those given by scatter_sample"""
         plt.figure()
         ax = plt.subplot(111)
         #print(x_sage,y_sage)
@@ -321,9 +531,7 @@ class Constraint(object):
         plt.plot(x_sage, y_sage, c='k', label='SAGE')
         plt.plot(x_obs, y_obs, c='r', label="Observation")
 
-        w = np.where(StellarMass > 0.0)[0]
-        if(len(w) > dilute): w = sample(list(range(len(w))), dilute)
-        plt.scatter(HaloMass[w], StellarMass[w], s=0.5, c='orange', alpha=0.6, label='SAGE galaxies')
+        plt.scatter(HaloMass, StellarMass, s=0.5, c='orange', alpha=0.6, label='SAGE galaxies')
 
         class_name = self.__class__.__name__
 
@@ -378,16 +586,44 @@ class Constraint(object):
         The model data is interpolated to match the observation's X values."""
 
         self.h0, self.Omega0, hist_smf, hist_bhmf, TimeBinEdge, SFRD_Age, BlackHoleMass, BulgeMass, HaloMass, StellarMass = self._load_model_data(modeldir, subvols)
-        x_obs, y_obs, y_dn, y_up = self.get_obs_x_y_err()
-        x_sage, y_sage = self.get_sage_x_y()
+        x_obs, y_obs, y_dn, y_up = self._get_obs_x_y_err()
+        x_sage, y_sage = self._get_sage_x_y()
         x_mod, y_mod = self.get_model_x_y(hist_smf, hist_bhmf, TimeBinEdge, SFRD_Age, BlackHoleMass, BulgeMass, HaloMass, StellarMass)
         return x_obs, y_obs, y_dn, y_up, x_sage, y_sage, x_mod, y_mod
 
+    def get_plot_data(self, x_obs, y_obs, y_mod, x_sage, y_sage, BlackHoleMass, BulgeMass, HaloMass, StellarMass):
+        """The arrays make_plots needs to plot this constraint"""
+        plot_data = dict(x_obs=x_obs, y_obs=y_obs, y_mod=y_mod, x_sage=np.asarray(x_sage), y_sage=np.asarray(y_sage))
+        constraint_name = self.__class__.__name__
+        if 'BHBM' in constraint_name:
+            plot_data['BulgeMass'], plot_data['BlackHoleMass'] = scatter_sample(BulgeMass, BlackHoleMass)
+        if 'HSMR' in constraint_name:
+            plot_data['HaloMass'], plot_data['StellarMass'] = scatter_sample(HaloMass, StellarMass)
+        return plot_data
+
+    def make_plots(self, plot_data, output_dir):
+        """Plots this constraint from the data returned by get_plot_data"""
+        d = plot_data
+        args = d['x_obs'], d['y_obs'], d['y_mod'], d['x_sage'], d['y_sage']
+
+        # Get constraint name for appropriate plotting function
+        constraint_name = self.__class__.__name__
+        if 'SMF' in constraint_name:
+            self.plot_smf(*args, output_dir)
+        if 'BHMF' in constraint_name:
+            self.plot_bhmf(*args, output_dir)
+        if 'BHBM' in constraint_name:
+            self.plot_bhbm(*args, d['BlackHoleMass'], d['BulgeMass'], output_dir)
+        if 'HSMR' in constraint_name:
+            self.plot_hsmr(*args, d['HaloMass'], d['StellarMass'], output_dir)
+
     def get_data(self, modeldir, subvols):
+        if not isinstance(modeldir, ModelData):
+            modeldir = ModelData(modeldir)
 
         self.h0, self.Omega0, hist_smf, hist_HImf, TimeBinEdge, SFRD_Age, BlackHoleMass, BulgeMass, HaloMass, StellarMass = self._load_model_data(modeldir, subvols)
-        x_obs, y_obs, y_dn, y_up = self.get_obs_x_y_err()
-        x_sage, y_sage = self.get_sage_x_y()
+        x_obs, y_obs, y_dn, y_up = self._get_obs_x_y_err()
+        x_sage, y_sage = self._get_sage_x_y()
         x_mod, y_mod = self.get_model_x_y(hist_smf, hist_HImf, TimeBinEdge, SFRD_Age, BlackHoleMass, BulgeMass, HaloMass, StellarMass)
 
         # Linearly interpolate model Y values respect to the observations'
@@ -398,7 +634,7 @@ class Constraint(object):
         y_mod = interp_func(x_obs)
         #y_mod = np.interp(x_obs, x_mod, y_mod)
         ind = np.where((x_obs >= self.domain[0]) & (x_obs <= self.domain[1]))
-        err = y_dn
+        err = np.array(y_dn) # copy, y_dn is reused by the next evaluation
         err[y_mod > y_obs] = y_up[y_mod > y_obs] # take upper error when model above, lower when below
         err = err[ind]
         print('in get_data:')
@@ -406,26 +642,16 @@ class Constraint(object):
         print('obs y:', y_obs[ind])
         print('mod y:', y_mod[ind])
 
-        # Get the constraint name and create filename directly in outdir
-        constraint_name = self.__class__.__name__
-        filename = os.path.join(self.output_dir, f"{constraint_name}_dump.txt")
-
-        # Append data to dump file
-        with open(filename, 'a') as f:
-            f.write(f"# New Data Block\n")
-            for x_val, y_val, mod_y_val in zip(x_obs, y_obs, y_mod):
-                f.write(f"{x_val}\t{y_val}\t{mod_y_val}\n")
-            
-        # Get constraint name for appropriate plotting function
-        constraint_name = self.__class__.__name__
-        if 'SMF' in constraint_name:
-            self.plot_smf(x_obs, y_obs, y_mod, x_sage, y_sage, self.output_dir)
-        if 'BHMF' in constraint_name:
-            self.plot_bhmf(x_obs, y_obs, y_mod, x_sage, y_sage, self.output_dir)
-        if 'BHBM' in constraint_name:
-            self.plot_bhbm(x_obs, y_obs, y_mod, x_sage, y_sage, BlackHoleMass, BulgeMass, self.output_dir)
-        if 'HSMR' in constraint_name:
-            self.plot_hsmr(x_obs, y_obs, y_mod, x_sage, y_sage, HaloMass, StellarMass, self.output_dir)
+        # Keep the model values for the diagnostics (saved by execution.save_dump_data)
+        modeldir.dump_data[self.__class__.__name__] = dict(x_obs=x_obs, y_obs=y_obs, y_mod=y_mod)
+
+        # Plot now, or only keep what's needed to plot later on
+        if self.plot_mode != 'none':
+            plot_data = self.get_plot_data(x_obs, y_obs, y_mod, x_sage, y_sage, BlackHoleMass, BulgeMass, HaloMass, StellarMass)
+            if self.plot_mode == 'all':
+                self.make_plots(plot_data, self.output_dir)
+            else:
+                modeldir.plot_data[self.__class__.__name__] = plot_data
 
 
         return y_obs[ind], y_mod[ind], err
@@ -735,8 +961,10 @@ class SMF_z0(SMF):
     def get_obs_x_y_err(self):
         # Load data from Driver et al. (2022)
         logm, logphi, dlogphi = self.load_observation('GAMA_SMF_highres.csv', cols=[0,1,2])
-        cosmology_correction_median = np.log10( r.comoving_distance(0.079, 100*self.h0, 0, self.Omega0, 1.0-self.Omega0) / r.comoving_distance(0.079, 70.0, 0, 0.3, 0.7) )
-        cosmology_correction_maximum = np.log10( r.comoving_distance(0.1, 100*self.h0, 0, self.Omega0, 1.0-self.Omega0) / r.comoving_distance(0.1, 70.0, 0, 0.3, 0.7) )
+        my_cosmo = r.get_cosmology(self.h0, self.Omega0, 1.0-self.Omega0)
+        D22_cosmo = r.get_cosmology(0.7, 0.3, 0.7)
+        cosmology_correction_median = np.log10( my_cosmo.comoving_distance(0.079) / D22_cosmo.comoving_distance(0.079) )
+        cosmology_correction_maximum = np.log10( my_cosmo.comoving_distance(0.1) / D22_cosmo.comoving_distance(0.1) )
         x_obs = logm + 2.0 * cosmology_correction_median 
         y_obs = logphi - 3.0 * cosmology_correction_maximum + 0.0807 # last factor accounts for average under-density of GAMA and to correct for this to be at z=0
 
@@ -1192,17 +1420,17 @@ class CSFRDH(Constraint):
     
     def get_obs_x_y_err(self):
 #        zmin, zmax, logSFRD, err1, err2, err3 = self.load_observation('Driver_SFRD.dat', cols=[1,2,3,5,6,7])
-        my_cosmo = [100*self.h0, 0.0, self.Omega0, 1.0-self.Omega0]
-        D18_cosmo = [70.0, 0., 0.3, 0.7]
+        my_cosmo = r.get_cosmology(self.h0, self.Omega0, 1.0-self.Omega0)
+        D18_cosmo = r.get_cosmology(0.7, 0.3, 0.7)
 
         D23_0, D23_1, D23_2, D23_3, D23_4, D23_5 = self.load_observation('CSFH_DSILVA+23_Ver_Final.csv', cols=[0,1,2,3,4,5])
         D23 = np.column_stack((D23_0, D23_1, D23_2, D23_3, D23_4, D23_5))
         z_D23 = D23[:,3]
-        tLB_D23 = np.array([r.z2tL(z, self.h0, self.Omega0,  1.0-self.Omega0) for z in z_D23])
+        tLB_D23 = my_cosmo.z2tL(z_D23)
         CSFH_D23 = D23[:,0]
-        for i in range(len(z_D23)):
-            CSFH_D23[i] += np.log10( r.z2dA(z_D23[i], *my_cosmo) / r.z2dA(z_D23[i], *D18_cosmo) )*2 # adjust for assumed-cosmology influence on SFR calculations
-            CSFH_D23[i] += np.log10( (r.comoving_distance(D23[i,3]+D23[i,4], *D18_cosmo)**3 - r.comoving_distance(D23[i,3]-D23[i,5], *D18_cosmo)**3) / (r.comoving_distance(D23[i,3]+D23[i,4], *my_cosmo)**3 - r.comoving_distance(D23[i,3]-D23[i,5], *my_cosmo)**3) )# adjust for assumed-cosmology influence on comoving volume
+        zup, zdn = D23[:,3]+D23[:,4], D23[:,3]-D23[:,5]
+        CSFH_D23 += np.log10( my_cosmo.z2dA(z_D23) / D18_cosmo.z2dA(z_D23) )*2 # adjust for assumed-cosmology influence on SFR calculations
+        CSFH_D23 += np.log10( (D18_cosmo.comoving_distance(zup)**3 - D18_cosmo.comoving_distance(zdn)**3) / (my_cosmo.comoving_distance(zup)**3 - my_cosmo.comoving_distance(zdn)**3) )# adjust for assumed-cosmology influence on comoving volume
 #        
 #        Np = len(logSFRD)
 #        x_obs = np.zeros(Np)
@@ -1222,32 +1450,47 @@ class CSFRDH(Constraint):
     def get_model_x_y(self, _, _2, TimeBinEdge, SFRD_Age, _3, _4):
         return 0.5*(TimeBinEdge[1:]+TimeBinEdge[:-1]), SFRD_Age
         
-class BHBM(Constraint):
+class Relation(Constraint):
+    """
+    Base class for the scaling relation constraints, which compare the median y of the
+    model galaxies in bins of x. The bins are fixed, bin_width wide and covering the
+    domain plus a bin on either side, so the model can be interpolated anywhere in it.
+    x_field and y_field are the log masses (as returned by ModelData.get) x and y are
+    """
+
+    bin_width = 0.1
+    x_field = None
+    y_field = None
+
+    def bin_edges(self):
+        return self.domain[0] - self.bin_width + self.bin_width * np.arange(
+            int(round((self.domain[1] - self.domain[0]) / self.bin_width)) + 3)
+
+    def used(self, x, y):
+        """Which of the galaxies binned_median (and, if plotting, scatter_sample) use"""
+        bin_edges = self.bin_edges()
+        used = (x >= bin_edges[0]) & (x < bin_edges[-1])
+        if self.plot_mode != 'none':
+            used |= y > 0.0
+        return used
+
+    def binned_median(self, x, y):
+        """The centres of the non-empty bins, and the median y in each of them"""
+        bin_edges = self.bin_edges()
+        bin_centers = (bin_edges[1:] + bin_edges[:-1]) / 2
+        medians = binned_percentile(x, y, bin_edges)
+        ok = ~np.isnan(medians)
+        return bin_centers[ok], medians[ok]
+
+class BHBM(Relation):
     """The Black hole-Bulge mass relation constraint"""
 
     domain = (9.5, 11)
+    x_field = 'BulgeMass'
+    y_field = 'BlackHoleMass'
 
     def get_model_x_y(self, _, _2, _3, _4, BlackHoleMass, BulgeMass, _5, _6):
-        y = BlackHoleMass
-        x = BulgeMass
-
-        # Define the bin edges
-        bin_edges = np.arange(min(x), max(x) + 0.1, 0.1)
-
-        # Assign each x-value to a bin
-        bins = np.digitize(x, bin_edges)
-
-        # Create a DataFrame to group and calculate medians
-        data = pd.DataFrame({'x': x, 'y': y, 'bin': bins})
-
-        # Calculate the median y-value for each bin
-        medians = data.groupby('bin')['y'].median()
-
-        # Map bins back to their corresponding bin centers
-        bin_centers = {i: (bin_edges[i - 1] + bin_edges[i]) / 2 for i in range(1, len(bin_edges))}
-        medians.index = medians.index.map(bin_centers)
-        
-        return medians.index, medians
+        return self.binned_median(BulgeMass, BlackHoleMass)
     
 class BHBM_z0(BHBM):
     """The BHBM constraint at z=0"""
@@ -1289,32 +1532,15 @@ class BHBM_z20(BHBM):
 
         return x_sage, y_sage
     
-class HSMR(Constraint):
+class HSMR(Relation):
     """The Halo-Stellar mass relation constraint"""
 
     domain = (11, 15)
+    x_field = 'HaloMass'
+    y_field = 'StellarMass'
 
     def get_model_x_y(self, _, _2, _3, _4, _5, _6, HaloMass, StellarMass):
-        y = StellarMass
-        x = HaloMass
-
-        # Define the bin edges
-        bin_edges = np.arange(min(x), max(x) + 0.1, 0.1)
-
-        # Assign each x-value to a bin
-        bins = np.digitize(x, bin_edges)
-
-        # Create a DataFrame to group and calculate medians
-        data = pd.DataFrame({'x': x, 'y': y, 'bin': bins})
-
-        # Calculate the median y-value for each bin
-        medians = data.groupby('bin')['y'].median()
-
-        # Map bins back to their corresponding bin centers
-        bin_centers = {i: (bin_edges[i - 1] + bin_edges[i]) / 2 for i in range(1, len(bin_edges))}
-        medians.index = medians.index.map(bin_centers)
-        
-        return medians.index, medians
+        return self.binned_median(HaloMass, StellarMass)
     
 class HSMR_z0(HSMR):
     """The HSMR constraint at z=0"""
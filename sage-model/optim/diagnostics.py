@@ -67,7 +67,7 @@ def load_space_and_particles(tracks_dir, space_file):
     fx = []
     for pos_fname, fx_fname in zip(pos_fnames, fx_fnames):
         pos.append(np.load(os.path.join(tracks_dir, pos_fname)))
-        fx.append(np.load(os.path.join(tracks_dir, fx_fname)))
+        fx.append(common.load_track_fx(os.path.join(tracks_dir, fx_fname)))
 
     # after this fx dims are (S, L), pos dims are (S, D, L)
     pos, fx = np.asarray(pos), np.asarray(fx)
@@ -202,38 +202,13 @@ def create_iteration_plot(filename, num_particles, num_iterations, obs_data, sag
         y_obs_converted = y_obs
         y_sage_converted = y_sage
 
-    # Process data
-    with open(filename, 'r') as file:
-        lines = file.readlines()
-    
-    blocks_by_iteration = []
-    current_iteration = []
-    current_block_y = []
-    x_values = []
-    capture_x = True
-
-    # Parse blocks
-    for line in lines:
-        line = line.strip()
-        if line.startswith("# New Data Block"):
-            if current_block_y:
-                current_iteration.append(current_block_y)
-                current_block_y = []
-                capture_x = False
-                if len(current_iteration) == num_particles:
-                    blocks_by_iteration.append(current_iteration)
-                    current_iteration = []
-                    if len(blocks_by_iteration) == num_iterations:
-                        break
-        elif line:
-            values = list(map(float, line.split('\t')))
-            if capture_x:
-                x_values.append(values[0])
-            current_block_y.append(values[2])
+    # Process data, the model values are indexed by [iteration, particle, bin]
+    x_values, blocks_by_iteration, _ = load_dump_file(filename)
+    blocks_by_iteration = blocks_by_iteration[:num_iterations]
 
     # Process scores
     track_files = sorted(glob.glob(f"{track_folder}/track_*_fx.npy"))
-    fit_scores = [np.load(file) for file in track_files[:num_iterations]]
+    fit_scores = [common.load_track_fx(file) for file in track_files[:num_iterations]]
     all_scores = np.concatenate(np.log10(fit_scores))
     
     # Create plot
@@ -264,57 +239,57 @@ def create_iteration_plot(filename, num_particles, num_iterations, obs_data, sag
         ax.plot(lowest_score_line[0], lowest_score_line[1], 'b-', linewidth=2.25, label='PSO Best Fit')
 
     # Add SHARK data if available
-    if plot_type == 'SMF' and 'SMF_z0_dump.txt' in filename:
+    if plot_type == 'SMF' and 'SMF_z0_dump.npz' in filename:
         mass, phi = load_observation('SHARK_SMF.csv', cols=[0,1])
         ax.plot(mass, transform_y(phi), 'g--', label='SHARK')
 
-    elif plot_type == 'SMF' and 'SMF_z05_dump.txt' in filename:
+    elif plot_type == 'SMF' and 'SMF_z05_dump.npz' in filename:
         mass, phi = load_observation('SHARK_SMF.csv', cols=[2,3])
         ax.plot(mass, transform_y(phi), 'g--', label='SHARK')
 
-    elif plot_type == 'SMF' and 'SMF_z10_dump.txt' in filename:
+    elif plot_type == 'SMF' and 'SMF_z10_dump.npz' in filename:
         mass, phi = load_observation('SHARK_SMF.csv', cols=[4,5])
         #print(mass, transform_y(phi))
         ax.plot(mass, transform_y(phi), 'g--', label='SHARK')
 
-    elif plot_type == 'SMF' and 'SMF_z20_dump.txt' in filename:
+    elif plot_type == 'SMF' and 'SMF_z20_dump.npz' in filename:
         mass, phi = load_observation('SHARK_SMF.csv', cols=[6,7])
         #print(mass, transform_y(phi))
         ax.plot(mass, transform_y(phi), 'g--', label='SHARK')
 
-    elif plot_type == 'SMF' and 'SMF_z31_dump.txt' in filename:
+    elif plot_type == 'SMF' and 'SMF_z31_dump.npz' in filename:
         mass, phi = load_observation('SHARK_SMF.csv', cols=[8,9])
         ax.plot(mass, transform_y(phi), 'g--', label='SHARK')
 
-    elif plot_type == 'SMF' and 'SMF_z46_dump.txt' in filename:
+    elif plot_type == 'SMF' and 'SMF_z46_dump.npz' in filename:
         mass, phi = load_observation('SHARK_SMF.csv', cols=[10,11])
         ax.plot(mass, transform_y(phi), 'g--', label='SHARK')
 
-    elif plot_type == 'BHBM' and 'BHBM_z0_dump.txt' in filename:
+    elif plot_type == 'BHBM' and 'BHBM_z0_dump.npz' in filename:
         mass, phi = load_observation('SHARK_BHBM_z0.csv', cols=[0,1])
         ax.plot(mass, phi, 'g--', label='SHARK')
 
-    elif plot_type == 'HSMR' and 'HSMR_z0_dump.txt' in filename:
+    elif plot_type == 'HSMR' and 'HSMR_z0_dump.npz' in filename:
         mass, phi = load_observation('SHARK_HSMR.csv', cols=[0,1])
         ax.plot(mass, transform_y(phi), 'g--', label='SHARK')
 
-    elif plot_type == 'HSMR' and 'HSMR_z05_dump.txt' in filename:
+    elif plot_type == 'HSMR' and 'HSMR_z05_dump.npz' in filename:
         mass, phi = load_observation('SHARK_HSMR.csv', cols=[2,3])
         ax.plot(mass, transform_y(phi), 'g--', label='SHARK')
 
-    elif plot_type == 'HSMR' and 'HSMR_z10_dump.txt' in filename:
+    elif plot_type == 'HSMR' and 'HSMR_z10_dump.npz' in filename:
         mass, phi = load_observation('SHARK_HSMR.csv', cols=[4,5])
         ax.plot(mass, transform_y(phi), 'g--', label='SHARK')
 
-    elif plot_type == 'HSMR' and 'HSMR_z20_dump.txt' in filename:
+    elif plot_type == 'HSMR' and 'HSMR_z20_dump.npz' in filename:
         mass, phi = load_observation('SHARK_HSMR.csv', cols=[6,7])
         ax.plot(mass, transform_y(phi), 'g--', label='SHARK')
 
-    elif plot_type == 'HSMR' and 'HSMR_z30_dump.txt' in filename:
+    elif plot_type == 'HSMR' and 'HSMR_z30_dump.npz' in filename:
         mass, phi = load_observation('SHARK_HSMR.csv', cols=[8,9])
         ax.plot(mass, transform_y(phi), 'g--', label='SHARK')
 
-    elif plot_type == 'HSMR' and 'HSMR_z40_dump.txt' in filename:
+    elif plot_type == 'HSMR' and 'HSMR_z40_dump.npz' in filename:
         mass, phi = load_observation('SHARK_HSMR.csv', cols=[10,11])
         ax.plot(mass, transform_y(phi), 'g--', label='SHARK')
         
@@ -705,7 +680,7 @@ def get_smf_files_map(config_opts):
     smf_files = {}
     
     # Handle z=0 case specially since it uses GAMA data
-    filename = f'SMF_z0_dump.txt'
+    filename = f'SMF_z0_dump.npz'
     filepath = os.path.join(config_opts.outdir, filename)
     if os.path.exists(filepath):
         logger.info(f"Found: {filename}")
@@ -714,7 +689,7 @@ def get_smf_files_map(config_opts):
         logger.info(f"Not found: {filename}")
 
     # Handle z=0 case specially since it uses GAMA data
-    filename = f'SMF_z10_dump.txt'
+    filename = f'SMF_z10_dump.npz'
     filepath = os.path.join(config_opts.outdir, filename)
     if os.path.exists(filepath):
         logger.info(f"Found: {filename}")
@@ -723,7 +698,7 @@ def get_smf_files_map(config_opts):
         logger.info(f"Not found: {filename}")
 
     # Handle z=0 case specially since it uses GAMA data
-    filename = f'SMF_z20_dump.txt'
+    filename = f'SMF_z20_dump.npz'
     filepath = os.path.join(config_opts.outdir, filename)
     if os.path.exists(filepath):
         logger.info(f"Found: {filename}")
@@ -739,7 +714,7 @@ def get_smf_files_map(config_opts):
         _, z_str = get_redshift_info(z=z)
         if z_str is None:
             continue
-        filename = f'SMF_z{z_str}_dump.txt'
+        filename = f'SMF_z{z_str}_dump.npz'
         filepath = os.path.join(config_opts.outdir, filename)
         if os.path.exists(filepath):
             logger.info(f"Found: {filename}")
@@ -764,7 +739,7 @@ def get_bhmf_files_map(config_opts):
         if z_str is None:
             continue
             
-        filename = f'BHMF_z{z_str}_dump.txt'
+        filename = f'BHMF_z{z_str}_dump.npz'
         filepath = os.path.join(config_opts.outdir, filename)
         if os.path.exists(filepath):
             logger.info(f"Found: {filename}")
@@ -788,7 +763,7 @@ def get_bhbm_files_map(config_opts):
         if z_str is None:
             continue
             
-        filename = f'BHBM_z{z_str}_dump.txt'
+        filename = f'BHBM_z{z_str}_dump.npz'
         filepath = os.path.join(config_opts.outdir, filename)
         if os.path.exists(filepath):
             logger.info(f"Found: {filename}")
@@ -814,7 +789,7 @@ def get_hsmr_files_map(config_opts):
         if z_str is None:
             continue
             
-        filename = f'HSMR_z{z_str}_dump.txt'
+        filename = f'HSMR_z{z_str}_dump.npz'
         filepath = os.path.join(config_opts.outdir, filename)
         if os.path.exists(filepath):
             files[filename] = (new_data[z], sage_data[z])
@@ -827,10 +802,18 @@ def file_exists_and_not_empty(filepath):
         return False
     return os.path.getsize(filepath) > 0
 
+def load_dump_file(filename):
+    """
+    Loads a <constraint>_dump.npz file (see execution.collect_dumps), returning
+    the x values, the model y values indexed by [iteration, particle, bin] and the
+    particle scores indexed by [iteration, particle]
+    """
+    with np.load(filename) as dump:
+        return dump['x'], dump['y_mod'], dump['fx']
+
 def read_smf_dump_file(filename, n_particles, skip_iterations):
     """
     Read SMF dump file and extract SMF values for all particles.
-    Each particle is marked by "# New Data Block" in the file.
     Skips the first skip_iterations iterations.
     
     Parameters:
@@ -850,57 +833,26 @@ def read_smf_dump_file(filename, n_particles, skip_iterations):
         SMF values for all particles after skipped iterations
     """
     logger = logging.getLogger('diagnostics')
-    x_values = None 
-    current_block = []
-    all_blocks = []
-    current_iteration = []
-    iteration_blocks = []
     
     logger.info(f"Reading file: {filename}")
     logger.info(f"Skipping first {skip_iterations} iterations ({skip_iterations * n_particles} blocks)")
     
     try:
-        with open(filename, 'r') as f:
-            for line in f:
-                line = line.strip()
-                if line.startswith("# New Data Block"):
-                    if current_block:
-                        values = np.array(current_block)
-                        if x_values is None:
-                            x_values = values[:, 0]  # Mass bins
-                            
-                        current_iteration.append(values[:, 2])
-                        if len(current_iteration) == n_particles:
-                            iteration_blocks.append(np.array(current_iteration))
-                            current_iteration = []
-                        
-                        current_block = []
-                elif line:
-                    try:
-                        values = list(map(float, line.split('\t')))
-                        current_block.append(values)
-                    except (ValueError, IndexError):
-                        continue
-                        
-        # Process last block if needed
-        if current_block:
-            values = np.array(current_block)
-            current_iteration.append(values[:, 2])
-            if len(current_iteration) == n_particles:
-                iteration_blocks.append(np.array(current_iteration))
-        
+        x_values, y_mod, _ = load_dump_file(filename)
+        if y_mod.shape[1] != n_particles:
+            logger.warning(f"Unexpected number of particles in {filename}: {y_mod.shape[1]} vs expected {n_particles}")
+
         # Skip iterations and process remaining ones
-        if skip_iterations < len(iteration_blocks):
-            iteration_blocks = iteration_blocks[skip_iterations:]
-            smf_values = np.vstack(iteration_blocks)
+        if skip_iterations < len(y_mod):
+            iteration_blocks = y_mod[skip_iterations:]
+            smf_values = iteration_blocks.reshape(-1, len(x_values))
         else:
             logger.error(f"Not enough iterations to skip {skip_iterations}")
             return None, None
             
-        if smf_values is not None:
-            logger.info(f"Mass bins shape: {x_values.shape}")
-            logger.info(f"SMF values shape: {smf_values.shape}")
-            logger.info(f"Skipped {skip_iterations} iterations, kept {len(iteration_blocks)} iterations")
+        logger.info(f"Mass bins shape: {x_values.shape}")
+        logger.info(f"SMF values shape: {smf_values.shape}")
+        logger.info(f"Skipped {skip_iterations} iterations, kept {len(iteration_blocks)} iterations")
         
         return x_values, smf_values
         
@@ -1,287 +1,782 @@
 #!/bin/bash
 
+import fcntl
+import glob
+import hashlib
 import logging
+import math
 import multiprocessing
 import os
 import shutil
+import signal
 import subprocess
+import sys
 import time
+from functools import partial
 
 import numpy as np # type: ignore
 
+import analysis
 import common
+import constraints
 
 
 logger = logging.getLogger(__name__)
 
-def count_jobs(job_name, username=None):
+class SageTimeout(RuntimeError):
+    """SAGE didn't finish within the wall-clock limit for a particle"""
+
+# Per-particle wall-clock limits (see --timeout and --timeout-percentile). The run times
+# of the SAGE instances that finish are recorded in <outdir>/sage_run_times.txt
+MIN_RUN_TIMES = 5
+
+def record_run_time(opts, seconds):
+    with open(os.path.join(opts.outdir, 'sage_run_times.txt'), 'a') as f:
+        f.write(f'{seconds:.3f}\n')
+
+def run_time_limit(opts):
     """
-    Returns how many jobs are currently queued or running.
-    If username is provided, checks all jobs for that user.
-    Otherwise, checks for jobs matching job_name.
+    The wall-clock limit for a SAGE instance: --timeout, or --timeout-factor times the
+    --timeout-percentile of the recorded run times (whichever is lower), None if no limit
     """
-    try:
-        if username:
-            # Check jobs for specific user
-            out, err, code = common.exec_command(["squeue", "-u", username])
-        else:
-            # Fall back to checking all jobs and filtering by name
-            out, err, code = common.exec_command("squeue")
-            
-        if code:
-            raise RuntimeError(f"squeue failed with code {code}: stdout: {out}, stderr: {err}")
-        
-        # Convert bytes to string if necessary
-        if isinstance(out, bytes):
-            out = out.decode('utf-8')
-            
-        if username:
-            # For username query, just count lines (minus header)
-            return max(0, len(out.splitlines()) - 1)
-        else:
-            # For job name, filter lines containing the name
-            lines_with_jobname = [l for l in out.splitlines() if job_name in l]
-            return len(lines_with_jobname)
-            
-    except OSError:
-        raise RuntimeError("Couldn't run squeue, is it installed?")
+    limit = opts.timeout
+    fname = os.path.join(opts.outdir, 'sage_run_times.txt')
+    if opts.timeout_percentile and os.path.exists(fname):
+        with open(fname) as f:
+            times = [float(line) for line in f if line.strip()]
+        if len(times) >= MIN_RUN_TIMES:
+            adaptive = opts.timeout_factor * np.percentile(times, opts.timeout_percentile)
+            limit = adaptive if limit is None else min(limit, adaptive)
+    return limit
+
+def _kill(process, grace=5):
+    """Terminates a process started with start_new_session=True, and everything it started"""
+    for sig in (signal.SIGTERM, signal.SIGKILL):
+        try:
+            os.killpg(process.pid, sig)
+        except ProcessLookupError:
+            break
+        try:
+            process.wait(grace)
+            break
+        except subprocess.TimeoutExpired:
+            pass
+    process.wait()
 
 #This is the original function and is just fine
-def _exec_sage(msg, cmdline):
+def _exec_sage(msg, cmdline, timeout=None):
     logger.info('%s with command line: %s', msg, subprocess.list2cmdline(cmdline))
-    out, err, code = common.exec_command(cmdline)
+    # In its own session, so mpirun and its ranks can all be killed on timeout
+    process = subprocess.Popen(cmdline, stdout=subprocess.PIPE, stderr=subprocess.PIPE, start_new_session=True)
+    try:
+        out, err = process.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        _kill(process)
+        process.communicate()
+        raise SageTimeout('%s did not finish in %.0f [s]' % (cmdline[0], timeout))
+    code = process.returncode
     if code != 0:
         logger.error('Error while executing %s (exit code %d):\n' +
                      'stdout:\n%s\nstderr:\n%s', cmdline[0], code,
                      common.b2s(out), common.b2s(err))
         raise RuntimeError('%s error' % cmdline[0])
 
-def _evaluate(constraint, stat_test, modeldir, subvols):
+def _constraint_data(constraint, modeldir, subvols, evaluations=None):
+    """The (y_obs, y_mod, err) a constraint compares, also added to evaluations if given"""
     y_obs, y_mod, err = constraint.get_data(modeldir, subvols)
-    return stat_test(y_obs, y_mod, err)
+    if evaluations is not None:
+        evaluations[_cache_label(constraint)] = dict(y_obs=y_obs, y_mod=y_mod, err=err)
+    return y_obs, y_mod, err
+
+def _model_data(opts, model, volume_fraction=1.0):
+    """The ModelData for the constraints of the run, which only keeps the galaxies these use"""
+    return constraints.ModelData(model, [c.snapshot for c in opts.constraints], volume_fraction,
+                                 [c for c in opts.constraints if isinstance(c, constraints.Relation)])
+
+def _evaluate(constraint, stat_test, modeldir, subvols, evaluations=None):
+    return stat_test(*_constraint_data(constraint, modeldir, subvols, evaluations))
+
+# On-disk evaluation cache (see --eval-cache). For every parameter vector (rounded as
+# in the parameter files) it keeps what each constraint compared (y_obs, y_mod, err),
+# rather than the score, so that a cached particle can be scored with any stat test.
+# Entries are only valid for the same base configuration, SAGE build and constraints
+# code, which cache_version summarises
+def cache_version(opts):
+    """Hash of everything other than the particle that determines the constraints' data"""
+    h = hashlib.sha1()
+    if opts.in_process:
+        # The cffi module is only a stub, linked against the libsage.so next to it
+        load_sage_lib()
+        stub = sys.modules['_sage_cffi'].__file__
+        sage = [stub, os.path.join(os.path.dirname(stub), 'libsage.so')]
+    else:
+        sage = [opts.sage_binary]
+    # The modules that read the model output and reduce it to the constraints' data
+    modules = [os.path.join(os.path.dirname(os.path.abspath(__file__)), m) for m in ('constraints.py', 'routines.py', 'common.py')]
+    for fname in [opts.config] + sage + modules:
+        with open(fname, 'rb') as f:
+            h.update(f.read())
+    h.update(repr((opts.sim, opts.boxsize, opts.vol_frac, opts.age_alist_file, opts.Omega0, opts.h0, opts.subvolumes)).encode())
+    return h.hexdigest()
+
+def _cache_label(constraint):
+    return f'{constraint.__class__.__name__}({constraint.domain[0]}-{constraint.domain[1]})@{constraint.snapshot}'
+
+def _cache_file(opts, space, particle):
+    params = ','.join(f'{name}={round(particle[p], 5)}' for p, name in enumerate(space['name']))
+    key = hashlib.sha1(f'{opts.cache_version}\n{params}'.encode()).hexdigest()
+    return os.path.join(opts.eval_cache, key + '.npz')
+
+def load_cached_evaluation(opts, space, particle):
+    """
+    The cached data of every constraint for the particle, as {label: {y_obs, y_mod, err}},
+    plus the particle's dump data under 'dump'. None if not cached (for all constraints)
+    """
+    if not opts.eval_cache:
+        return None
+    fname = _cache_file(opts, space, particle)
+    if not os.path.exists(fname):
+        return None
+    cached = {}
+    with np.load(fname) as arrays:
+        for key in arrays.files:
+            label, field = key.rsplit('|', 1)
+            cached.setdefault(label, {})[field] = arrays[key]
+    if any(_cache_label(c) not in cached for c in opts.constraints):
+        return None
+    return cached
+
+def save_cached_evaluation(opts, space, particle, evaluations, model):
+    """Adds the data of the constraints just evaluated for the particle to its cache entry"""
+    if not opts.eval_cache:
+        return
+    fname = _cache_file(opts, space, particle)
+    arrays = {}
+    if os.path.exists(fname):
+        with np.load(fname) as previous:
+            arrays = {key: previous[key] for key in previous.files}
+    for label, data in evaluations.items():
+        arrays.update({f'{label}|{field}': value for field, value in data.items()})
+    for name, data in model.dump_data.items():
+        arrays.update({f'dump:{name}|{field}': value for field, value in data.items()})
+    os.makedirs(opts.eval_cache, exist_ok=True)
+    _write_npz(fname, arrays)
+
+def _restore_cached_dumps(opts, cached, particle):
+    """Saves the dump data of a cached particle as if it had been evaluated"""
+    dump_data = {label[len('dump:'):]: data for label, data in cached.items() if label.startswith('dump:')}
+    _save_particle_data(os.path.join(opts.outdir, 'dumps'), particle, dump_data)
+
+def _score_cached(opts, statTest, cached, particle):
+    """Per-constraint scores of a cached particle; its dump data is saved as if it had been evaluated"""
+    _restore_cached_dumps(opts, cached, particle)
+    return [statTest(*(cached[_cache_label(c)][field] for field in ('y_obs', 'y_mod', 'err'))) for c in opts.constraints]
+
+def particle_key(particle):
+    """A short name identifying the particle (i.e., its exact position)"""
+    return hashlib.sha1(np.asarray(particle, dtype=np.float64).tobytes()).hexdigest()[:16]
+
+def _particle_file(dirname, particle):
+    return os.path.join(dirname, particle_key(particle) + '.npz')
+
+def _write_npz(fname, arrays):
+    # Write and rename, so a file is never seen half-written
+    tmp_fname = f'{fname}.{os.getpid()}.tmp'
+    with open(tmp_fname, 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(tmp_fname, fname)
+
+def _save_particle_data(dirname, particle, data):
+    """Saves data, the arrays of each constraint (by name), to the particle's file under dirname"""
+    if not data:
+        return
+    os.makedirs(dirname, exist_ok=True)
+    arrays = {f'{name}.{key}': value for name, values in data.items() for key, value in values.items()}
+    _write_npz(_particle_file(dirname, particle), arrays)
+
+def _load_particle_data(dirname, particle):
+    """Loads what _save_particle_data saved for the particle, None if there is nothing"""
+    fname = _particle_file(dirname, particle)
+    if not os.path.exists(fname):
+        return None
+    data = {}
+    with np.load(fname) as arrays:
+        for key in arrays.files:
+            name, field = key.split('.', 1)
+            data.setdefault(name, {})[field] = arrays[key]
+    return data
+
+def save_plot_data(opts, particle, model):
+    """Saves the plot data the constraints left in model, so the particle can be plotted later on"""
+    _save_particle_data(os.path.join(opts.outdir, 'plot_data'), particle, model.plot_data)
+
+def load_plot_data(outdir, particle):
+    """Loads the plot data saved for the particle, per constraint name. None if there is none"""
+    return _load_particle_data(os.path.join(outdir, 'plot_data'), particle)
+
+def save_dump_data(opts, particle, model):
+    """Saves the model values the constraints left in model, for collect_dumps to pick them up"""
+    _save_particle_data(os.path.join(opts.outdir, 'dumps'), particle, model.dump_data)
+
+def collect_dumps(outdir, tracks_dir, constraint_names):
+    """
+    Gathers the values saved by save_dump_data for every particle of every iteration into
+    <outdir>/<constraint>_dump.npz, one per constraint, with the arrays
+      x, y_obs: the observations (per bin)
+      y_mod:    the model values, indexed by [iteration, particle, bin] (NaNs if the particle failed)
+      fx:       the particle scores, indexed by [iteration, particle] (NaN if the surrogate screened it out)
+    """
+    dumpsdir = os.path.join(outdir, 'dumps')
+    fx_files = sorted(glob.glob(os.path.join(tracks_dir, 'track_*_fx.npy')))
+    if not fx_files:
+        return
+    fx = np.array([common.load_track_fx(fname) for fname in fx_files])
+    positions = [np.load(fname[:-len('_fx.npy')] + '_pos.npy') for fname in fx_files]
+    L, S = fx.shape
+
+    collected = {}
+    for it in range(L):
+        for i in range(S):
+            data = _load_particle_data(dumpsdir, positions[it][i])
+            if data is None:
+                continue
+            for name in constraint_names:
+                if name not in data:
+                    continue
+                values = data[name]
+                if name not in collected:
+                    collected[name] = dict(x=values['x_obs'], y_obs=values['y_obs'],
+                                           y_mod=np.full((L, S, len(values['x_obs'])), np.nan), fx=fx)
+                collected[name]['y_mod'][it, i] = values['y_mod']
+
+    for name, arrays in collected.items():
+        _write_npz(os.path.join(outdir, f'{name}_dump.npz'), arrays)
 
 count = 0
+# How often (in seconds) the completion of SLURM array tasks is checked
+SLURM_POLL_INTERVAL = 10
+# How long a task that SLURM says has ended can go without its status file
+# showing up (e.g., due to file system lag) before it is considered failed
+SLURM_STATUS_GRACE = 30
+_SLURM_ACTIVE_STATES = ('PENDING', 'RUNNING', 'REQUEUED', 'CONFIGURING', 'COMPLETING', 'SUSPENDED', 'RESIZING')
+
+def _write_particle_params(opts, space, particle, temp_filename, output_dir, overrides=None):
+    """
+    Writes the base configuration file with the particle's parameters, output_dir as
+    OutputDir and any other parameters in overrides (e.g., FirstFile and LastFile)
+    """
+    with open(opts.config) as f:
+        lines = f.readlines()
+
+    values = {name: round(particle[p], 5) for p, name in enumerate(space['name'])}
+    values.update(overrides or {})
+    with open(temp_filename, 'w') as s:
+        Ndone = 0
+        for l, line in enumerate(lines):
+            if line[:9] == 'OutputDir':
+                lines[l] = f'OutputDir              {output_dir}\n'
+            for name, value in values.items():
+                if line[:len(name)] == name:
+                    lines[l] = f'{name}          {value}\n'
+                    Ndone += 1
+            if Ndone == len(values):
+                break
+        s.writelines(lines)
+
+def _write_slurm_array_script(opts, batch_script, job_name, indices, param_prefix, work_prefix, modeldir, timeout=None):
+    """
+    Writes the batch script of a job array running one particle per task. Each task
+    writes its exit status and the run time of SAGE to <modeldir>/<task>.status when
+    it finishes. SAGE is killed if it runs for longer than timeout seconds
+    """
+    with open(batch_script, 'w') as f:
+        f.write("#!/bin/bash\n")
+        f.write(f"#SBATCH --job-name={job_name}\n")
+        f.write(f"#SBATCH --array={','.join(str(i) for i in indices)}\n")
+        f.write("#SBATCH --output=/dev/null\n")
+        f.write("#SBATCH --error=/dev/null\n\n")
+        f.write(f"#SBATCH --ntasks={opts.cpus}\n")
+        f.write(f"#SBATCH --mem-per-cpu={opts.memory}\n")
+        f.write("#SBATCH --tmp=200GB\n")
+
+        if opts.walltime:
+            f.write(f"#SBATCH --time={opts.walltime}\n")
+        if opts.account:
+            f.write(f"#SBATCH --account={opts.account}\n")
+        if opts.queue:
+            f.write(f"#SBATCH --partition={opts.queue}\n")
+
+        # Each task runs the particle with its index
+        f.write("\nTASK=$SLURM_ARRAY_TASK_ID\n")
+        f.write(f"PARAM_FILE={param_prefix}_${{TASK}}_temp.par\n")
+        f.write(f"WORK_DIR={work_prefix}_${{TASK}}\n")
+        f.write(f"PARTICLE_DIR={modeldir}${{TASK}}/\n")
+
+        # Create work directory in JOBFS
+        f.write("\n# Setup working directory\n")
+        f.write('mkdir -p $WORK_DIR\n')
+
+        # Show initial JOBFS state
+        f.write('\necho "Initial JOBFS status:"\n')
+        f.write('df -h $JOBFS\n')
+
+        f.write("\nml purge\n")
+        f.write("ml restore basic\n\n")
+
+        # Run SAGE
+        f.write(f"echo 'Starting SAGE job with {opts.cpus} CPUs'\n")
+        limit = f"timeout --kill-after=30 {int(math.ceil(timeout))} " if timeout else ""
+        f.write("start=$SECONDS\n")
+        f.write(f"{limit}mpirun -np {opts.cpus} {opts.sage_binary} $PARAM_FILE\n")
+        f.write("status=$?\n")
+        f.write("run_time=$((SECONDS - start))\n")
+
+        # Copy results back with error checking
+        f.write("\necho 'Copying results to permanent storage...'\n")
+        f.write('if [ $status -ne 0 ]; then\n')
+        f.write('    echo "Error: SAGE failed"\n')
+        f.write('elif [ "$(ls -A $WORK_DIR)" ]; then\n')
+        f.write('    cp -r $WORK_DIR/* $PARTICLE_DIR\n')
+        f.write('    echo "Copy completed successfully"\n')
+        f.write('else\n')
+        f.write('    echo "Error: No files found in JOBFS working directory"\n')
+        f.write('    status=1\n')
+        f.write('fi\n\n')
+
+        # Completion marker, renamed into place so it is never seen half-written
+        f.write(f'echo $status $run_time > {modeldir}${{TASK}}.status.tmp\n')
+        f.write(f'mv {modeldir}${{TASK}}.status.tmp {modeldir}${{TASK}}.status\n')
+        f.write('exit $status\n')
+
+def _read_task_status(modeldir, i):
+    """The exit status and run time written by array task i, None if it hasn't written them"""
+    try:
+        with open(os.path.join(modeldir, f'{i}.status')) as f:
+            status, run_time = f.read().split()
+        return int(status), float(run_time)
+    except (OSError, ValueError):
+        return None
+
+def _slurm_task_states(jobid):
+    """
+    Returns {task: state} for the tasks of the jobid array that sacct knows about,
+    or None if sacct is not available (e.g., no accounting on the cluster)
+    """
+    try:
+        out, err, code = common.exec_command(['sacct', '-n', '-X', '-P', '-j', jobid, '-o', 'JobID,State'])
+    except OSError:
+        return None
+    if code:
+        return None
+    states = {}
+    for line in common.b2s(out).splitlines():
+        job, _, state = line.partition('|')
+        task = job.partition('_')[2]
+        # Pending tasks are still listed together, e.g. 1234_[3-7]
+        if task.isdigit() and state:
+            states[int(task)] = state.split()[0]
+    return states
+
+def _slurm_job_queued(jobid):
+    """Whether squeue still lists any task of the jobid array"""
+    try:
+        out, err, code = common.exec_command(['squeue', '-h', '-j', jobid, '-o', '%i'])
+    except OSError:
+        raise RuntimeError("Couldn't run squeue, is it installed?")
+    if code:
+        # Jobs that left the queue some time ago are reported as invalid
+        if b'Invalid job id' in err:
+            return False
+        raise RuntimeError(f"squeue failed with code {code}: stdout: {out}, stderr: {err}")
+    return bool(out.strip())
+
+def _wait_for_slurm_array(jobid, indices, modeldir):
+    """
+    Yields (task, (exit status, run time)) for the tasks of the jobid array as
+    they finish. Tasks that ended without writing their status file (e.g., killed
+    by SLURM) are yielded with a None status, once sacct (or squeue, if sacct is
+    not available) shows they are not running anymore
+    """
+    pending = set(indices)
+    ended_at = {}
+    while pending:
+        for i in sorted(pending):
+            status = _read_task_status(modeldir, i)
+            if status is not None:
+                pending.discard(i)
+                yield i, status
+        if not pending:
+            break
+
+        states = _slurm_task_states(jobid)
+        if states is not None:
+            ended = {i for i in pending if i in states and states[i] not in _SLURM_ACTIVE_STATES}
+        elif not _slurm_job_queued(jobid):
+            ended = set(pending)
+        else:
+            ended = set()
+        now = time.time()
+        for i in sorted(ended):
+            ended_at.setdefault(i, now)
+            if now - ended_at[i] >= SLURM_STATUS_GRACE:
+                logger.error(f"SLURM task {jobid}_{i} ended ({states[i] if states else 'not in the queue'}) without finishing")
+                pending.discard(i)
+                yield i, None
+        if pending:
+            time.sleep(SLURM_POLL_INTERVAL)
+
+def _tree_files(config):
+    """The FirstFile and LastFile of a SAGE parameter file"""
+    params = {}
+    with open(config) as f:
+        for line in f:
+            words = line.split()
+            if len(words) >= 2 and words[0] in ('FirstFile', 'LastFile'):
+                params[words[0]] = int(words[1])
+    return params['FirstFile'], params['LastFile']
+
+def _num_tree_files(config):
+    """The number of tree files (FirstFile to LastFile) a SAGE parameter file processes"""
+    first, last = _tree_files(config)
+    return last - first + 1
+
+# Multi-fidelity evaluation (see --low-fidelity). Particles are first run on a subset of
+# the tree files, and only re-run on all of them if their score is promising compared to
+# the low-fidelity scores so far, which are recorded in <outdir>/low_fidelity_scores.txt.
+# Until there are enough scores to compare to, every particle is promoted. Particles that
+# aren't promoted get an infinite score, so low-fidelity scores never compete with full ones
+# (nor are taken for the penalty score of failed runs, e.g. by the surrogate)
+MIN_LOW_FIDELITY_SCORES = 10
+
+def low_fidelity_overrides(opts):
+    """
+    The FirstFile/LastFile overrides that make SAGE process only the --low-fidelity
+    fraction of the tree files, and the fraction of the volume these cover
+    """
+    first, last = _tree_files(opts.config)
+    nfiles = last - first + 1
+    nsub = min(nfiles, max(1, int(round(opts.low_fidelity * nfiles))))
+    return {'FirstFile': first, 'LastFile': first + nsub - 1}, nsub / nfiles
+
+def promote(opts, score):
+    """
+    Records the low-fidelity score of a particle and returns whether it should be re-evaluated
+    on all the tree files: always while there are too few scores to compare to, afterwards
+    if it is within their --promote-quantile. Particles that got the penalty score are never promoted
+    """
+    if score >= 1e10:
+        return False
+    # Particles evaluated in parallel record their scores in the same file
+    with open(os.path.join(opts.outdir, 'low_fidelity_scores.txt'), 'a+') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.seek(0)
+        scores = [float(line) for line in f if line.strip()]
+        f.write(f'{score:.17g}\n')
+    scores.append(score)
+    return len(scores) < MIN_LOW_FIDELITY_SCORES or score <= np.quantile(scores, opts.promote_quantile)
+
+def _multi_fidelity(run, particle, args):
+    """
+    Evaluates a particle with run(particle, args, overrides, volume_fraction), first on the
+    --low-fidelity subset of the tree files (if given), and then on all of them if promoted.
+    Particles that aren't promoted get an infinite score
+    """
+    opts = args[0]
+    if opts.low_fidelity:
+        overrides, volume_fraction = low_fidelity_overrides(opts)
+        total = run(particle, args, overrides, volume_fraction)
+        if not promote(opts, total):
+            return np.inf
+        logger.info('Particle %r promoted to a run on all tree files', particle)
+    return run(particle, args, {}, 1.0)
+
+def _auto_ranks(nfiles, ncores, nparticles):
+    """
+    The number of MPI ranks per SAGE instance that runs nparticles soonest on ncores,
+    assuming the run time of an instance goes with the number of tree files per rank
+    """
+    best_time, best_ranks = None, 1
+    for ranks in range(1, max(1, min(nfiles, ncores)) + 1):
+        rounds = -(-nparticles // (ncores // ranks))
+        run_time = rounds * -(-nfiles // ranks)
+        if best_time is None or run_time < best_time:
+            best_time, best_ranks = run_time, ranks
+    return best_ranks
+
+def _usable_cores():
+    """The cores this process can run on (all of them where CPU affinity isn't supported, e.g. macOS)"""
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+def _run_packed(commands, ranks, cores, finished, timeout=None):
+    """
+    Runs the (index, cmdline, log file) commands, each using ranks cores, on the given cores.
+    Only as many run at once as fit on the cores without sharing them, each pinned to its
+    own cores, and the next one starts as soon as one finishes. finished(index, return code,
+    log file, run time) is called for each as it finishes; commands still running after
+    timeout seconds are killed, with None as their return code. Where CPU affinity isn't
+    supported the instances are still packed, but not pinned
+    """
+    pending = list(commands)
+    free = list(cores)
+    # Instances with more ranks than cores just get all of them (one at a time)
+    slots = min(ranks, len(cores))
+    running = []
+    while pending or running:
+        while pending and len(free) >= slots:
+            i, cmdline, log = pending.pop(0)
+            pinned, free = free[:slots], free[slots:]
+            logger.info(f'Running SAGE instance {i} on cores {pinned}: {subprocess.list2cmdline(cmdline)}')
+            with open(log, 'w') as f:
+                pin = partial(os.sched_setaffinity, 0, pinned) if hasattr(os, 'sched_setaffinity') else None
+                process = subprocess.Popen(cmdline, stdout=f, stderr=subprocess.STDOUT, start_new_session=True,
+                                           preexec_fn=pin)
+            running.append((i, process, log, pinned, time.time()))
+
+        time.sleep(0.1)
+        for item in list(running):
+            i, process, log, pinned, start = item
+            run_time = time.time() - start
+            if process.poll() is not None:
+                returncode = process.returncode
+            elif timeout is not None and run_time > timeout:
+                _kill(process)
+                returncode = None
+            else:
+                continue
+            running.remove(item)
+            free += pinned
+            finished(i, returncode, log, run_time)
+
+def _model_dir(opts, name):
+    """
+    The directory SAGE writes its output to for a particle (or an iteration): under --scratch
+    (node-local storage like /dev/shm) if given, where the constraints then read it without
+    touching the shared file system, otherwise under the output directory
+    """
+    return os.path.join(opts.scratch or opts.outdir, name + '/')
+
+def _release_model_dir(opts, modeldir, keep=False):
+    """Removes a model output directory, first copying it to the output directory if it was staged in --scratch and keep is set"""
+    staged = opts.scratch and os.path.dirname(os.path.normpath(modeldir)) == os.path.normpath(opts.scratch)
+    if keep and not staged:
+        return
+    if keep:
+        shutil.copytree(modeldir, os.path.join(opts.outdir, os.path.basename(os.path.normpath(modeldir))), dirs_exist_ok=True)
+    shutil.rmtree(modeldir)
+
+def _evaluate_particle_output(opts, space, subvols, particle, particle_dir, volume_fraction=1.0):
+    """
+    The data each constraint compares for the output SAGE wrote for a particle, as
+    {label: {y_obs, y_mod, err}} (like the evaluation cache), None if that fails.
+    Only full-volume evaluations go into the evaluation cache
+    """
+    # Process results with retries
+    max_retries = 1
+    retry_delay = 10
+    for retry in range(max_retries):
+        try:
+            model = _model_data(opts, particle_dir, volume_fraction)
+            evaluations = {}
+            for c in opts.constraints:
+                _constraint_data(c, model, subvols, evaluations)
+            save_plot_data(opts, particle, model)
+            save_dump_data(opts, particle, model)
+            if volume_fraction == 1:
+                save_cached_evaluation(opts, space, particle, evaluations, model)
+            return evaluations
+        except Exception as e:
+            logger.warning(f"Attempt {retry+1}: Error evaluating particle: {e}")
+            time.sleep(retry_delay)
+    return None
+
 def run_sage_hpc(particles, *args):
     """Modified version for SAGE with parallel particle execution."""
+    return evaluate_sage_hpc(particles, *args)[0]
+
+def evaluate_sage_hpc(particles, *args):
+    """
+    Same as run_sage_hpc, but as a vectorized evaluator for pso.pso: returns the values of
+    the particles, their feasibility (always true) and a dict per particle saying whether it
+    was taken from the evaluation cache, whether SAGE failed for it (and it got the penalty score)
+    and whether its value comes from a run on the --low-fidelity subset of the tree files.
+    With --low-fidelity the whole swarm is run on the subset first, and then only the
+    promoted particles on all the tree files; the rest get an infinite score
+    """
+    opts = args[0]
+    if not opts.low_fidelity:
+        return _evaluate_sage_hpc(particles, args)
+
+    overrides, volume_fraction = low_fidelity_overrides(opts)
+    fx, fs, diagnostics = _evaluate_sage_hpc(particles, args, overrides, volume_fraction)
+    promoted = []
+    for i, d in enumerate(diagnostics):
+        if d['cached']:
+            continue
+        if promote(opts, fx[i]):
+            promoted.append(i)
+        else:
+            fx[i] = np.inf
+    if promoted:
+        logger.info(f'Particles {promoted} promoted to runs on all tree files')
+        fx_full, _, diagnostics_full = _evaluate_sage_hpc(np.asarray(particles)[promoted], args)
+        for j, i in enumerate(promoted):
+            fx[i] = fx_full[j]
+            diagnostics[i] = diagnostics_full[j]
+    return fx, fs, diagnostics
+
+def _evaluate_sage_hpc(particles, args, overrides=None, volume_fraction=1.0):
+    """evaluate_sage_hpc for a single fidelity, with overrides for the parameter files"""
     global count, opts
     opts, space, subvols, statTest = args
 
-    # Create base output directory for all particles
-    modeldir = os.path.join(opts.outdir, f'DS_output_{count}/')
+    # Determine if we should use SLURM
+    use_slurm = opts.cpus > 4
+
+    # Create base output directory for all particles. SLURM tasks stage
+    # their output in JOBFS and copy it here, so it must be shared
+    if use_slurm:
+        modeldir = os.path.join(opts.outdir, f'DS_output_{count}/')
+    else:
+        modeldir = _model_dir(opts, f'DS_output_{count}')
     if not os.path.exists(modeldir):
         os.makedirs(modeldir)
 
-    fx = np.zeros(len(particles))
-    processes = []
+    # Particles already in the evaluation cache are not run again. The data the constraints
+    # compare for every particle are collected, and the whole swarm scored at once at the end
+    cached = [load_cached_evaluation(opts, space, particle) for particle in particles]
+    evaluations = list(cached)
+    diagnostics = [{'cached': c is not None, 'failed': False, 'timed_out': False,
+                    'low_fidelity': c is None and volume_fraction < 1} for c in cached]
+    to_run = [i for i in range(len(particles)) if cached[i] is None]
+    timeout = run_time_limit(opts)
 
-    # Determine if we should use SLURM
-    use_slurm = opts.cpus > 4
+    slash = len(opts.config) - opts.config[::-1].find('/') - 1
+    param_prefix = os.path.join(opts.outdir, f'{opts.config[slash+1:-4]}_{count}')
 
-    if use_slurm:
-        # Prepare for SLURM submission
+    def process_output(i, ok):
+        if ok:
+            evaluations[i] = _evaluate_particle_output(opts, space, subvols, particles[i], os.path.join(modeldir, f"{i}/"), volume_fraction)
+        if evaluations[i] is None:
+            logger.warning(f"Failed to process outputs for particle {i}  - assigning penalty score")
+            logger.warning("This usually means SAGE is unhappy, bad parameter combination")
+            diagnostics[i]['failed'] = True
+
+        # Clean up parameter file
+        try:
+            os.remove(f'{param_prefix}_{i}_temp.par')
+        except OSError:
+            pass
+
+    if use_slurm and to_run:
+        # One job array per iteration, with a task per particle
         job_name = f'PSOSMF_{count}'
-        
-        for i, particle in enumerate(particles):
-            # Create particle subdirectory
-            particle_dir = os.path.join(modeldir, f"{i}/")
-            os.makedirs(particle_dir, exist_ok=True)
-            
-            # Get JOBFS path from environment
-            jobfs = os.environ.get('JOBFS', '/var/tmp')
-            work_dir = os.path.join(jobfs, 'jobfs')
-            
-            # Create particle-specific parameter file
-            slash = len(opts.config) - opts.config[::-1].find('/') - 1
-            temp_filename = os.path.join(opts.outdir, f'{opts.config[slash+1:-4]}_{count}_{i}_temp.par')
-            
-            # Modify parameter file with JOBFS path
-            with open(opts.config) as f:
-                lines = f.readlines()
-                
-            with open(temp_filename, 'w') as s:
-                Ndone = 0
-                for l, line in enumerate(lines):
-                    if line[:9] == 'OutputDir':
-                        lines[l] = f'OutputDir              {work_dir}\n'
-                    for p, name in enumerate(space['name']):
-                        if line[:len(name)] == name:
-                            lines[l] = f'{name}          {str(round(particle[p],5))}\n'
-                            Ndone += 1
-                    if Ndone == len(space['name']):
-                        break
-                s.writelines(lines)
-
-            logger.info(f'Submitting SAGE SLURM job for: {temp_filename}')
-
-            # Create SLURM batch script
-            batch_script = os.path.join(opts.outdir, f'slurm_script_{count}_{i}.slurm')
-            with open(batch_script, 'w') as f:
-                f.write("#!/bin/bash\n")
-                f.write(f"#SBATCH --job-name={job_name}_{i}\n")
-                f.write("#SBATCH --output=/dev/null\n")
-                f.write("#SBATCH --error=/dev/null\n\n")
-                f.write(f"#SBATCH --ntasks={opts.cpus}\n")
-                f.write(f"#SBATCH --mem-per-cpu={opts.memory}\n")
-                f.write("#SBATCH --tmp=200GB\n")
-
-                if opts.walltime:
-                    f.write(f"#SBATCH --time={opts.walltime}\n")
-                if opts.account:
-                    f.write(f"#SBATCH --account={opts.account}\n")
-                if opts.queue:
-                    f.write(f"#SBATCH --partition={opts.queue}\n")
-                
-                # Create work directory in JOBFS
-                f.write("\n# Setup working directory\n")
-                f.write(f'mkdir -p {work_dir}\n')
-                
-                # Show initial JOBFS state
-                f.write('\necho "Initial JOBFS status:"\n')
-                f.write('df -h $JOBFS\n')
-                
-                f.write("\nml purge\n")
-                f.write("ml restore basic\n\n")
-                
-                # Run SAGE
-                f.write(f"echo 'Starting SAGE job with {opts.cpus} CPUs'\n")
-                f.write(f"mpirun -np {opts.cpus} {opts.sage_binary} {temp_filename}\n")
-                
-                # Copy results back with error checking
-                f.write("\necho 'Copying results to permanent storage...'\n")
-                f.write(f'if [ "$(ls -A {work_dir})" ]; then\n')
-                f.write(f'    cp -r {work_dir}/* {particle_dir}\n')
-                f.write('    echo "Copy completed successfully"\n')
-                f.write('else\n')
-                f.write('    echo "Error: No files found in JOBFS working directory"\n')
-                f.write('    exit 1\n')
-                f.write('fi\n\n')
-
-            # Submit job using the batch script
-            cmdline = ['sbatch', batch_script]
-            process = subprocess.Popen(cmdline, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            out, err = process.communicate()
-            
-            if process.returncode != 0:
-                raise RuntimeError(f"SLURM submission failed: {err.decode()}")
-                
-            # Extract job ID from sbatch output
-            jobid = out.decode().strip().split()[-1]
-            processes.append((i, jobid, temp_filename, particle_dir, batch_script))
-
-        # Wait for all SLURM jobs to complete
-        logger.info('Waiting for all SLURM jobs to complete...')
-        #while True:
-            #if count_jobs(job_name) == 0:
-                #break
-            #time.sleep(40)
-        while True:
-            if count_jobs(job_name, opts.username) == 0:
-                # Add delay to allow file system to settle
-                time.sleep(2)  
-                break
-            time.sleep(10)
 
-    else:
-        # Use MPI implementation for small CPU requests
-        for i, particle in enumerate(particles):
+        # Get JOBFS path from environment
+        jobfs = os.environ.get('JOBFS', '/var/tmp')
+        work_prefix = os.path.join(jobfs, f'jobfs_{count}')
+
+        for i in to_run:
+            # Create particle subdirectory and parameter file
+            os.makedirs(os.path.join(modeldir, f"{i}/"), exist_ok=True)
+            _write_particle_params(opts, space, particles[i], f'{param_prefix}_{i}_temp.par', f'{work_prefix}_{i}', overrides)
+
+        batch_script = os.path.join(opts.outdir, f'slurm_script_{count}.slurm')
+        _write_slurm_array_script(opts, batch_script, job_name, to_run, param_prefix, work_prefix, modeldir, timeout)
+
+        # Submit job using the batch script
+        logger.info(f'Submitting SAGE SLURM job array for particles {to_run}')
+        out, err, code = common.exec_command(['sbatch', batch_script])
+        if code != 0:
+            raise RuntimeError(f"SLURM submission failed: {common.b2s(err)}")
+
+        # Extract job ID from sbatch output
+        jobid = common.b2s(out).strip().split()[-1]
+
+        # Process each particle as soon as its task finishes
+        logger.info(f'Waiting for the tasks of SLURM job {jobid} to complete...')
+        for i, status in _wait_for_slurm_array(jobid, to_run, modeldir):
+            status, run_time = status or (None, None)
+            if status == 124:
+                # Exit status of timeout(1)
+                logger.warning(f"SLURM task {jobid}_{i} did not finish in {timeout:.0f} [s] and was killed")
+                diagnostics[i]['timed_out'] = True
+            elif status:
+                logger.error(f"SLURM task {jobid}_{i} failed with exit status {status}")
+            elif status == 0 and volume_fraction == 1:
+                record_run_time(opts, run_time)
+            process_output(i, status == 0)
+
+        try:
+            os.remove(batch_script)  # Clean up the batch script
+        except OSError:
+            pass
+
+    elif to_run:
+        # Use MPI implementation for small CPU requests, packing
+        # as many SAGE instances as fit onto the cores of this node
+        cores = _usable_cores()
+        ranks = opts.cpus
+        if not ranks:
+            nfiles = overrides['LastFile'] - overrides['FirstFile'] + 1 if overrides else _num_tree_files(opts.config)
+            ranks = _auto_ranks(nfiles, len(cores), len(to_run))
+        logger.info(f'Running {len(to_run)} SAGE instances with {ranks} ranks each on {len(cores)} cores')
+
+        commands = []
+        for i in to_run:
             # Create particle subdirectory
             particle_dir = os.path.join(modeldir, f"{i}/")
             os.makedirs(particle_dir, exist_ok=True)
-            
+
             # Create particle-specific parameter file
-            slash = len(opts.config) - opts.config[::-1].find('/') - 1
-            temp_filename = os.path.join(opts.outdir, f'{opts.config[slash+1:-4]}_{count}_{i}_temp.par')
-            
-            # Modify parameter file
-            with open(opts.config) as f:
-                lines = f.readlines()
-                
-            with open(temp_filename, 'w') as s:
-                Ndone = 0
-                for l, line in enumerate(lines):
-                    if line[:9] == 'OutputDir':
-                        lines[l] = f'OutputDir              {particle_dir}\n'
-                    for p, name in enumerate(space['name']):
-                        if line[:len(name)] == name:
-                            lines[l] = f'{name}          {str(round(particle[p],5))}\n'
-                            Ndone += 1
-                    if Ndone == len(space['name']):
-                        break
-                s.writelines(lines)
-
-            logger.info(f'Running SAGE instance: {temp_filename}')
-
-            # Launch SAGE with MPI for each particle
+            temp_filename = f'{param_prefix}_{i}_temp.par'
+            _write_particle_params(opts, space, particles[i], temp_filename, particle_dir, overrides)
+
+            # Launch SAGE with MPI for each particle. The ranks inherit the cores
+            # the instance is pinned to, which mpirun must not re-bind to its own
             cmdline = [
                 'mpirun',
-                '-np', str(opts.cpus),
+                '-np', str(ranks),
+                '--bind-to', 'none',
                 opts.sage_binary,
                 temp_filename
             ]
+            commands.append((i, cmdline, os.path.join(modeldir, f'{i}.log')))
 
-            # Launch process and store handle
-            process = subprocess.Popen(cmdline, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            processes.append((i, process, temp_filename, particle_dir))
-            
-        # Wait for all MPI processes to complete
-        for i, process, temp_filename, particle_dir in processes:
-            logger.info('Waiting for all SAGE instances to complete...')
-            out, err = process.communicate()
-            
-            if process.returncode != 0:
-                logger.error(f"SAGE instance {i} failed with return code {process.returncode}")
-                logger.error(f"stdout: {out.decode()}")
-                logger.error(f"stderr: {err.decode()}")
-                raise RuntimeError(f"SAGE instance {i} failed")
-
-    # Process results and clean up
-    for item in processes:
-        if use_slurm:
-            try:
-                i, jobid, temp_filename, particle_dir, batch_script = item
-            except ValueError:
-                # Handle case where we might not have batch_script
-                i, jobid, temp_filename, particle_dir = item
-                batch_script = None
-        else:
-            i, process, temp_filename, particle_dir = item
-            
-        # Process results with retries
-        max_retries = 1
-        retry_delay = 10
-        success = False
-        #logger.info("Processing everything, combining HDF5 files if needed, etc. etc. etc.")
-        
-        for retry in range(max_retries):
-            try:
-                total_score = sum(_evaluate(c, statTest, particle_dir, subvols) for c in opts.constraints)
-                fx[i] = total_score
-                success = True
-                break
-            except Exception as e:
-                logger.warning(f"Attempt {retry+1}: Error evaluating particle: {e}")
-                time.sleep(retry_delay)
-                
-        if not success:
-            logger.warning(f"Failed to process outputs for particle {i}  - assigning penalty score")
-            logger.warning("This usually means SAGE is unhappy, bad parameter combination")
-            fx[i] = 1e10
+        def finished(i, returncode, log, run_time):
+            if returncode is None:
+                logger.warning(f"SAGE instance {i} did not finish in {timeout:.0f} [s] and was killed")
+                diagnostics[i]['timed_out'] = True
+            elif returncode != 0:
+                with open(log) as f:
+                    output = f.read()
+                logger.error(f"SAGE instance {i} failed with return code {returncode}")
+                logger.error(f"output: {output}")
+            elif volume_fraction == 1:
+                record_run_time(opts, run_time)
+            process_output(i, returncode == 0)
 
-        # Clean up parameter file and batch script
-        try:
-            os.remove(temp_filename)
-            if use_slurm:
-                os.remove(batch_script)  # Clean up the batch script
-        except OSError:
-            pass
+        _run_packed(commands, ranks, cores, finished, timeout)
+
+    for i, particle in enumerate(particles):
+        if cached[i] is not None:
+            _restore_cached_dumps(opts, cached[i], particle)
+            logger.info(f"Particle {i} taken from the evaluation cache")
+
+    fx = np.full(len(particles), 1e10)
+    scored = [i for i in range(len(particles)) if evaluations[i] is not None]
+    if scored:
+        data = [tuple(np.stack([evaluations[i][_cache_label(c)][field] for i in scored]) for field in ('y_obs', 'y_mod', 'err'))
+                for c in opts.constraints]
+        _, fx[scored] = analysis.score_batch(opts.stat_test, data)
 
     # Clean up output directory if not keeping
-    if not opts.keep:
-        shutil.rmtree(modeldir)
+    _release_model_dir(opts, modeldir, opts.keep)
 
     logger.info('Particles %r evaluated to %r', particles, fx)
     count += 1
-    return fx
+    return fx, np.ones(len(particles), dtype=bool), diagnostics
 
 # this is the 'func' that is passed into the pso routine in pso.py
 # this doesn't require the new pso.py file, can just run on the original pyswarm function
@@ -289,11 +784,24 @@ def run_sage(particle, *args):
     
     # space is the thing containing the parameter values for the model
     opts, space, subvols, statTest = args
+
+    cached = load_cached_evaluation(opts, space, particle)
+    if cached is not None:
+        scores = _score_cached(opts, statTest, cached, particle)
+        total = 10**sum(np.log10(np.sum(score)*c.weight) for score, c in zip(scores, opts.constraints))
+        logger.info('Particle %r evaluated to %f (from the evaluation cache)', particle, total)
+        return total
     
+    return _multi_fidelity(_run_sage_binary, particle, args)
+
+def _run_sage_binary(particle, args, overrides, volume_fraction):
+    """Runs the SAGE binary for a particle, with overrides for the parameter file, and evaluates its output"""
+    opts, space, subvols, statTest = args
+
     # create/clear directory for temporary Dark Sage output
     spid = str(multiprocessing.current_process().pid)
 #    modeldir = '/Users/adam/DarkSage/autocalibration/DS_output_'+spid+'/'
-    modeldir = os.path.join(opts.outdir, 'DS_output_' + spid + '/')
+    modeldir = _model_dir(opts, 'DS_output_' + spid)
     if not os.path.exists(modeldir): os.makedirs(modeldir)
     if os.path.isfile(modeldir+'model_z0.000_0'): subprocess.call(['rm', modeldir+'model*'])
 
@@ -301,31 +809,141 @@ def run_sage(particle, *args):
     slash = len(opts.config) - opts.config[::-1].find('/') - 1
 #    temp_filename = '/Users/adam/DarkSage/autocalibration/' + opts.config[slash+1:-4] + '_' + spid + '_temp.par'
     temp_filename = os.path.join(opts.outdir, opts.config[slash+1:-4] + '_' + spid + '_temp.par')
-    #
-    f = open(opts.config).readlines()
-    s = open(temp_filename, 'w')
-    #
-    Np = len(space['name'])
-    Ndone = 0
-    for l, line in enumerate(f):
-        if line[:9] == 'OutputDir': f[l] = 'OutputDir              '+modeldir+'\n'
-        for p in range(Np):
-            if line[:len(space['name'][p])] == space['name'][p]: 
-                f[l] = space['name'][p]+'          '+str(round(particle[p],5))+'\n'
-                Ndone += 1
-        if Ndone==Np: break
-    #
-    s.writelines(f)
-    s.close()
+    _write_particle_params(opts, space, particle, temp_filename, modeldir, overrides)
 
     # currently assuming that serial in parallel here is the best
     print('Running SAGE instance', temp_filename)
 #    cmdline = ['mpirun', '-np', '8', opts.sage_binary, temp_filename]
     cmdline = [opts.sage_binary, temp_filename]
-    _exec_sage('Running SAGE instance', cmdline)
+    start = time.time()
+    try:
+        _exec_sage('Running SAGE instance', cmdline, run_time_limit(opts))
+    except SageTimeout as e:
+        logger.warning(f"{e} for particle {particle} - assigning penalty score")
+        _release_model_dir(opts, modeldir)
+        return 1e10
+    # Only full-volume runs tell how long a particle should take
+    if volume_fraction == 1:
+        record_run_time(opts, time.time() - start)
 
-    total = 10**sum(np.log10(np.sum(_evaluate(c, statTest, modeldir, subvols))*c.weight) for c in opts.constraints)
-    logger.info('Particle %r evaluated to %f', particle, total)
+    # The model output is read once and shared by all constraints
+    model = _model_data(opts, modeldir, volume_fraction)
+    evaluations = {}
+    total = 10**sum(np.log10(np.sum(_evaluate(c, statTest, model, subvols, evaluations))*c.weight) for c in opts.constraints)
+    save_plot_data(opts, particle, model)
+    save_dump_data(opts, particle, model)
+    if volume_fraction == 1:
+        save_cached_evaluation(opts, space, particle, evaluations, model)
+        logger.info('Particle %r evaluated to %f', particle, total)
+    else:
+        logger.info('Particle %r evaluated to %f on %.0f%% of the volume', particle, total, 100 * volume_fraction)
 
-    shutil.rmtree(modeldir)
+    _release_model_dir(opts, modeldir)
+    return total
+
+
+# In-process execution through the cffi bindings built by sage.build_sage_pyext.
+# The bindings are loaded once per process and then reused by every particle
+# evaluated in that process (i.e., by the long-lived pool workers)
+_sage_ffi = None
+_sage_lib = None
+
+def load_sage_lib(use_from_mcmc=False):
+    """Loads the SAGE cffi bindings, building them first if needed"""
+    global _sage_ffi, _sage_lib
+    if _sage_lib is not None:
+        return _sage_ffi, _sage_lib
+
+    sagedir = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+    if sagedir not in sys.path:
+        sys.path.insert(0, sagedir)
+    try:
+        from _sage_cffi import ffi, lib
+    except ImportError:
+        import sage
+        logger.info('Building the SAGE python extension in %s', sagedir)
+        sage.build_sage_pyext(use_from_mcmc=use_from_mcmc)
+        from _sage_cffi import ffi, lib
+
+    _sage_ffi, _sage_lib = ffi, lib
+    return ffi, lib
+
+_sage_params = {}
+
+def init_worker(opts):
+    """
+    Initializer for the pso.WorkerPool of a calibration: leaves each worker ready
+    to evaluate particles, with the observations of the constraints loaded and,
+    for in-process runs, SAGE and its base parameter file too. Trees cached by
+    --cache-trees then stay in the workers for as long as the pool lives
+    """
+    for c in opts.constraints:
+        c._get_obs_x_y_err()
+        c._get_sage_x_y()
+    if opts.in_process:
+        _get_sage_params(opts.config, opts.cache_trees)
+
+def _get_sage_params(config, cache_trees=False):
+    """Reads the base parameter file once per process, returning the sage.SageParams for it"""
+    if config not in _sage_params:
+        load_sage_lib()
+        import sage
+        _sage_params[config] = sage.SageParams(config, cache_forests=cache_trees)
+    return _sage_params[config]
+
+def run_sage_inprocess(particle, *args):
+    """Same as run_sage, but runs the model inside this process via the cffi bindings"""
+    opts, space, subvols, statTest = args
+
+    cached = load_cached_evaluation(opts, space, particle)
+    if cached is not None:
+        scores = _score_cached(opts, statTest, cached, particle)
+        total = 10**sum(np.log10(np.sum(score)*c.weight) for score, c in zip(scores, opts.constraints))
+        logger.info('Particle %r evaluated to %f (from the evaluation cache)', particle, total)
+        return total
+
+    return _multi_fidelity(_run_sage_inprocess, particle, args)
+
+def _run_sage_inprocess(particle, args, overrides, volume_fraction):
+    """Runs SAGE in this process for a particle, with overrides for the base parameter file, and evaluates its output"""
+    opts, space, subvols, statTest = args
+
+    spid = str(multiprocessing.current_process().pid)
+    modeldir = _model_dir(opts, 'DS_output_' + spid)
+    os.makedirs(modeldir, exist_ok=True)
+
+    # No temporary parameter file, the particle is passed as overrides
+    # of the base parameter file (which is only read once per process)
+    overrides = dict(overrides)
+    overrides.update({name: round(particle[p], 5) for p, name in enumerate(space['name'])})
+    overrides['OutputDir'] = modeldir
+    if opts.in_memory:
+        overrides['OutputFormat'] = 'sage_memory'
+
+    try:
+        logger.info('Running in-process SAGE instance with %r', overrides)
+        status = _get_sage_params(opts.config, opts.cache_trees).run(overrides)
+        if status != 0:
+            raise RuntimeError(f'SAGE failed with status {status}')
+        model = modeldir
+        if opts.in_memory:
+            # The constraints read the galaxies straight from memory, nothing was written to modeldir
+            import sage
+            model = sage.get_memory_output(opts.snapshot)
+        model = _model_data(opts, model, volume_fraction)
+        evaluations = {}
+        total = 10**sum(np.log10(np.sum(_evaluate(c, statTest, model, subvols, evaluations))*c.weight) for c in opts.constraints)
+        save_plot_data(opts, particle, model)
+        save_dump_data(opts, particle, model)
+        if volume_fraction == 1:
+            save_cached_evaluation(opts, space, particle, evaluations, model)
+    except Exception as e:
+        logger.warning(f"Failed to evaluate particle {particle} - assigning penalty score: {e}")
+        total = 1e10
+    if volume_fraction == 1:
+        logger.info('Particle %r evaluated to %f', particle, total)
+    else:
+        logger.info('Particle %r evaluated to %f on %.0f%% of the volume', particle, total, 100 * volume_fraction)
+
+    _release_model_dir(opts, modeldir)
     return total
@@ -1,11 +1,15 @@
 #!/bin/bash
 
 import argparse
+import atexit
+import contextlib
 import logging
 import math
 import multiprocessing
 import os
 import sys
+import shutil
+import tempfile
 import time
 
 def _abspath(p):
@@ -20,6 +24,7 @@ import constraints
 import execution
 import pso
 import glob
+import numpy as np # type: ignore
 import diagnostics
 
 
@@ -51,30 +56,7 @@ def setup_logging(outdir):
 def get_required_snapshots(constraints_str):
     """Get all unique snapshots needed for constraints"""
     # Map of constraint classes to their snapshots 
-    snapshot_map = {
-        'SMF_z0': [49],
-        'SMF_z02': [43],
-        'SMF_z05': [38],
-        'SMF_z08': [34],
-        'SMF_z10': [32], 
-        'SMF_z11': [31],
-        'SMF_z15': [27],
-        'SMF_z20': [23],
-        'SMF_z24': [20],
-        'SMF_z31': [16],
-        'SMF_z36': [14],
-        'SMF_z46': [11],
-        'SMF_z57': [9],
-        'SMF_z63': [8],
-        'SMF_z77': [6],
-        'SMF_z85': [5],
-        'SMF_z104': [3],
-        'BHMF_z0': [49],
-        'BHMF_z20': [23],
-        'BHBM_z0': [49],
-        'BHBM_z20': [23],
-        'HSMR_z0': [49]
-    }
+    snapshot_map = constraints.snapshot_map
     
     snapshots = set()
     print(f"Parsing constraints string: {constraints_str}")
@@ -93,15 +75,73 @@ def get_required_snapshots(constraints_str):
     print(f"Final snapshots list: {result}")
     return result
 
+def plot_best_particles(opts, tracksdir):
+    """Plots the constraints for the best particle of each iteration, under plots/track_<iteration>"""
+    for fx_file in sorted(glob.glob(os.path.join(tracksdir, 'track_*_fx.npy'))):
+        fx = common.load_track_fx(fx_file)
+        if np.all(np.isnan(fx)):
+            continue
+        pos = np.load(fx_file[:-len('_fx.npy')] + '_pos.npy')
+        best = pos[np.nanargmin(fx)]
+        plot_data = execution.load_plot_data(opts.outdir, best)
+        if plot_data is None:
+            logger.warning('No plot data for the best particle in %s', fx_file)
+            continue
+        plotdir = os.path.join(opts.outdir, 'plots', os.path.basename(fx_file)[:-len('_fx.npy')])
+        os.makedirs(plotdir, exist_ok=True)
+        for c in opts.constraints:
+            if c.__class__.__name__ in plot_data:
+                c.make_plots(plot_data[c.__class__.__name__], plotdir)
+
+    if not opts.keep:
+        shutil.rmtree(os.path.join(opts.outdir, 'plot_data'), ignore_errors=True)
+
+def load_tracks(tracksdirs):
+    """All the evaluated (position, value) pairs in the track files of the given directories"""
+    positions, values = [], []
+    for tracksdir in tracksdirs:
+        for pos_file in sorted(glob.glob(os.path.join(tracksdir, 'track_*_pos.npy'))):
+            fx_file = pos_file[:-len('_pos.npy')] + '_fx.npy'
+            fx = np.load(fx_file)
+            evaluated = ~common.load_track_screened(fx_file, len(fx))
+            positions.append(np.load(pos_file)[evaluated])
+            values.append(fx[evaluated])
+    if not positions:
+        return None
+    return np.concatenate(positions), np.concatenate(values)
+
+def rescore_tracks(opts, tracksdir, f, args):
+    """
+    Re-scores the particles of a previous PSO run (in tracksdir) with the current stat test,
+    saving track_<iteration>_fx_<stat test>.npy next to the original scores.
+    Particles in the evaluation cache are not run again, and those the surrogate screened out
+    (which were never evaluated) are not run at all and keep an infinite score
+    """
+    best = None
+    for pos_file in sorted(glob.glob(os.path.join(tracksdir, 'track_*_pos.npy'))):
+        pos = np.load(pos_file)
+        screened = common.load_track_screened(pos_file[:-len('_pos.npy')] + '_fx.npy', len(pos))
+        fx = np.full(len(pos), np.inf)
+        fx[~screened] = [f(particle, *args) for particle in pos[~screened]]
+        np.save(pos_file[:-len('_pos.npy')] + '_fx_' + opts.stat_test, fx)
+        if np.all(screened):
+            continue
+        if best is None or fx.min() < best[1]:
+            best = (pos[np.argmin(fx)], fx.min())
+    if best is None:
+        logger.error('No particles to re-score in %s', tracksdir)
+        return
+    logger.info('Best particle under %s: %r, fx = %r', opts.stat_test, best[0], best[1])
+
 def cleanup_files(opts):
     """Clean up dump files and track files after PSO run"""
     
     # Define patterns for files to delete
     patterns = {
-        'smf_dumps': os.path.join(opts.outdir, 'SMF_z*_dump.txt'),
-        'bhmf_dump': os.path.join(opts.outdir, 'BHMF_z*_dump.txt'),
-        'bhbm_dump': os.path.join(opts.outdir, 'BHBM_z*_dump.txt'),
-        'hsmr_dump': os.path.join(opts.outdir, 'HSMR_z*_dump.txt')
+        'smf_dumps': os.path.join(opts.outdir, 'SMF_z*_dump.npz'),
+        'bhmf_dump': os.path.join(opts.outdir, 'BHMF_z*_dump.npz'),
+        'bhbm_dump': os.path.join(opts.outdir, 'BHBM_z*_dump.npz'),
+        'hsmr_dump': os.path.join(opts.outdir, 'HSMR_z*_dump.npz')
     }
 
     # Delete dump files
@@ -113,6 +153,7 @@ def cleanup_files(opts):
                 print(f"Deleted {os.path.basename(file_path)}")
             except OSError as e:
                 print(f"Error deleting {os.path.basename(file_path)}: {e}")
+    shutil.rmtree(os.path.join(opts.outdir, 'dumps'), ignore_errors=True)
     """
     # Clean up tracks folder
     tracks_folder = os.path.join(opts.outdir, 'tracks')
@@ -160,6 +201,10 @@ def main():
     parser.add_argument('-o', '--outdir', help='Auxiliary output directory, defaults to .', default=_abspath('.'),
                         type=_abspath)
     parser.add_argument('-k', '--keep', help='Keep temporary output files', action='store_true')
+    parser.add_argument('--scratch', help=('Node-local directory (e.g. /dev/shm) where SAGE writes its output and the constraints read it, '
+                                           'instead of the output directory. With -k the output is copied to the output directory afterwards. '
+                                           'Not used for SLURM runs, which use JOBFS'),
+                        default=None, type=_abspath)
     parser.add_argument('-sn', '--snapshot', help='Comma-separated list of snapshot numbers to analyze', 
                    type=lambda x: [int(i) for i in x.split(',')], default=None)
     parser.add_argument('--sim', help='Simulation to use (0=miniUchuu, 1=miniMillennium, 2=MTNG)', 
@@ -183,19 +228,65 @@ def main():
                           default=10, type=int)
     pso_opts.add_argument('-S', '--space-file', help='File with the search space specification, defaults to space.txt',
                           default='space.txt', type=_abspath)
+    pso_opts.add_argument('--init', help=("How to choose the initial positions of the particles: 'random' (the default), "
+                                          "or spread evenly with a Sobol sequence ('sobol') or a Latin hypercube ('lhs'). "
+                                          "Parameters with is_log set in the space file are sampled log-uniformly"),
+                          default='random', choices=['random', 'sobol', 'lhs'])
+    pso_opts.add_argument('--reseed', help='Re-seed particles whose best position has not improved for this many iterations (not available with --async)',
+                          default=None, type=int)
+    pso_opts.add_argument('--surrogate', help=('Pre-screen the new positions of the particles at each iteration with a cheap model of the '
+                                               'previous evaluations, only running SAGE for the promising (or uncertain) ones (not available with --async)'),
+                          action='store_true')
+    pso_opts.add_argument('--surrogate-data', help='Comma-separated list of tracks directories of previous runs whose evaluations also train the --surrogate model',
+                          default=None, type=lambda x: [_abspath(d) for d in x.split(',')])
+    pso_opts.add_argument('--low-fidelity', help=('Multi-fidelity evaluation: run each particle first on this fraction of the tree files (e.g. 0.25), '
+                                                  'with the volume of the constraints scaled accordingly, and only re-run the promising ones on all of them (the others get an infinite score)'),
+                          default=None, type=float)
+    pso_opts.add_argument('--promote-quantile', help=('With --low-fidelity, re-run a particle on all tree files if its low-fidelity score is within this quantile '
+                                                      'of the low-fidelity scores so far, defaults to 0.25'),
+                          default=0.25, type=float)
     pso_opts.add_argument('-t', '--stat-test', help='Stat function used to calculate the value of a particle, defaults to student-t',
                           default='student-t', choices=list(analysis.stat_tests.keys()))
     pso_opts.add_argument('-x', '--constraints', default='BHMF,SMF_z0,BHBM',
                           help=("Comma-separated list of constraints, any of BHMF, SMF_z0 or BHBM, defaults to 'BHMF,SMF_z0,BHBM'. "
                                 "Can specify a domain range after the name (e.g., 'SMF_z0(8-11)')"
                                 "and/or a relative weight (e.g. 'BHMF*6,SMF_z0(8-11)*10)'"))
+    pso_opts.add_argument('-I', '--in-process', help='Run SAGE inside the PSO worker processes through the cffi bindings (see sage.py) instead of spawning the binary',
+                          action='store_true')
+    pso_opts.add_argument('--cache-trees', help='With -I, keep the merger trees in memory in each worker after their first model run instead of re-reading them for every particle',
+                          action='store_true')
+    pso_opts.add_argument('--in-memory', help='With -I, keep the galaxies SAGE produces in memory (OutputFormat sage_memory) instead of writing and re-reading hdf5 files',
+                          action='store_true')
+    pso_opts.add_argument('--async', dest='async_pso', help=("Asynchronous PSO: move and re-evaluate each particle as soon as its evaluation finishes "
+                                                             "instead of waiting for the whole swarm (not available with -H)"),
+                          action='store_true')
+    pso_opts.add_argument('--resume', help=("Resume a PSO run that stopped before finishing from the checkpoint in <outdir>/tracks, "
+                                            "continuing exactly as if it had not stopped (not available with --async)"),
+                          action='store_true')
+    pso_opts.add_argument('--timeout', help='Wall-clock limit (in seconds) for the SAGE run of each particle, which gets a penalty score if it takes longer. Not available with -I',
+                          default=None, type=float)
+    pso_opts.add_argument('--timeout-percentile', help=('Also limit each SAGE run to --timeout-factor times this percentile of the run times so far '
+                                                        '(once there are a few of them), e.g. 95'),
+                          default=None, type=float)
+    pso_opts.add_argument('--timeout-factor', help='See --timeout-percentile, defaults to 3', default=3., type=float)
+    pso_opts.add_argument('--plots', help=("When to plot the constraints: 'all' plots every particle as it is evaluated (the default), "
+                                           "'best' only plots the best particle of each iteration once the PSO finishes, 'none' doesn't plot"),
+                          default='all', choices=['all', 'best', 'none'])
+    pso_opts.add_argument('--eval-cache', help=("Directory with a persistent cache of the model data compared by the constraints for each particle, "
+                                                "used instead of re-running SAGE for particles evaluated before (in this or another run, "
+                                                "with any stat test). Defaults to no cache"),
+                          default=None, type=_abspath)
+    pso_opts.add_argument('--rescore', help=("Instead of running the PSO, re-score the particles of a previous run in <outdir>/tracks "
+                                             "with the stat test given by -t, taking them from the evaluation cache (see --eval-cache) where possible"),
+                          action='store_true')
     pso_opts.add_argument('-csv', '--csv-output', help='Path to save PSO results as CSV file. If not specified, no CSV will be generated.',
                       type=_abspath, default=None)
 
 ### currently Shark specific, can ignore unless on HPC
     hpc_opts = parser.add_argument_group('HPC options')
     hpc_opts.add_argument('-H', '--hpc-mode', help='Enable HPC mode', action='store_true')
-    hpc_opts.add_argument('-C', '--cpus', help='Number of CPUs per sage instance', default=1, type=int)
+    hpc_opts.add_argument('-C', '--cpus', help=('Number of CPUs per sage instance. Without SLURM (up to 4 CPUs) instances are packed onto the cores of the node, '
+                                                'and 0 chooses the number from the number of tree files and cores'), default=1, type=int)
     hpc_opts.add_argument('-M', '--memory', help='Memory needed by each sage instance', default='1500m')
     hpc_opts.add_argument('-N', '--nodes', help='Number of nodes to use', default=None, type=int)
     hpc_opts.add_argument('-a', '--account', help='Submit jobs using this account', default=None)
@@ -208,6 +299,28 @@ def main():
 
     if not opts.config:
         parser.error('-c option is mandatory but missing')
+    if opts.async_pso and opts.hpc_mode:
+        parser.error('--async cannot be used with -H, which evaluates whole swarms at once')
+    if opts.in_process and opts.hpc_mode:
+        parser.error('-I cannot be used with -H, which runs the SAGE binary under mpirun')
+    if (opts.in_memory or opts.cache_trees) and not opts.in_process:
+        parser.error('--in-memory and --cache-trees need -I')
+    if opts.in_process and (opts.timeout or opts.timeout_percentile):
+        parser.error('--timeout and --timeout-percentile cannot be used with -I, which runs SAGE inside the PSO workers')
+    if opts.rescore and (opts.resume or opts.hpc_mode):
+        parser.error('--rescore cannot be used with --resume or -H')
+    if opts.surrogate and opts.async_pso:
+        parser.error('--surrogate cannot be used with --async')
+    if opts.reseed and opts.async_pso:
+        parser.error('--reseed cannot be used with --async')
+    if opts.resume and opts.async_pso:
+        parser.error('--resume cannot be used with --async, which does not checkpoint its swarm')
+    if opts.low_fidelity is not None and not 0 < opts.low_fidelity <= 1:
+        parser.error('--low-fidelity must be a fraction between 0 and 1')
+    if opts.low_fidelity and opts.rescore:
+        parser.error('--low-fidelity cannot be used with --rescore')
+    if opts.low_fidelity and opts.cache_trees:
+        parser.error('--cache-trees cannot be used with --low-fidelity, which switches the tree files SAGE reads between runs')
 
     if opts.snapshot:
         snapshots = opts.snapshot
@@ -218,9 +331,14 @@ def main():
     # Create the output directory if it doesn't exist
     os.makedirs(opts.outdir, exist_ok=True)
 
+    # A directory of our own in the scratch space, which may be shared with other runs on the node
+    if opts.scratch:
+        opts.scratch = tempfile.mkdtemp(prefix='sage_pso_', dir=opts.scratch)
+        atexit.register(shutil.rmtree, opts.scratch, True)
+
     if opts.sage_binary and not common.has_program(opts.sage_binary):
         parser.error("SAGE binary '%s' not found, specify a correct one via -b" % opts.sage_binary)
-    elif not opts.sage_binary:
+    elif not opts.sage_binary and not opts.in_process:
         for candidate in ['sage', '../sage']:
             if not common.has_program(candidate):
                 continue
@@ -245,6 +363,13 @@ def main():
 #    for c in opts.constraints:
 #        c.redshift_table = redshift_table
 
+    # Load the observations once here, the constraints are then
+    # handed over to the workers with them already in place
+    for c in opts.constraints:
+        c.plot_mode = opts.plots
+        c._get_obs_x_y_err()
+        c._get_sage_x_y()
+
     # Read search space specification, which is a comma-separated multiline file,
     # each line containing the following elements:
     #
@@ -269,6 +394,13 @@ def main():
         print('seeing', n_cpus, 'CPUs')
         procs = min(n_cpus, ss)        
         f = execution.run_sage
+        if opts.in_process:
+            # Load (or build) the bindings once here, before the workers are
+            # forked, so that they inherit the already loaded library
+            execution.load_sage_lib()
+            f = execution.run_sage_inprocess
+    if opts.eval_cache:
+        opts.cache_version = execution.cache_version(opts)
 
 
 
@@ -285,6 +417,7 @@ def main():
     logger.info('    Omega0: %.4f', opts.Omega0)
     logger.info('    h0: %.4f', opts.h0)
     logger.info('    Keep temporary output files: %d', opts.keep)
+    logger.info('    Scratch directory: %s', opts.scratch if opts.scratch else 'Not used')
     logger.info('    Snapshot Number: %s', opts.snapshot)
     logger.info("PSO information:")
     logger.info('    Search space parameters: %s', ' '.join(space['name']))
@@ -293,10 +426,26 @@ def main():
     logger.info('    Lower bounds: %r', space['lb'])
     logger.info('    Upper bounds: %r', space['ub'])
     logger.info('    Test function: %s', opts.stat_test)
+    logger.info('    Initial positions: %s', opts.init)
+    logger.info('    Re-seed particles after: %s', f'{opts.reseed} iterations' if opts.reseed else 'Never')
+    logger.info('    Surrogate pre-screening: %d', opts.surrogate)
+    logger.info('    Low-fidelity fraction of tree files: %s', opts.low_fidelity if opts.low_fidelity else 'Not used')
+    if opts.low_fidelity:
+        logger.info('    Promotion quantile: %.2f', opts.promote_quantile)
+    logger.info('    Asynchronous: %d', opts.async_pso)
+    logger.info('    Resume: %d', opts.resume)
     logger.info('Constraints:')
     for c in opts.constraints:
         logger.info('    %s', c)
     logger.info('    CSV Output Path: %s', opts.csv_output if opts.csv_output else 'Not specified')
+    logger.info('    Plots: %s', opts.plots)
+    logger.info('    Evaluation cache: %s', opts.eval_cache if opts.eval_cache else 'Not used')
+    logger.info('    Timeout per particle: %s', f'{opts.timeout} [s]' if opts.timeout else 'None')
+    if opts.timeout_percentile:
+        logger.info('    Adaptive timeout: %.1f times the %.0fth percentile of run times', opts.timeout_factor, opts.timeout_percentile)
+    logger.info('In-process SAGE: %d', opts.in_process)
+    logger.info('    Cache merger trees: %d', opts.cache_trees)
+    logger.info('    Keep galaxies in memory: %d', opts.in_memory)
     logger.info('HPC mode: %d', opts.hpc_mode)
     if opts.hpc_mode:
         logger.info('    Account used to submit: %s', opts.account if opts.account else '')
@@ -325,14 +474,51 @@ def main():
     except OSError:
         pass
 
+    if opts.rescore:
+        logger.info('Re-scoring the particles in %s', tracksdir)
+        rescore_tracks(opts, tracksdir, f, args)
+        return
+
+    # Run times (and low-fidelity scores) of a previous calibration don't apply to this one,
+    # and neither do the particle data it saved for the dump files and plots
+    if not opts.resume:
+        for fname in ('sage_run_times.txt', 'low_fidelity_scores.txt'):
+            try:
+                os.remove(os.path.join(opts.outdir, fname))
+            except OSError:
+                pass
+        for dirname in ('dumps', 'plot_data'):
+            shutil.rmtree(os.path.join(opts.outdir, dirname), ignore_errors=True)
+
     # Go, go, go!
     logger.info('Starting PSO now')
     tStart = time.time()
     if opts.hpc_mode:
         os.chdir(os.path.join(opts.outdir, '../../autocalibration/'))
-    xopt, fopt = pso.pso(f, space['lb'], space['ub'], args=args, swarmsize=ss,
-                         maxiter=opts.max_iterations, processes=procs,
-                         dumpfile_prefix=os.path.join(tracksdir, 'track_%03d'),csv_output_path=opts.csv_output)
+    pso_kwargs = dict(init=opts.init, log_scale=space['is_log'].astype(bool))
+    if opts.hpc_mode:
+        pso_kwargs['evaluator'] = execution.evaluate_sage_hpc
+    if not opts.async_pso:
+        checkpoint_file = os.path.join(tracksdir, 'checkpoint.npz')
+        if opts.resume and not os.path.exists(checkpoint_file):
+            logger.error('Cannot resume, there is no checkpoint at %s', checkpoint_file)
+            return
+        pso_kwargs.update(checkpoint_file=checkpoint_file, resume=opts.resume, reseed_after=opts.reseed,
+                          surrogate=opts.surrogate)
+        if opts.surrogate and opts.surrogate_data:
+            pso_kwargs['surrogate_data'] = load_tracks(opts.surrogate_data)
+            if pso_kwargs['surrogate_data'] is not None:
+                logger.info('Training the surrogate model with %d previous evaluations', len(pso_kwargs['surrogate_data'][1]))
+    # Warm workers, which would be reused by any further pso call made with this pool
+    pool = None
+    if procs > 1 or opts.async_pso:
+        pool = pso.WorkerPool(procs, execution.init_worker, (opts,))
+    pso_func = pso.pso_async if opts.async_pso else pso.pso
+    with pool or contextlib.nullcontext():
+        xopt, fopt = pso_func(f, space['lb'], space['ub'], args=args, swarmsize=ss,
+                             maxiter=opts.max_iterations, processes=procs,
+                             dumpfile_prefix=os.path.join(tracksdir, 'track_%03d'),csv_output_path=opts.csv_output,
+                             pool=pool, **pso_kwargs)
     tEnd = time.time()
 
     global count
@@ -340,14 +526,19 @@ def main():
     logger.info('xopt = %r', xopt)
     logger.info('fopt = %r', fopt)
     logger.info('PSO finished in %.3f [s]', tEnd - tStart)
+    execution.collect_dumps(opts.outdir, tracksdir, [c.__class__.__name__ for c in opts.constraints])
     logger.info('Checking for SMF, BHBM and BHMF dump files...')
-    dump_files = glob.glob(os.path.join(opts.outdir, 'SMF_z*_dump.txt'))
+    dump_files = glob.glob(os.path.join(opts.outdir, 'SMF_z*_dump.npz'))
     logger.info('Found SMF dump files: %s', dump_files)
-    dump_files2 = glob.glob(os.path.join(opts.outdir, 'BHMF_z*_dump.txt'))
+    dump_files2 = glob.glob(os.path.join(opts.outdir, 'BHMF_z*_dump.npz'))
     logger.info('Found BHMF dump files: %s', dump_files2)
-    dump_files3 = glob.glob(os.path.join(opts.outdir, 'BHBM_z*_dump.txt'))
+    dump_files3 = glob.glob(os.path.join(opts.outdir, 'BHBM_z*_dump.npz'))
     logger.info('Found BHBM dump files: %s', dump_files3)
 
+    if opts.plots == 'best':
+        logger.info('Plotting the best particle of each iteration...')
+        plot_best_particles(opts, tracksdir)
+
     logger.info('Running diagnostics...')
     diagnostics.main(
         tracks_dir=os.path.join(opts.outdir, 'tracks'),
@@ -1,7 +1,12 @@
+import glob
+import os
+
 import numpy as np
-from pso import pso
+from pso import pso, pso_async
 import time
 
+import analysis
+
 def test_pso_reproducibility(n_runs=3):
     """
     Test if PSO gives consistent results across multiple runs
@@ -72,6 +77,89 @@ def test_pso_reproducibility(n_runs=3):
     
     return all_identical, results
 
+def sphere(x):
+    return np.sum(x**2)
+
+def _load_csv(csv_path):
+    """The particle rows, best position and best fitness of a PSO CSV output file"""
+    with open(csv_path) as f:
+        blocks = f.read().strip().split('\n\n')
+    rows = np.array([[float(v) for v in line.split('\t')] for line in blocks[0].splitlines()])
+    best_position, best_fitness = blocks[1].splitlines()
+    return rows, np.array(best_position.split('\t'), dtype=float), float(best_fitness)
+
+def _load_dumps(tracks_dir):
+    """The positions and values of every dumped iteration"""
+    pos = [np.load(f) for f in sorted(glob.glob(os.path.join(tracks_dir, 'track_*_pos.npy')))]
+    fx = [np.load(f) for f in sorted(glob.glob(os.path.join(tracks_dir, 'track_*_fx.npy')))]
+    return np.array(pos), np.array(fx)
+
+def test_pso_resume(tmp_path):
+    """A run resumed from its checkpoint continues exactly as an uninterrupted one"""
+    kwargs = dict(swarmsize=10, minstep=-1, minfunc=-1, debug=False, particle_output=True)
+    lb, ub = [-5.0] * 4, [5.0] * 4
+    for name in ('full', 'resumed'):
+        os.makedirs(tmp_path / name)
+
+    np.random.seed(42)
+    full = pso(sphere, lb, ub, maxiter=12, dumpfile_prefix=str(tmp_path / 'full' / 'track_%03d'),
+               csv_output_path=str(tmp_path / 'full.csv'), **kwargs)
+
+    checkpoint = str(tmp_path / 'checkpoint.npz')
+    np.random.seed(42)
+    pso(sphere, lb, ub, maxiter=6, checkpoint_file=checkpoint,
+        dumpfile_prefix=str(tmp_path / 'resumed' / 'track_%03d'), **kwargs)
+    np.random.seed(0)  # the checkpoint brings back the random state as well
+    resumed = pso(sphere, lb, ub, maxiter=12, checkpoint_file=checkpoint, resume=True,
+                  dumpfile_prefix=str(tmp_path / 'resumed' / 'track_%03d'),
+                  csv_output_path=str(tmp_path / 'resumed.csv'), **kwargs)
+
+    for a, b in zip(full, resumed):
+        assert np.array_equal(a, b)
+    for a, b in zip(_load_dumps(tmp_path / 'full'), _load_dumps(tmp_path / 'resumed')):
+        assert np.array_equal(a, b)
+    with open(tmp_path / 'full.csv') as f1, open(tmp_path / 'resumed.csv') as f2:
+        assert f1.read() == f2.read()
+
+def test_pso_async_dumps_and_csv(tmp_path):
+    """pso_async dumps every iteration and writes them all (but the initial one) to the CSV, like pso"""
+    swarmsize, maxiter = 6, 5
+    g, fg, p, fp = pso_async(sphere, [-5.0] * 3, [5.0] * 3, swarmsize=swarmsize, maxiter=maxiter,
+                             minstep=-1, minfunc=-1, debug=False, particle_output=True,
+                             dumpfile_prefix=str(tmp_path / 'track_%03d'),
+                             csv_output_path=str(tmp_path / 'pso.csv'))
+
+    pos, fx = _load_dumps(tmp_path)
+    assert pos.shape == (maxiter, swarmsize, 3) and fx.shape == (maxiter, swarmsize)
+    assert np.allclose(fx, np.sum(pos**2, axis=-1))
+
+    rows, best_position, best_fitness = _load_csv(tmp_path / 'pso.csv')
+    assert np.array_equal(rows[:, :-1], pos[1:].reshape(-1, 3))
+    assert np.array_equal(rows[:, -1], fx[1:].reshape(-1))
+    assert best_fitness == fg == fx.min()
+    assert np.array_equal(best_position, g)
+
+def test_studentT_batch():
+    """Batch Student-t (and chi2) scores match the single-particle ones, row by row"""
+    rng = np.random.default_rng(1)
+    obs = rng.normal(size=8)
+    # The first particle is closer to the observations than their errors, which gives nu < 0 (and NaN)
+    mod = obs + rng.normal(scale=[[0.1], [3.0], [10.0], [30.0]], size=(4, 8))
+    err = rng.uniform(0.5, 2.0, size=(4, 8))
+    err[0, 3] = 0  # replaced by the scatter of the observations
+
+    batch = analysis.studentT_batch(obs, mod, err)
+    assert batch.shape == (4,)
+    assert np.all(np.isfinite(batch[1:]))
+    for i in range(4):
+        assert np.array_equal(batch[i], analysis.studentT(obs, mod[i], err[i]), equal_nan=True)
+        assert np.array_equal(batch[i], analysis.studentT_batch(np.tile(obs, (4, 1)), mod, err)[i], equal_nan=True)
+        assert np.isclose(analysis.chi2_batch(obs, mod, err)[i], analysis.chi2(obs, mod[i], err[i]))
+
+    scores, total = analysis.score_batch('student-t', [(obs, mod, err), (obs, mod, err)])
+    assert scores.shape == (4, 2)
+    assert np.array_equal(total, 2 * batch, equal_nan=True)
+
 if __name__ == "__main__":
     success, results = test_pso_reproducibility(n_runs=3)
     
@@ -0,0 +1,136 @@
+import os
+import stat
+import time
+import types
+
+import common
+import execution
+
+JOBID = '4242'
+
+# sbatch runs every task of the array right away, except those listed in FAKE_SLURM_SKIP
+SBATCH = """#!/bin/bash
+indices=$(sed -n 's/^#SBATCH --array=//p' "$1" | tr ',' ' ')
+for i in $indices; do
+    case " $FAKE_SLURM_SKIP " in *" $i "*) continue;; esac
+    SLURM_ARRAY_TASK_ID=$i bash "$1" > /dev/null 2>&1
+done
+echo "Submitted batch job %s"
+"""
+
+# sacct reports whatever is in sacct.txt, and isn't available if there is no such file
+SACCT = """#!/bin/bash
+[ -f "$FAKE_SLURM_DIR/sacct.txt" ] || exit 1
+cat "$FAKE_SLURM_DIR/sacct.txt"
+"""
+
+# squeue lists the job while queued.txt exists
+SQUEUE = """#!/bin/bash
+[ -f "$FAKE_SLURM_DIR/queued.txt" ] && echo %s
+exit 0
+"""
+
+# A SAGE that writes a model file into its OutputDir, and fails for parameter files saying so
+SAGE = """#!/bin/bash
+grep -q '^Fail' "$1" && exit 1
+outdir=$(sed -n 's/^OutputDir *//p' "$1")
+echo model > "$outdir/model_0.hdf5"
+"""
+
+MPIRUN = """#!/bin/bash
+shift 2
+exec "$@"
+"""
+
+def _write_script(path, contents):
+    with open(path, 'w') as f:
+        f.write(contents)
+    os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR)
+
+def _fake_slurm(tmp_path, monkeypatch, skip=()):
+    """Puts fake SLURM commands (and mpirun, ml and SAGE) on the PATH"""
+    bindir = tmp_path / 'bin'
+    bindir.mkdir()
+    _write_script(bindir / 'sbatch', SBATCH % JOBID)
+    _write_script(bindir / 'sacct', SACCT)
+    _write_script(bindir / 'squeue', SQUEUE % JOBID)
+    _write_script(bindir / 'mpirun', MPIRUN)
+    _write_script(bindir / 'ml', '#!/bin/bash\n')
+    _write_script(bindir / 'sage', SAGE)
+    monkeypatch.setenv('PATH', f"{bindir}{os.pathsep}{os.environ['PATH']}")
+    monkeypatch.setenv('FAKE_SLURM_DIR', str(tmp_path))
+    monkeypatch.setenv('FAKE_SLURM_SKIP', ' '.join(str(i) for i in skip))
+    monkeypatch.setattr(execution, 'SLURM_POLL_INTERVAL', 0.05)
+    monkeypatch.setattr(execution, 'SLURM_STATUS_GRACE', 0.2)
+    return bindir
+
+def _submit(tmp_path, bindir, indices, failing=()):
+    """Writes the array script and parameter files for indices, submits it and returns its modeldir"""
+    opts = types.SimpleNamespace(cpus=2, memory='1G', walltime=None, account=None, queue=None,
+                                 sage_binary=str(bindir / 'sage'))
+    modeldir = f'{tmp_path}/DS_output_0/'
+    for i in indices:
+        os.makedirs(f'{modeldir}{i}/')
+        with open(f'{tmp_path}/params_{i}_temp.par', 'w') as f:
+            f.write(f'OutputDir {tmp_path}/work_{i}\n')
+            if i in failing:
+                f.write('Fail 1\n')
+    batch_script = str(tmp_path / 'array.slurm')
+    execution._write_slurm_array_script(opts, batch_script, 'test', indices, f'{tmp_path}/params',
+                                        f'{tmp_path}/work', modeldir, timeout=60)
+    out, err, code = common.exec_command(['sbatch', batch_script])
+    assert code == 0
+    assert common.b2s(out).split()[-1] == JOBID
+    return modeldir
+
+def test_slurm_array_success_and_failure(tmp_path, monkeypatch):
+    bindir = _fake_slurm(tmp_path, monkeypatch)
+    modeldir = _submit(tmp_path, bindir, [0, 3], failing=[3])
+
+    results = dict(execution._wait_for_slurm_array(JOBID, [0, 3], modeldir))
+    assert results[0][0] == 0
+    assert results[3][0] == 1
+    assert os.path.exists(f'{modeldir}0/model_0.hdf5')
+    assert not os.listdir(f'{modeldir}3/')
+
+def test_slurm_task_states(tmp_path, monkeypatch):
+    _fake_slurm(tmp_path, monkeypatch)
+    assert execution._slurm_task_states(JOBID) is None
+    (tmp_path / 'sacct.txt').write_text(f'{JOBID}_0|COMPLETED\n{JOBID}_1|CANCELLED by 123\n{JOBID}_[2-4]|PENDING\n')
+    assert execution._slurm_task_states(JOBID) == {0: 'COMPLETED', 1: 'CANCELLED'}
+
+def test_slurm_missing_status_after_grace(tmp_path, monkeypatch):
+    bindir = _fake_slurm(tmp_path, monkeypatch, skip=[1])
+    modeldir = _submit(tmp_path, bindir, [0, 1])
+    (tmp_path / 'sacct.txt').write_text(f'{JOBID}_0|COMPLETED\n{JOBID}_1|FAILED\n')
+
+    start = time.time()
+    results = list(execution._wait_for_slurm_array(JOBID, [0, 1], modeldir))
+    assert results[0][0] == 0 and results[0][1][0] == 0
+    assert results[1] == (1, None)
+    assert time.time() - start >= execution.SLURM_STATUS_GRACE
+
+def test_slurm_missing_status_without_sacct(tmp_path, monkeypatch):
+    bindir = _fake_slurm(tmp_path, monkeypatch, skip=[0])
+    modeldir = _submit(tmp_path, bindir, [0])
+    assert list(execution._wait_for_slurm_array(JOBID, [0], modeldir)) == [(0, None)]
+
+def test_slurm_task_still_queued(tmp_path, monkeypatch):
+    bindir = _fake_slurm(tmp_path, monkeypatch, skip=[2])
+    modeldir = _submit(tmp_path, bindir, [2])
+    (tmp_path / 'sacct.txt').write_text(f'{JOBID}_[2]|PENDING\n')
+
+    # The task stays queued for longer than the grace period, and then runs
+    polls = []
+    sleep = time.sleep
+    def poll(seconds):
+        polls.append(seconds)
+        sleep(seconds)
+        if len(polls) == 10:
+            (tmp_path / 'sacct.txt').write_text(f'{JOBID}_2|COMPLETED\n')
+            with open(f'{modeldir}2.status', 'w') as f:
+                f.write('0 12\n')
+    monkeypatch.setattr(execution.time, 'sleep', poll)
+
+    assert list(execution._wait_for_slurm_array(JOBID, [2], modeldir)) == [(2, (0, 12.0))]
+    assert sum(polls) > execution.SLURM_STATUS_GRACE
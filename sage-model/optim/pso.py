@@ -9,6 +9,10 @@ import os
 import logging
 import time
 import threading
+import warnings
+
+
+logger = logging.getLogger(__name__)
 
 def _write_results_to_csv(csv_path, iteration_history, final_positions, particle_fitness, best_position, best_fitness, max_retries=3):
     """
@@ -19,7 +23,8 @@ def _write_results_to_csv(csv_path, iteration_history, final_positions, particle
     csv_path : str
         Path to save the CSV file
     iteration_history : list of tuples
-        List containing (iteration, positions, fitness) for each iteration
+        List containing (iteration, positions, fitness, screened) for each iteration;
+        particles screened out by the surrogate were never evaluated and are not written
     final_positions : array
         Final positions of all particles
     particle_fitness : array
@@ -32,11 +37,6 @@ def _write_results_to_csv(csv_path, iteration_history, final_positions, particle
         Maximum number of retry attempts for writing CSV
     """
     
-    # Logging setup
-    logging.basicConfig(level=logging.INFO,
-                       format='%(asctime)s - %(levelname)s - %(message)s',
-                       filename='pso_csv_log.txt')
-    
     # Thread-safe lock
     csv_write_lock = threading.Lock()
     
@@ -46,7 +46,7 @@ def _write_results_to_csv(csv_path, iteration_history, final_positions, particle
                 # Check directory permissions
                 directory = os.path.dirname(csv_path)
                 if not os.access(directory, os.W_OK):
-                    logging.error(f"No write permissions for directory: {directory}")
+                    logger.error(f"No write permissions for directory: {directory}")
                     return
                 
                 # Ensure directory exists
@@ -57,8 +57,8 @@ def _write_results_to_csv(csv_path, iteration_history, final_positions, particle
                     csvwriter = csv.writer(csvfile, delimiter='\t')
                     
                     # Write iteration history
-                    for it, positions, fitness in iteration_history:
-                        for particle_idx in range(len(positions)):
+                    for it, positions, fitness, screened in iteration_history:
+                        for particle_idx in np.flatnonzero(~screened):
                             row = list(positions[particle_idx])
                             row.append(fitness[particle_idx])
                             csvwriter.writerow(row)
@@ -69,14 +69,14 @@ def _write_results_to_csv(csv_path, iteration_history, final_positions, particle
                     csvwriter.writerow(list(best_position))  # Second to last row: best position
                     csvwriter.writerow([best_fitness])       # Last row: best fitness score
                 
-                logging.info(f"CSV successfully written to {csv_path}")
+                logger.info(f"CSV successfully written to {csv_path}")
                 return
                 
             except Exception as e:
-                logging.error(f"Attempt {attempt + 1} failed: {e}", exc_info=True)
+                logger.error(f"Attempt {attempt + 1} failed: {e}", exc_info=True)
                 time.sleep(0.1)  # Small delay between attempts
         
-        logging.error(f"Failed to write CSV after {max_retries} attempts")
+        logger.error(f"Failed to write CSV after {max_retries} attempts")
 
 def _obj_wrapper(func, args, kwargs, x):
     return func(x, *args, **kwargs)
@@ -92,11 +92,238 @@ def _cons_ieqcons_wrapper(ieqcons, args, kwargs, x):
 
 def _cons_f_ieqcons_wrapper(f_ieqcons, args, kwargs, x):
     return np.array(f_ieqcons(x, *args, **kwargs))
+
+def _evaluate_particle(obj, is_feasible, x):
+    start = time.time()
+    fx = obj(x)
+    fs = is_feasible(x)
+    return fx, fs, {'eval_time': time.time() - start}
+
+def _evaluator_wrapper(evaluator, args, kwargs, x):
+    fx, fs, diagnostics = evaluator(x, *args, **kwargs)
+    return np.asarray(fx, dtype=float), np.asarray(fs, dtype=bool), list(diagnostics)
+
+def evaluate_swarm(x, obj, is_feasible, processes=1, mp_pool=None, evaluator=None):
+    """
+    Evaluates the objective and feasibility of all particles in x in a single
+    dispatch, returning (fx, fs, diagnostics), with diagnostics a list of dicts
+    (one per particle).
+
+    With processes > 1 each particle goes once through mp_pool, with
+    processes = 0 obj receives the whole swarm (or evaluator is used instead,
+    if given), otherwise particles are evaluated one after the other here.
+    """
+    if evaluator is not None:
+        return evaluator(x)
+    if processes == 0:
+        start = time.time()
+        fx = np.asarray(obj(x), dtype=float)
+        fs = np.array([is_feasible(xi) for xi in x], dtype=bool)
+        eval_time = time.time() - start
+        return fx, fs, [{'eval_time': eval_time} for _ in range(len(x))]
+    evaluate = partial(_evaluate_particle, obj, is_feasible)
+    if processes > 1:
+        results = mp_pool.map(evaluate, x)
+    else:
+        results = [evaluate(xi) for xi in x]
+    fx, fs, diagnostics = zip(*results)
+    return np.array(fx, dtype=float), np.array(fs, dtype=bool), list(diagnostics)
+
+class WorkerPool(object):
+    """
+    A pool of worker processes that outlives a single pso/pso_async call.
+
+    Creating the workers (and warming them up via initializer, which runs once
+    in each of them) then happens only once, and whatever they keep in memory
+    between evaluations stays there for all the iterations and all the pso
+    runs that use the pool. Use it as a context manager, or close it when done.
+    """
+
+    def __init__(self, processes, initializer=None, initargs=()):
+        import multiprocessing
+        self.processes = processes
+        self._pool = multiprocessing.Pool(processes, initializer, initargs)
+
+    def map(self, func, iterable):
+        return self._pool.map(func, iterable)
+
+    def apply_async(self, func, args=(), callback=None, error_callback=None):
+        return self._pool.apply_async(func, args, callback=callback, error_callback=error_callback)
+
+    def terminate(self):
+        self._pool.terminate()
+        self._pool.join()
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.terminate()
+
+def _scale_positions(u, lb, ub, log_scale=None):
+    """Maps u in [0, 1) to positions within the bounds, log-uniformly along the log_scale dimensions"""
+    x = lb + u*(ub - lb)
+    if log_scale is not None and np.any(log_scale):
+        x[:, log_scale] = np.exp(np.log(lb[log_scale]) + u[:, log_scale]*np.log(ub[log_scale]/lb[log_scale]))
+    return x
+
+def _initial_positions(S, lb, ub, init='random', log_scale=None):
+    """
+    S positions within the bounds, either uniformly random ('random') or spread
+    more evenly with a scrambled Sobol sequence ('sobol') or a Latin hypercube ('lhs')
+    """
+    D = len(lb)
+    if init == 'random':
+        u = np.random.rand(S, D)
+    else:
+        from scipy.stats import qmc # type: ignore
+        seed = np.random.randint(2**31)
+        if init == 'sobol':
+            with warnings.catch_warnings():
+                # Sobol points are best balanced in powers of 2, but still better than random otherwise
+                warnings.simplefilter('ignore', UserWarning)
+                u = qmc.Sobol(D, seed=seed).random(S)
+        elif init == 'lhs':
+            u = qmc.LatinHypercube(D, seed=seed).random(S)
+        else:
+            raise ValueError(f'Unknown swarm initialisation: {init}')
+    return _scale_positions(u, lb, ub, log_scale)
+
+class Surrogate(object):
+    """
+    A cheap model of the objective function (a radial basis function interpolant
+    of all the positions evaluated so far) used to pre-screen candidate positions:
+    only those predicted to improve on their particle's best position, or too far
+    from any evaluated position for the prediction to be trusted, are evaluated.
+    Until there are min_points evaluations every candidate is.
+    """
+
+    def __init__(self, lb, ub, x=None, f=None, min_points=None):
+        self.lb = np.asarray(lb, dtype=float)
+        self.scale = np.asarray(ub, dtype=float) - self.lb
+        self.min_points = min_points if min_points else 5*len(self.lb)
+        self.x = np.zeros((0, len(self.lb)))
+        self.f = np.zeros(0)
+        if x is not None:
+            self.add(x, f)
+
+    @staticmethod
+    def _compress(f):
+        # Monotonic, so comparisons are preserved, but keeps penalty scores from dominating the fit
+        return np.sign(f)*np.log10(1 + np.abs(f))
+
+    def add(self, x, f):
+        """Adds evaluated positions (non-finite values are ignored)"""
+        x = np.asarray(x, dtype=float).reshape(-1, len(self.lb))
+        f = np.asarray(f, dtype=float).reshape(-1)
+        ok = np.isfinite(f)
+        self.x = np.concatenate([self.x, x[ok]])
+        self.f = np.concatenate([self.f, f[ok]])
+
+    def screen(self, x, fp):
+        """Which of the candidate positions x are worth evaluating, given their particles' best values fp"""
+        if len(self.x) < self.min_points:
+            return np.ones(len(x), dtype=bool)
+        from scipy.interpolate import RBFInterpolator # type: ignore
+        from scipy.spatial import cKDTree # type: ignore
+
+        # Fit in the unit hypercube, averaging repeated positions
+        u, inverse = np.unique((self.x - self.lb)/self.scale, axis=0, return_inverse=True)
+        f = np.bincount(inverse.ravel(), self._compress(self.f))/np.bincount(inverse.ravel())
+        if len(u) < self.min_points:
+            return np.ones(len(x), dtype=bool)
+        model = RBFInterpolator(u, f, kernel='thin_plate_spline', smoothing=1e-8)
+        candidates = (x - self.lb)/self.scale
+        predicted = model(candidates)
+
+        # Predictions far from the data (compared to its typical spacing) are not trusted
+        tree = cKDTree(u)
+        spacing = np.median(tree.query(u, k=2)[0][:, 1])
+        distance = tree.query(candidates)[0]
+
+        promising = predicted < self._compress(fp)
+        evaluate = promising | (distance > 3*spacing)
+        if not np.any(evaluate):
+            evaluate[np.argmin(predicted - self._compress(fp))] = True
+        return evaluate
+
+def _save_checkpoint(fname, it, x, v, p, fp, g, fg, p_min, fp_min, iteration_history, stall=None, surrogate=None):
+    if not fname:
+        return
+    _, rng_keys, rng_pos, rng_has_gauss, rng_cached_gaussian = np.random.get_state()
+    S, D = x.shape
+    n = len(iteration_history)
+    hist_it = np.array([h[0] for h in iteration_history], dtype=int)
+    hist_x = np.array([h[1] for h in iteration_history]).reshape(n, S, D)
+    hist_fx = np.array([h[2] for h in iteration_history]).reshape(n, S)
+    hist_screened = np.array([h[3] for h in iteration_history], dtype=bool).reshape(n, S)
+    # Write and rename, so there is always a complete checkpoint
+    tmp_fname = fname + '.tmp'
+    with open(tmp_fname, 'wb') as f:
+        np.savez(f, it=it, x=x, v=v, p=p, fp=fp, g=g, fg=fg, p_min=p_min, fp_min=fp_min,
+                 hist_it=hist_it, hist_x=hist_x, hist_fx=hist_fx, hist_screened=hist_screened,
+                 rng_keys=rng_keys, rng_pos=rng_pos, rng_has_gauss=rng_has_gauss,
+                 rng_cached_gaussian=rng_cached_gaussian,
+                 stall=stall if stall is not None else np.zeros(S, dtype=int),
+                 surrogate_x=surrogate.x if surrogate is not None else np.zeros((0, D)),
+                 surrogate_f=surrogate.f if surrogate is not None else np.zeros(0))
+    os.replace(tmp_fname, fname)
+
+def _load_checkpoint(fname):
+    with np.load(fname) as c:
+        state = {key: c[key] for key in c.files}
+    np.random.set_state(('MT19937', state['rng_keys'], int(state['rng_pos']),
+                         int(state['rng_has_gauss']), float(state['rng_cached_gaussian'])))
+    hist_screened = state.get('hist_screened', np.zeros(state['hist_fx'].shape, dtype=bool))
+    iteration_history = [(int(it), x, fx, screened) for it, x, fx, screened in
+                         zip(state['hist_it'], state['hist_x'], state['hist_fx'], hist_screened)]
+    stall = state.get('stall', np.zeros(len(state['x']), dtype=int))
+    surrogate_data = (state.get('surrogate_x', np.zeros((0, state['x'].shape[1]))), state.get('surrogate_f', np.zeros(0)))
+    return (state['x'], state['v'], state['p'], state['fp'], state['g'], state['fg'][()],
+            state['p_min'], state['fp_min'][()], int(state['it']), iteration_history, stall, surrogate_data)
+
+def _dump_function(dumpfile_prefix):
+    if dumpfile_prefix:
+        def dump(i, x, fx, screened=None):
+            np.save(dumpfile_prefix % i + "_fx", fx)
+            np.save(dumpfile_prefix % i + "_pos", x)
+            # Particles the surrogate screened out were not evaluated, their fx is just a placeholder
+            if screened is not None:
+                np.save(dumpfile_prefix % i + "_screened", screened)
+    else:
+        dump = lambda *_: None
+    return dump
+
+def _feasibility_function(ieqcons, f_ieqcons, args, kwargs, debug):
+    if f_ieqcons is None:
+        if not len(ieqcons):
+            if debug:
+                print('No constraints given.')
+            cons = _cons_none_wrapper
+        else:
+            if debug:
+                print('Converting ieqcons to a single constraint function')
+            cons = partial(_cons_ieqcons_wrapper, ieqcons, args, kwargs)
+    else:
+        if debug:
+            print('Single constraint function given in f_ieqcons')
+        cons = partial(_cons_f_ieqcons_wrapper, f_ieqcons, args, kwargs)
+    return partial(_is_feasible_wrapper, cons)
     
 def pso(func, lb, ub, ieqcons=[], f_ieqcons=None, args=(), kwargs={}, 
         swarmsize=100, omega=0.5, phip=0.7, phig=0.3, maxiter=100, 
         minstep=1e-3, minfunc=1e-3, debug=True, processes=1,
-        particle_output=False, dumpfile_prefix=None, csv_output_path=None):
+        particle_output=False, dumpfile_prefix=None, csv_output_path=None,
+        checkpoint_file=None, resume=False, evaluator=None, pool=None,
+        init='random', log_scale=None, reseed_after=None,
+        surrogate=False, surrogate_data=None, surrogate_min_points=None):
     """
     Perform a particle swarm optimization (PSO)
    
@@ -155,6 +382,47 @@ def pso(func, lb, ub, ieqcons=[], f_ieqcons=None, args=(), kwargs={},
     csv_output_path : str, optional
         Path to save CSV file with best positions and their objective values
         (Default: None)
+    checkpoint_file : str, optional
+        File where the whole state of the swarm (including that of the random
+        number generator) is saved after every iteration (Default: None)
+    resume : boolean
+        Continue the run saved in checkpoint_file instead of starting a new
+        swarm. The run then carries on exactly as if it had never stopped
+        (Default: False)
+    evaluator : function, optional
+        Vectorized evaluator used with processes = 0 instead of func and the
+        constraints. Called as evaluator(x, *args, **kwargs) with the positions
+        of the whole swarm, it must return (fx, fs, diagnostics): the objective
+        value and feasibility of each particle, and a dict per particle with
+        any other information about its evaluation (Default: None)
+    pool : WorkerPool, optional
+        Pool used when processes > 1, which is left open for other runs.
+        If not given, a pool of processes workers is created and closed
+        for this run only (Default: None)
+    init : str
+        How the initial positions are chosen: uniformly at random ('random'),
+        or spread more evenly over the search space with a scrambled Sobol
+        sequence ('sobol') or a Latin hypercube ('lhs') (Default: 'random')
+    log_scale : array, optional
+        Booleans saying which dimensions are sampled log-uniformly (when
+        initialising or re-seeding particles). Their bounds must be positive
+        (Default: None)
+    reseed_after : int, optional
+        Particles whose best position hasn't improved for this many
+        iterations are re-seeded at a random position within the bounds,
+        except the one holding the swarm's best position (Default: None)
+    surrogate : boolean
+        Pre-screen the candidate positions of each iteration with a Surrogate
+        model of func, trained on every position evaluated so far. Positions
+        that are not evaluated are left out of the CSV output, and flagged in
+        the <dumpfile_prefix>_screened.npy dump of their iteration, their
+        objective value being a placeholder inf (Default: False)
+    surrogate_data : tuple, optional
+        (positions, values) evaluated before (e.g., in previous runs) to also
+        train the surrogate model with (Default: None)
+    surrogate_min_points : int, optional
+        Evaluations needed before the surrogate starts screening positions
+        (Default: 5 times the number of dimensions)
    
     Returns
     =======
@@ -171,9 +439,13 @@ def pso(func, lb, ub, ieqcons=[], f_ieqcons=None, args=(), kwargs={},
    
     assert len(lb)==len(ub), 'Lower- and upper-bounds must be the same length'
     assert hasattr(func, '__call__'), 'Invalid function handle'
+    assert evaluator is None or processes == 0, 'A vectorized evaluator can only be used with processes = 0'
     lb = np.array(lb)
     ub = np.array(ub)
     assert np.all(ub>lb), 'All upper-bound values must be greater than lower-bound values'
+    if log_scale is not None:
+        log_scale = np.asarray(log_scale, dtype=bool)
+        assert np.all(lb[log_scale] > 0), 'Log-scaled dimensions must have positive bounds'
 
     vhigh = np.abs(ub - lb)
     vlow = -vhigh
@@ -182,86 +454,76 @@ def pso(func, lb, ub, ieqcons=[], f_ieqcons=None, args=(), kwargs={},
     obj = partial(_obj_wrapper, func, args, kwargs)
 
     # Initialize dumping function if required
-    if dumpfile_prefix:
-        def dump(i, x, fx):
-            np.save(dumpfile_prefix % i + "_fx", fx)
-            np.save(dumpfile_prefix % i + "_pos", x)
-    else:
-        dump = lambda *_: None
+    dump = _dump_function(dumpfile_prefix)
 
     # Check for constraint function(s)
-    if f_ieqcons is None:
-        if not len(ieqcons):
-            if debug:
-                print('No constraints given.')
-            cons = _cons_none_wrapper
-        else:
-            if debug:
-                print('Converting ieqcons to a single constraint function')
-            cons = partial(_cons_ieqcons_wrapper, ieqcons, args, kwargs)
-    else:
-        if debug:
-            print('Single constraint function given in f_ieqcons')
-        cons = partial(_cons_f_ieqcons_wrapper, f_ieqcons, args, kwargs)
-    is_feasible = partial(_is_feasible_wrapper, cons)
+    is_feasible = _feasibility_function(ieqcons, f_ieqcons, args, kwargs, debug)
+
+    if evaluator is not None:
+        evaluator = partial(_evaluator_wrapper, evaluator, args, kwargs)
 
     # Initialize the multiprocessing module if necessary
+    mp_pool = None
     if processes > 1:
-        import multiprocessing
-        mp_pool = multiprocessing.Pool(processes)
+        mp_pool = pool if pool is not None else WorkerPool(processes)
+
+    if resume:
+        # Continue exactly where the checkpointed run left off
+        x, v, p, fp, g, fg, p_min, fp_min, it, iteration_history, stall, surrogate_data = _load_checkpoint(checkpoint_file)
+        model = Surrogate(lb, ub, *surrogate_data, min_points=surrogate_min_points) if surrogate else None
+        S, D = x.shape
+        fx = np.zeros(S)  # current particle function values
+        fs = np.zeros(S, dtype=bool)  # feasibility of each particle
+        if debug:
+            print('Resuming from {:} at iteration {:}'.format(checkpoint_file, it))
+    else:
+        # Initialize the particle swarm
+        S = swarmsize
+        D = len(lb)  # the number of dimensions each particle has
+        x = _initial_positions(S, lb, ub, init, log_scale)  # particle positions
+        v = np.zeros_like(x)  # particle velocities
+        p = np.zeros_like(x)  # best particle positions
+        fx = np.zeros(S)  # current particle function values
+        fs = np.zeros(S, dtype=bool)  # feasibility of each particle
+        fp = np.ones(S)*np.inf  # best particle function values
+        g = []  # best swarm position
+        fg = np.inf  # best swarm position starting value
+        stall = np.zeros(S, dtype=int)  # iterations since each particle's best position improved
+
+        # Calculate objective and constraints for each particle
+        fx, fs, diagnostics = evaluate_swarm(x, obj, is_feasible, processes, mp_pool, evaluator)
+        dump(0, x, fx)
+        model = None
+        if surrogate:
+            model = Surrogate(lb, ub, *(surrogate_data or (None, None)), min_points=surrogate_min_points)
+            model.add(x, fx)
 
-    # Initialize the particle swarm
-    S = swarmsize
-    D = len(lb)  # the number of dimensions each particle has
-    x = np.random.rand(S, D)  # particle positions
-    v = np.zeros_like(x)  # particle velocities
-    p = np.zeros_like(x)  # best particle positions
-    fx = np.zeros(S)  # current particle function values
-    fs = np.zeros(S, dtype=bool)  # feasibility of each particle
-    fp = np.ones(S)*np.inf  # best particle function values
-    g = []  # best swarm position
-    fg = np.inf  # best swarm position starting value
+        # Store particle's best position (if constraints are satisfied)
+        i_update = np.logical_and((fx < fp), fs)
+        p[i_update, :] = x[i_update, :].copy()
+        fp[i_update] = fx[i_update]
 
-    # Initialize the particle's position
-    x = lb + x*(ub - lb)
+        # Initialize global best position and score
+        i_min = np.argmin(fp)
+        p_min = p[i_min, :].copy()  # Initialize p_min with best initial position
+        fp_min = fp[i_min]  # Initialize fp_min with best initial score
 
-    # Calculate objective and constraints for each particle
-    if processes > 1:
-        fx = np.array(mp_pool.map(obj, x))
-        fs = np.array(mp_pool.map(is_feasible, x))
-    elif processes != 0:
-        for i in range(S):
-            fx[i] = obj(x[i, :])
-            fs[i] = is_feasible(x[i, :])
-    else:
-        fx = obj(x)
-        fs = is_feasible(x)
-    dump(0, x, fx)
-
-    # Store particle's best position (if constraints are satisfied)
-    i_update = np.logical_and((fx < fp), fs)
-    p[i_update, :] = x[i_update, :].copy()
-    fp[i_update] = fx[i_update]
-
-    # Initialize global best position and score
-    i_min = np.argmin(fp)
-    p_min = p[i_min, :].copy()  # Initialize p_min with best initial position
-    fp_min = fp[i_min]  # Initialize fp_min with best initial score
-
-    if fp[i_min] < fg:
-        fg = fp[i_min]
-        g = p[i_min, :].copy()
-    else:
-        g = x[0, :].copy()
+        if fp[i_min] < fg:
+            fg = fp[i_min]
+            g = p[i_min, :].copy()
+        else:
+            g = x[0, :].copy()
 
-    # Initialize the particle's velocity
-    v = vlow + np.random.rand(S, D)*(vhigh - vlow)
+        # Initialize the particle's velocity
+        v = vlow + np.random.rand(S, D)*(vhigh - vlow)
 
-    # Initialize iteration history
-    iteration_history = []
+        # Initialize iteration history
+        iteration_history = []
+
+        it = 1
+        _save_checkpoint(checkpoint_file, it, x, v, p, fp, g, fg, p_min, fp_min, iteration_history, stall, model)
 
     # Iterate until termination criterion met
-    it = 1
     while it < maxiter:
         rp = np.random.uniform(size=(S, D))
         rg = np.random.uniform(size=(S, D))
@@ -275,21 +537,27 @@ def pso(func, lb, ub, ieqcons=[], f_ieqcons=None, args=(), kwargs={},
         masku = x > ub
         x = x*(~np.logical_or(maskl, masku)) + lb*maskl + ub*masku
 
-        # Update objectives and constraints
-        if processes > 1:
-            fx = np.array(mp_pool.map(obj, x))
-            fs = np.array(mp_pool.map(is_feasible, x))
-        elif processes != 0:
-            for i in range(S):
-                fx[i] = obj(x[i, :])
-                fs[i] = is_feasible(x[i, :])
+        # Update objectives and constraints, only of the positions worth it if there is a surrogate
+        if model is not None:
+            i_eval = model.screen(x, fp)
+            fx = np.full(S, np.inf)
+            fs = np.zeros(S, dtype=bool)
+            fx[i_eval], fs[i_eval], diagnostics = evaluate_swarm(x[i_eval], obj, is_feasible, processes, mp_pool, evaluator)
+            model.add(x[i_eval], fx[i_eval])
+            screened = ~i_eval
+            if debug:
+                print('Surrogate screened out {:} of {:} particles at iteration {:}'.format(S - np.sum(i_eval), S, it))
         else:
-            fx = obj(x)
-            fs = is_feasible(x)
+            fx, fs, diagnostics = evaluate_swarm(x, obj, is_feasible, processes, mp_pool, evaluator)
+            screened = np.zeros(S, dtype=bool)
+        if debug:
+            eval_times = [d['eval_time'] for d in diagnostics if 'eval_time' in d]
+            if eval_times:
+                print('Evaluated iteration {:} in {:.3f} [s] (slowest particle)'.format(it, max(eval_times)))
 
         # Store current iteration data
-        iteration_history.append((it, x.copy(), fx.copy()))
-        dump(it, x, fx)
+        iteration_history.append((it, x.copy(), fx.copy(), screened))
+        dump(it, x, fx, screened if model is not None else None)
 
         # Store particle's best position (if constraints are satisfied)
         i_update = np.logical_and((fx < fp), fs)
@@ -316,9 +584,27 @@ def pso(func, lb, ub, ieqcons=[], f_ieqcons=None, args=(), kwargs={},
                 g = p_min.copy()
                 fg = fp[i_min]
 
+        # Re-seed the particles that got stuck
+        if reseed_after:
+            stall = np.where(i_update, 0, stall + 1)
+            stall[i_min] = 0
+            i_reseed = np.flatnonzero(stall >= reseed_after)
+            if len(i_reseed):
+                if debug:
+                    print('Re-seeding particles {:} at iteration {:}'.format(i_reseed, it))
+                x[i_reseed, :] = _scale_positions(np.random.rand(len(i_reseed), D), lb, ub, log_scale)
+                v[i_reseed, :] = vlow + np.random.rand(len(i_reseed), D)*(vhigh - vlow)
+                p[i_reseed, :] = x[i_reseed, :]
+                fp[i_reseed] = np.inf
+                stall[i_reseed] = 0
+
         if debug:
             print('Best after iteration {:}: {:} {:}'.format(it, g, fg))
         it += 1
+        _save_checkpoint(checkpoint_file, it, x, v, p, fp, g, fg, p_min, fp_min, iteration_history, stall, model)
+
+    if mp_pool is not None and pool is None:
+        mp_pool.close()
 
     if it >= maxiter:
         print('Stopping search: maximum iterations reached --> {:}'.format(maxiter))
@@ -332,4 +618,146 @@ def pso(func, lb, ub, ieqcons=[], f_ieqcons=None, args=(), kwargs={},
     if particle_output:
         return g, fg, p, fp
     else:
-        return g, fg
\ No newline at end of file
+        return g, fg
+
+
+def pso_async(func, lb, ub, ieqcons=[], f_ieqcons=None, args=(), kwargs={}, 
+              swarmsize=100, omega=0.5, phip=0.7, phig=0.3, maxiter=100, 
+              minstep=1e-3, minfunc=1e-3, debug=True, processes=1,
+              particle_output=False, dumpfile_prefix=None, csv_output_path=None,
+              pool=None, init='random', log_scale=None):
+    """
+    Asynchronous (steady-state) version of pso. Instead of waiting for the whole
+    swarm at each iteration, every particle is moved (towards the swarm's best
+    position at that moment) and re-evaluated as soon as its own evaluation
+    finishes, so a slow evaluation doesn't leave the other processes idle.
+
+    Takes the same parameters and returns the same values as pso, except that
+    there is no batch mode (processes must be >= 1). The k-th evaluation of each
+    particle counts as iteration k: the dump files and the CSV output are the
+    same as pso's, and an iteration is dumped once all its particles finished.
+    As with pso, an external WorkerPool can be given in pool, and is left open,
+    and init and log_scale choose the initial positions.
+    """
+
+    assert len(lb)==len(ub), 'Lower- and upper-bounds must be the same length'
+    assert hasattr(func, '__call__'), 'Invalid function handle'
+    assert processes >= 1, 'pso_async needs at least one process'
+    lb = np.array(lb)
+    ub = np.array(ub)
+    assert np.all(ub>lb), 'All upper-bound values must be greater than lower-bound values'
+    if log_scale is not None:
+        log_scale = np.asarray(log_scale, dtype=bool)
+        assert np.all(lb[log_scale] > 0), 'Log-scaled dimensions must have positive bounds'
+
+    vhigh = np.abs(ub - lb)
+    vlow = -vhigh
+
+    obj = partial(_obj_wrapper, func, args, kwargs)
+    dump = _dump_function(dumpfile_prefix)
+    is_feasible = _feasibility_function(ieqcons, f_ieqcons, args, kwargs, debug)
+    evaluate = partial(_evaluate_particle, obj, is_feasible)
+
+    import queue
+    mp_pool = pool if pool is not None else WorkerPool(processes)
+
+    # Initialize the particle swarm
+    S = swarmsize
+    D = len(lb)  # the number of dimensions each particle has
+    x = _initial_positions(S, lb, ub, init, log_scale)  # particle positions
+    v = vlow + np.random.rand(S, D)*(vhigh - vlow)  # particle velocities
+    p = np.zeros_like(x)  # best particle positions
+    fp = np.ones(S)*np.inf  # best particle function values
+    g = x[0, :].copy()  # best swarm position
+    fg = np.inf  # best swarm position starting value
+
+    # Positions and values of each particle, per iteration
+    xs = np.zeros((maxiter, S, D))
+    fxs = np.zeros((maxiter, S))
+    ndone = np.zeros(maxiter, dtype=int)
+    next_dump = 0
+    iteration_history = []
+
+    # Results are handed over by the pool's callbacks through this queue
+    results = queue.Queue()
+    def submit(i, k):
+        xs[k, i] = x[i]
+        mp_pool.apply_async(evaluate, (xs[k, i],),
+                            callback=lambda r, i=i, k=k: results.put((i, k, r, None)),
+                            error_callback=lambda e, i=i, k=k: results.put((i, k, None, e)))
+
+    for i in range(S):
+        submit(i, 0)
+    pending = S
+    stop = False
+
+    while pending:
+        i, k, result, error = results.get()
+        pending -= 1
+        if error is not None:
+            if pool is None:
+                mp_pool.terminate()
+            raise error
+        fx, fs, _ = result
+        fxs[k, i] = fx
+        ndone[k] += 1
+
+        # Update the particle's best position (if constraints are satisfied)
+        if fx < fp[i] and fs:
+            p[i, :] = xs[k, i].copy()
+            fp[i] = fx
+
+        # and the swarm's, with the same stopping criteria as pso
+        if fp[i] < fg:
+            if debug:
+                print('New best for swarm at iteration {:} (particle {:}): {:} {:}'.format(k, i, p[i, :], fp[i]))
+            stepsize = np.sqrt(np.sum((g - p[i, :])**2))
+            if fg < np.inf and np.abs(fg - fp[i]) <= minfunc:
+                print('Stopping search: Swarm best objective change less than {:}'.format(minfunc))
+                stop = True
+            elif fg < np.inf and stepsize <= minstep:
+                print('Stopping search: Swarm best position change less than {:}'.format(minstep))
+                stop = True
+            else:
+                g = p[i, :].copy()
+                fg = fp[i]
+
+        # Move the particle and evaluate it again straight away
+        if not stop and k + 1 < maxiter:
+            rp = np.random.uniform(size=D)
+            rg = np.random.uniform(size=D)
+            v[i] = omega*v[i] + phip*rp*(p[i] - x[i]) + phig*rg*(g - x[i])
+            x[i] = x[i] + v[i]
+            # Correct for bound violations
+            maskl = x[i] < lb
+            masku = x[i] > ub
+            x[i] = x[i]*(~np.logical_or(maskl, masku)) + lb*maskl + ub*masku
+            submit(i, k + 1)
+            pending += 1
+
+        # Dump the iterations that are now complete
+        while next_dump < maxiter and ndone[next_dump] == S:
+            dump(next_dump, xs[next_dump], fxs[next_dump])
+            if next_dump > 0:
+                iteration_history.append((next_dump, xs[next_dump].copy(), fxs[next_dump].copy(), np.zeros(S, dtype=bool)))
+            if debug:
+                print('Best after iteration {:}: {:} {:}'.format(next_dump, g, fg))
+            next_dump += 1
+
+    if pool is None:
+        mp_pool.close()
+
+    if not stop:
+        print('Stopping search: maximum iterations reached --> {:}'.format(maxiter))
+
+    # Write final results to CSV if path is provided
+    if csv_output_path:
+        i_min = np.argmin(fp)
+        _write_results_to_csv(csv_output_path, iteration_history, p, fp, p[i_min, :].copy(), fp[i_min])
+
+    if not is_feasible(g):
+        print("However, the optimization couldn't find a feasible design. Sorry")
+    if particle_output:
+        return g, fg, p, fp
+    else:
+        return g, fg
@@ -8,6 +8,8 @@ import pandas as pd
 from matplotlib.colors import Normalize
 from matplotlib.cm import ScalarMappable
 
+import common
+
 def load_space(space_file):
     """Load parameter space definition"""
     return np.genfromtxt(space_file, 
@@ -49,7 +51,7 @@ def load_pso_data(tracks_dir):
     for pos_file, fx_file in zip(pos_files, fx_files):
         try:
             positions = np.load(pos_file)
-            scores = np.load(fx_file)
+            scores = common.load_track_fx(fx_file)
             
             positions_list.append(positions)
             scores_list.append(scores)
@@ -60,7 +62,7 @@ def load_pso_data(tracks_dir):
     all_positions = np.vstack(positions_list)
     all_scores = np.concatenate(scores_list)
     
-    # Create a mask for valid (non-NaN) scores
+    # Create a mask for valid (non-NaN) scores, which also drops the particles the surrogate screened out
     valid_mask = ~np.isnan(all_scores)
     if not np.any(valid_mask):
         raise ValueError("All scores are NaN! Cannot find best solution.")
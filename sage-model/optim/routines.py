@@ -945,6 +945,64 @@ def comoving_distance(z, H_0=67.74, Omega_R=0, Omega_M=0.3089, Omega_L=0.6911):
     return c/H_0 * integral
 
 
+class Cosmology(object):
+    # Vectorised equivalents of z2tL, z2dA and comoving_distance for a single cosmology.
+    # The integrals over 1/E(z) are tabulated cumulatively once, after which any array of
+    # redshifts (>= 0) is answered by interpolating the tables. Use get_cosmology to reuse them.
+    Mpc_km = 3.08567758e19 # Number of km in 1 Mpc
+    yr_s = 60*60*24*365.24 # Number of seconds in a year
+    c = 299792.458 # Speed of light in km/s
+
+    def __init__(self, h=0.6774, Omega_M=0.3089, Omega_Lambda=0.6911, Omega_R=0, zmax=20., dz=1e-4):
+        self.h = h
+        self.H_0 = 100*h
+        self.Omega_M = Omega_M
+        self.Omega_Lambda = Omega_Lambda
+        self.Omega_R = Omega_R
+        self.Omega_k = 1 - Omega_R - Omega_M - Omega_Lambda
+        self.dz = dz
+        self._tabulate(zmax)
+
+    def _tabulate(self, zmax):
+        zprime = np.linspace(0, zmax, int(round(zmax/self.dz)) + 1)
+        E = np.sqrt(self.Omega_R*(1+zprime)**4 + self.Omega_M*(1+zprime)**3 + self.Omega_k*(1+zprime)**2 + self.Omega_Lambda)
+        self._z = zprime
+        # Cumulative trapezoidal integrals of 1/E and 1/((1+z)E) from 0 to each zprime
+        dz = np.diff(zprime)
+        self._int_E = np.concatenate(([0.], np.cumsum(0.5*dz*(1./E[:-1] + 1./E[1:]))))
+        integrand = 1./((1+zprime)*E)
+        self._int_tL = np.concatenate(([0.], np.cumsum(0.5*dz*(integrand[:-1] + integrand[1:]))))
+
+    def _integral(self, table, z):
+        # table is the name of the tabulated integral
+        z = np.asarray(z, dtype=np.float64)
+        if z.size and np.max(z) > self._z[-1]:
+            self._tabulate(2*np.max(z))
+        return np.interp(z, self._z, getattr(self, table))
+
+    def z2tL(self, z):
+        # Look-back time in Gyr
+        tL = self._integral('_int_tL', z) * self.Mpc_km / (self.H_0*self.yr_s*1e9)
+        return np.where(np.asarray(z) > 0, tL, 0.) # not designed for blueshifts!
+
+    def z2dA(self, z):
+        # Angular-diameter distance in pc
+        return 1e6*self.c*self._integral('_int_E', z) / (self.H_0*(1+np.asarray(z)))
+
+    def comoving_distance(self, z):
+        # Co-moving distance in Mpc
+        return self.c/self.H_0 * self._integral('_int_E', z)
+
+_cosmologies = {}
+
+def get_cosmology(h=0.6774, Omega_M=0.3089, Omega_Lambda=0.6911, Omega_R=0):
+    # Returns the (cached) Cosmology for these parameters, so its tables are only built once
+    key = (h, Omega_M, Omega_Lambda, Omega_R)
+    if key not in _cosmologies:
+        _cosmologies[key] = Cosmology(h, Omega_M, Omega_Lambda, Omega_R)
+    return _cosmologies[key]
+
+
 def return_fraction_and_SN_ChabrierIMF(m_min=0.1, m_max=100.0, A=0.84342328, k=0.23837777, m_c=0.08, sigma=0.69, ratio_Ia_II=0.2):
     # array of mass values covering the full range that stars are assumed to fall within
     m = np.linspace(m_min, m_max, 10001) # solar masses
@@ -997,15 +1055,28 @@ def read_sage_hdf(frp, snap_num=None, fields=None):
     
     # Open the HDF file and select the specified snapshot
     with h5.File(frp, 'r') as property:
-        snapshot_data = property[snap_num]
+        return _read_sage_hdf_snapshot(property, snap_num, Galdesc)
+
+def read_sage_hdf_snapshots(frp, snap_nums, fields=None):
+    # Same as read_sage_hdf, but reads several snapshots while opening the file only once.
+    # Returns a dictionary with the data of each snapshot
+    Galdesc = galdtype_sage()
+    if fields is not None:
+        Galdesc = [field for field in Galdesc if field[0] in fields]
+
+    with h5.File(frp, 'r') as property:
+        return {snap_num: _read_sage_hdf_snapshot(property, snap_num, Galdesc) for snap_num in snap_nums}
+
+def _read_sage_hdf_snapshot(property, snap_num, Galdesc):
+    snapshot_data = property[snap_num]
         
-        # Extract each specified parameter
-        data = {}
-        for field_name, field_type in Galdesc:
-            try:
-                data[field_name] = np.array(snapshot_data[field_name])
-            except KeyError:
-                print(f"Parameter '{field_name}' not found in snapshot '{snap_num}'")
+    # Extract each specified parameter
+    data = {}
+    for field_name, field_type in Galdesc:
+        try:
+            data[field_name] = np.array(snapshot_data[field_name])
+        except KeyError:
+            print(f"Parameter '{field_name}' not found in snapshot '{snap_num}'")
     
     return data
 
@@ -40,6 +40,22 @@ def build_sage_pyext(use_from_mcmc=False, verbose=False):
     const char *param_file, void **run_params);
     int finalize_sage(void *run_params);
 
+    int read_sage_params(const int ThisTask, const int NTasks,
+    const char *param_file, void **base_params);
+    int run_sage_with_overrides(const void *base_params, const int noverrides,
+    const char **names, const char **values, void **run_params);
+    void free_sage_params(void *base_params);
+
+    void enable_forest_cache(const int enable);
+    void free_forest_cache(void);
+
+    int32_t get_num_memory_output_fields(void);
+    const char * get_memory_output_field_name(const int32_t field_idx);
+    int32_t get_memory_output_field_is_integer(const int32_t field_idx);
+    int64_t get_memory_output_ngals(const int32_t snapnum);
+    int32_t get_memory_output_field(const int32_t snapnum, const char *field_name, void *dest);
+    void free_memory_output(void);
+
     """)
 
     # set_source() gives the name of the python extension module to
@@ -59,17 +75,22 @@ def build_sage_pyext(use_from_mcmc=False, verbose=False):
                                            dir_path],
     )
 
-    ffibuilder.compile(verbose=verbose)
+    # Compile next to this file (rather than the cwd) so that callers
+    # running from elsewhere (e.g., optim/) can find the module
+    ffibuilder.compile(tmpdir=dir_path, verbose=verbose)
     return
 
 
-def run_sage(paramfile, use_from_mcmc=False):
+def _import_sage_cffi(use_from_mcmc=False):
     try:
         from _sage_cffi import ffi, lib
     except ImportError:
         build_sage_pyext(use_from_mcmc=use_from_mcmc)
         from _sage_cffi import ffi, lib
+    return ffi, lib
 
+
+def _get_rank_and_ntasks():
     rank = 0
     ntasks = 1
     try:
@@ -80,6 +101,12 @@ def run_sage(paramfile, use_from_mcmc=False):
     except ImportError:
         print("Did not detect MPI")
         pass
+    return rank, ntasks
+
+
+def run_sage(paramfile, use_from_mcmc=False):
+    ffi, lib = _import_sage_cffi(use_from_mcmc=use_from_mcmc)
+    rank, ntasks = _get_rank_and_ntasks()
 
     print(f"[Rank={rank}]: Running on {ntasks} tasks")
     # this will contain the (malloc'ed) pointer to 'struct params' in C
@@ -100,6 +127,142 @@ def run_sage(paramfile, use_from_mcmc=False):
     return
 
 
+def enable_forest_cache(enable=True, use_from_mcmc=False):
+    """
+    Keeps the forests loaded by this process in memory across successive
+    runs, so that repeated runs (e.g., during a calibration) only read the
+    trees once. Disabling the cache also releases the cached forests.
+    """
+    ffi, lib = _import_sage_cffi(use_from_mcmc=use_from_mcmc)
+    lib.enable_forest_cache(1 if enable else 0)
+
+
+def free_forest_cache(use_from_mcmc=False):
+    ffi, lib = _import_sage_cffi(use_from_mcmc=use_from_mcmc)
+    lib.free_forest_cache()
+
+
+def get_memory_output(snapshots, fields=None, use_from_mcmc=False):
+    """
+    Returns the galaxies kept in memory by the last run with
+    OutputFormat = sage_memory, as {'Snap_<n>': {field: numpy array}}
+    (i.e., keyed like the groups in the hdf5 output). All the fields
+    kept in memory are returned if fields is None.
+    """
+    import numpy as np
+
+    ffi, lib = _import_sage_cffi(use_from_mcmc=use_from_mcmc)
+    available = {}
+    for i in range(lib.get_num_memory_output_fields()):
+        name = ffi.string(lib.get_memory_output_field_name(i)).decode()
+        available[name] = np.int32 if lib.get_memory_output_field_is_integer(i) else np.float32
+    if fields is None:
+        fields = list(available.keys())
+
+    galaxies = {}
+    for snap in snapshots:
+        ngals = lib.get_memory_output_ngals(snap)
+        if ngals < 0:
+            raise ValueError(f"Snapshot {snap} was not kept in memory by the last SAGE run")
+        data = {}
+        for field in fields:
+            if field not in available:
+                raise KeyError(f"Field {field} is not kept in memory, available fields are {list(available.keys())}")
+            data[field] = np.empty(ngals, dtype=available[field])
+            if ngals > 0:
+                status = lib.get_memory_output_field(snap, field.encode(), ffi.from_buffer(data[field]))
+                if status != 0:
+                    raise RuntimeError(f"Could not get field {field} for snapshot {snap} (status = {status})")
+        galaxies[f"Snap_{snap}"] = data
+    return galaxies
+
+
+def free_memory_output(use_from_mcmc=False):
+    ffi, lib = _import_sage_cffi(use_from_mcmc=use_from_mcmc)
+    lib.free_memory_output()
+
+
+def _format_override(value):
+    import numbers
+    if isinstance(value, str):
+        return value
+    if isinstance(value, numbers.Integral):
+        return str(int(value))
+    # full double precision, so the C side sees exactly the python value
+    return "%.17g" % float(value)
+
+
+class SageParams(object):
+    """
+    A parameter file read once by SAGE, which can then be run any number
+    of times with some of the parameters overridden, without writing
+    new parameter files. For example:
+
+        params = SageParams("input/millennium.par")
+        params.run({"SfrEfficiency": 0.05, "OutputDir": "/tmp/run0"})
+        params.run(["SfrEfficiency"], [0.06])
+        params.close()
+
+    Only parameters that are stored directly (numbers and paths such as
+    OutputDir) and OutputFormat can be overridden; TreeType,
+    ForestDistributionScheme, LastSnapshotNr and NumOutputs can not.
+    With OutputFormat = sage_memory nothing is written to disk, and the
+    galaxies are instead available through get_memory_output.
+
+    With cache_forests=True the merger trees are only read from disk
+    during the first run, and kept in memory for all subsequent runs
+    within this process (see enable_forest_cache).
+    """
+
+    def __init__(self, paramfile, use_from_mcmc=False, cache_forests=False):
+        self.ffi, self.lib = _import_sage_cffi(use_from_mcmc=use_from_mcmc)
+        if cache_forests:
+            self.lib.enable_forest_cache(1)
+        self.rank, self.ntasks = _get_rank_and_ntasks()
+        self._base = self.ffi.new("void **")
+        fname = self.ffi.new("char []", paramfile.encode())
+        status = self.lib.read_sage_params(self.rank, self.ntasks, fname, self._base)
+        if status != 0:
+            self.close()
+            raise RuntimeError(f"Could not read the SAGE parameter file {paramfile} (status = {status})")
+
+    def run(self, names=None, values=None):
+        """Runs SAGE with overrides given as a dict, or as sequences of names and values"""
+        if self._base is None:
+            raise RuntimeError("SAGE parameters have already been released")
+        if names is None:
+            names = {}
+        if isinstance(names, dict):
+            names, values = list(names.keys()), list(names.values())
+        if len(names) != len(values):
+            raise ValueError(f"Got {len(names)} parameter names but {len(values)} values")
+
+        # keep references to the C strings alive for the duration of the call
+        c_names = [self.ffi.new("char []", str(n).encode()) for n in names]
+        c_values = [self.ffi.new("char []", _format_override(v).encode()) for v in values]
+        params_struct = self.ffi.new("void **")
+        status = self.lib.run_sage_with_overrides(self._base[0], len(c_names),
+                                                  self.ffi.new("char *[]", c_names),
+                                                  self.ffi.new("char *[]", c_values),
+                                                  params_struct)
+        if status != 0:
+            if params_struct[0] != self.ffi.NULL:
+                self.lib.free_sage_params(params_struct[0])
+            return status
+        return self.lib.finalize_sage(params_struct[0])
+
+    def close(self):
+        if self._base is not None and self._base[0] != self.ffi.NULL:
+            self.lib.free_sage_params(self._base[0])
+        self._base = None
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
 if __name__ == "__main__":
     import os
     parfile = "tests/test_data/mini-millennium.par"
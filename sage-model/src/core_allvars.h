@@ -49,6 +49,7 @@ enum Valid_OutputFormats
     sage_binary = 0, /* will be deprecated after version 1 release*/
     sage_hdf5 = 1,
     lhalo_binary_output = 2, /* special functionality to convert *any* supported input mergertree into a lhalo-binary format */
+    sage_memory = 3, /* keeps a few galaxy properties in memory (e.g., for calibrations through the python bindings) */
     num_output_format_types
 };
 
@@ -40,9 +40,17 @@ double get_rate(int tab, double logTemp);
 #define NUM_METALS_TABLE        sizeof(metallicities)/sizeof(metallicities[0])
 
 static double CoolRate[NUM_METALS_TABLE][TABSIZE];
+static int cooling_functions_read = 0;
 
 void read_cooling_functions(void)
 {
+    /* The tables are the same for every run. Only read them (and shift the metallicities)
+       once per process, otherwise repeated runs within the same process (e.g., through the
+       python bindings) would keep adding the solar metallicity to the table */
+    if(cooling_functions_read) {
+        return;
+    }
+
     char buf[MAX_STRING_LEN];
 
     const double log10_zerop02 = log10(0.02);
@@ -75,6 +83,7 @@ void read_cooling_functions(void)
         fclose(fd);
     }
 
+    cooling_functions_read = 1;
 }
 
 
@@ -22,6 +22,112 @@
 #include "io/read_tree_gadget4_hdf5.h"
 #endif
 
+/* Opt-in cache of all the forests loaded by this task. When enabled, repeated runs
+   within the same process (e.g., a calibration driving sage through the python bindings)
+   only read the forests from disk during the first run. The cache is keyed on everything
+   that determines which forests this task loads (and how they are converted), and is
+   discarded whenever any of those change */
+struct forest_cache {
+    int32_t enabled;
+    int32_t valid;/* set once *all* forests for this task have been cached */
+
+    enum Valid_TreeTypes TreeType;
+    char SimulationDir[MAX_STRING_LEN];
+    char TreeName[MAX_STRING_LEN];
+    char TreeExtension[MAX_STRING_LEN];
+    int32_t FirstFile;
+    int32_t LastFile;
+    int32_t NumSimulationTreeFiles;
+    int32_t ThisTask;
+    int32_t NTasks;
+    enum Valid_Forest_Distribution_Schemes ForestDistributionScheme;
+    double Exponent_Forest_Dist_Scheme;
+    double PartMass;
+    double Hubble_h;
+
+    int64_t nforests;
+    int64_t ncached;
+    int64_t *nhalos;
+    struct halo_data **halos;
+};
+static struct forest_cache cache;
+
+static int forest_cache_matches(const struct params *run_params, const int64_t nforests, const int ThisTask, const int NTasks);
+static int setup_forest_cache(const struct params *run_params, const int64_t nforests, const int ThisTask, const int NTasks);
+
+void enable_forest_cache(const int enable)
+{
+    if(!enable) {
+        free_forest_cache();
+    }
+    cache.enabled = enable ? 1:0;
+}
+
+void free_forest_cache(void)
+{
+    if(cache.halos != NULL) {
+        for(int64_t i=0;i<cache.nforests;i++) {
+            free(cache.halos[i]);
+        }
+    }
+    free(cache.halos);
+    free(cache.nhalos);
+    cache.halos = NULL;
+    cache.nhalos = NULL;
+    cache.nforests = 0;
+    cache.ncached = 0;
+    cache.valid = 0;
+}
+
+static int forest_cache_matches(const struct params *run_params, const int64_t nforests, const int ThisTask, const int NTasks)
+{
+    return cache.halos != NULL && cache.nforests == nforests &&
+        cache.TreeType == run_params->TreeType &&
+        strncmp(cache.SimulationDir, run_params->SimulationDir, MAX_STRING_LEN) == 0 &&
+        strncmp(cache.TreeName, run_params->TreeName, MAX_STRING_LEN) == 0 &&
+        strncmp(cache.TreeExtension, run_params->TreeExtension, MAX_STRING_LEN) == 0 &&
+        cache.FirstFile == run_params->FirstFile && cache.LastFile == run_params->LastFile &&
+        cache.NumSimulationTreeFiles == run_params->NumSimulationTreeFiles &&
+        cache.ThisTask == ThisTask && cache.NTasks == NTasks &&
+        cache.ForestDistributionScheme == run_params->ForestDistributionScheme &&
+        cache.Exponent_Forest_Dist_Scheme == run_params->Exponent_Forest_Dist_Scheme &&
+        cache.PartMass == run_params->PartMass && cache.Hubble_h == run_params->Hubble_h;
+}
+
+static int setup_forest_cache(const struct params *run_params, const int64_t nforests, const int ThisTask, const int NTasks)
+{
+    if(forest_cache_matches(run_params, nforests, ThisTask, NTasks)) {
+        return EXIT_SUCCESS;
+    }
+
+    free_forest_cache();
+    cache.TreeType = run_params->TreeType;
+    snprintf(cache.SimulationDir, MAX_STRING_LEN, "%s", run_params->SimulationDir);
+    snprintf(cache.TreeName, MAX_STRING_LEN, "%s", run_params->TreeName);
+    snprintf(cache.TreeExtension, MAX_STRING_LEN, "%s", run_params->TreeExtension);
+    cache.FirstFile = run_params->FirstFile;
+    cache.LastFile = run_params->LastFile;
+    cache.NumSimulationTreeFiles = run_params->NumSimulationTreeFiles;
+    cache.ThisTask = ThisTask;
+    cache.NTasks = NTasks;
+    cache.ForestDistributionScheme = run_params->ForestDistributionScheme;
+    cache.Exponent_Forest_Dist_Scheme = run_params->Exponent_Forest_Dist_Scheme;
+    cache.PartMass = run_params->PartMass;
+    cache.Hubble_h = run_params->Hubble_h;
+
+    /* calloc so that unloaded forests are NULL and can be freed safely */
+    cache.nhalos = calloc(nforests > 0 ? nforests:1, sizeof(cache.nhalos[0]));
+    cache.halos = calloc(nforests > 0 ? nforests:1, sizeof(cache.halos[0]));
+    if(cache.nhalos == NULL || cache.halos == NULL) {
+        fprintf(stderr,"Warning: Could not allocate memory to cache %"PRId64" forests...continuing without the cache\n", nforests);
+        free_forest_cache();
+        return MALLOC_FAILURE;
+    }
+    cache.nforests = nforests;
+
+    return EXIT_SUCCESS;
+}
+
 int setup_forests_io(struct params *run_params, struct forest_info *forests_info,
                      const int ThisTask, const int NTasks)
 {
@@ -93,6 +199,10 @@ int setup_forests_io(struct params *run_params, struct forest_info *forests_info
         return -1;
     }
 
+    /* A failure to setup the cache is not fatal, the forests are then simply read from disk */
+    if(cache.enabled) {
+        setup_forest_cache(run_params, forests_info->nforests_this_task, ThisTask, NTasks);
+    }
 
     return status;
 }
@@ -154,6 +264,19 @@ int64_t load_forest(struct params *run_params, const int64_t forestnr, struct ha
     int64_t nhalos;
     const enum Valid_TreeTypes TreeType = run_params->TreeType;
 
+    const int use_cache = cache.enabled && cache.halos != NULL && forestnr >= 0 && forestnr < cache.nforests;
+    if(use_cache && cache.valid) {
+        /* The caller frees the halos after processing the forest -> hand over a copy */
+        nhalos = cache.nhalos[forestnr];
+        *halos = mymalloc(sizeof(struct halo_data) * (nhalos > 0 ? nhalos:1));
+        if(*halos == NULL) {
+            fprintf(stderr,"Error: Could not allocate memory for %"PRId64" halos in forestnr = %"PRId64"\n", nhalos, forestnr);
+            return -MALLOC_FAILURE;
+        }
+        memcpy(*halos, cache.halos[forestnr], sizeof(struct halo_data) * nhalos);
+        return nhalos;
+    }
+
     switch (TreeType) {
 
 #ifdef HDF5
@@ -190,5 +313,20 @@ int64_t load_forest(struct params *run_params, const int64_t forestnr, struct ha
         return -EXIT_FAILURE;
     }
 
+    if(use_cache && nhalos >= 0 && cache.halos[forestnr] == NULL) {
+        cache.halos[forestnr] = malloc(sizeof(struct halo_data) * (nhalos > 0 ? nhalos:1));
+        if(cache.halos[forestnr] == NULL) {
+            fprintf(stderr,"Warning: Could not allocate memory to cache forestnr = %"PRId64"...disabling the cache\n", forestnr);
+            free_forest_cache();
+            return nhalos;
+        }
+        memcpy(cache.halos[forestnr], *halos, sizeof(struct halo_data) * nhalos);
+        cache.nhalos[forestnr] = nhalos;
+        cache.ncached++;
+        if(cache.ncached == cache.nforests) {
+            cache.valid = 1;
+        }
+    }
+
     return nhalos;
 }
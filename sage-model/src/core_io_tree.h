@@ -13,6 +13,8 @@ extern "C" {
                                 const int ThisTask, const int NTasks);
     extern int64_t load_forest(struct params *run_params, const int64_t forestnr, struct halo_data **halos, struct forest_info *forests_info);
     extern void cleanup_forests_io(enum Valid_TreeTypes my_TreeType, struct forest_info *forests_info);
+    extern void enable_forest_cache(const int enable);
+    extern void free_forest_cache(void);
 
 #ifdef __cplusplus
 }
@@ -18,6 +18,10 @@ enum datatypes {
 
 int compare_ints_descending (const void* p1, const void* p2);
 
+/* valid values for OutputFormat (also used when overriding the output format in update_parameters) */
+static const char format_names[][MAXTAGLEN] = {"sage_binary", "sage_hdf5", "lhalo_binary_output", "sage_memory"};
+static const enum Valid_OutputFormats format_enums[] = {sage_binary, sage_hdf5, lhalo_binary_output, sage_memory};
+
 int compare_ints_descending (const void* p1, const void* p2)
 {
     int i1 = *(int*) p1;
@@ -31,32 +35,20 @@ int compare_ints_descending (const void* p1, const void* p2)
     }
  }
 
-int read_parameter_file(const char *fname, struct params *run_params)
+static int setup_parameter_tags(struct params *run_params, char ParamTag[][MAXTAGLEN + 1], int *ParamID, void **ParamAddr,
+                                char *my_treetype, char *my_outputformat, char *my_forest_dist_scheme);
+static void assign_parameter_value(const int param_id, void *param_addr, const char *value);
+
+static int setup_parameter_tags(struct params *run_params, char ParamTag[][MAXTAGLEN + 1], int *ParamID, void **ParamAddr,
+                                char *my_treetype, char *my_outputformat, char *my_forest_dist_scheme)
 {
-    int errorFlag = 0;
-    int *used_tag = 0;
-    char my_treetype[MAX_STRING_LEN], my_outputformat[MAX_STRING_LEN], my_forest_dist_scheme[MAX_STRING_LEN];
-    /*  recipe parameters  */
     int NParam = 0;
-    char ParamTag[MAXTAGS][MAXTAGLEN + 1];
-    int  ParamID[MAXTAGS];
-    void *ParamAddr[MAXTAGS];
 
     /* Ensure that all strings will be NULL terminated */
     for(int i=0;i<MAXTAGS;i++) {
         ParamTag[i][MAXTAGLEN] = '\0';
     }
 
-    NParam = 0;
-
-#ifdef VERBOSE
-    const int ThisTask = run_params->ThisTask;
-
-    if(ThisTask == 0) {
-        fprintf(stdout, "\nreading parameter file:\n\n");
-    }
-#endif
-
     strncpy(ParamTag[NParam], "FileNameGalaxies", MAXTAGLEN);
     ParamAddr[NParam] = run_params->FileNameGalaxies;
     ParamID[NParam++] = STRING;
@@ -233,6 +225,46 @@ int read_parameter_file(const char *fname, struct params *run_params)
     ParamAddr[NParam] = &(run_params->Exponent_Forest_Dist_Scheme);
     ParamID[NParam++] = DOUBLE;
 
+    return NParam;
+}
+
+static void assign_parameter_value(const int param_id, void *param_addr, const char *value)
+{
+    switch (param_id)
+        {
+        case DOUBLE:
+            *((double *) param_addr) = atof(value);
+            break;
+        case STRING:
+            snprintf(param_addr, MAX_STRING_LEN, "%s", value);
+            break;
+        case INT:
+            *((int *) param_addr) = atoi(value);
+            break;
+        }
+}
+
+int read_parameter_file(const char *fname, struct params *run_params)
+{
+    int errorFlag = 0;
+    int *used_tag = 0;
+    char my_treetype[MAX_STRING_LEN], my_outputformat[MAX_STRING_LEN], my_forest_dist_scheme[MAX_STRING_LEN];
+    /*  recipe parameters  */
+    int NParam = 0;
+    char ParamTag[MAXTAGS][MAXTAGLEN + 1];
+    int  ParamID[MAXTAGS];
+    void *ParamAddr[MAXTAGS];
+
+#ifdef VERBOSE
+    const int ThisTask = run_params->ThisTask;
+
+    if(ThisTask == 0) {
+        fprintf(stdout, "\nreading parameter file:\n\n");
+    }
+#endif
+
+    NParam = setup_parameter_tags(run_params, ParamTag, ParamID, ParamAddr, my_treetype, my_outputformat, my_forest_dist_scheme);
+
     used_tag = mymalloc(sizeof(int) * NParam);
     for(int i=0; i<NParam; i++) {
         used_tag[i]=1;
@@ -293,18 +325,7 @@ int read_parameter_file(const char *fname, struct params *run_params)
             }
 #endif
 
-            switch (ParamID[j])
-                {
-                case DOUBLE:
-                    *((double *) ParamAddr[j]) = atof(buf2);
-                    break;
-                case STRING:
-                    snprintf(ParamAddr[j], MAX_STRING_LEN, "%s", buf2);
-                    break;
-                case INT:
-                    *((int *) ParamAddr[j]) = atoi(buf2);
-                    break;
-                }
+            assign_parameter_value(ParamID[j], ParamAddr[j], buf2);
         } else {
             fprintf(stderr, "Error in file %s:   Tag '%s' not allowed or multiply defined.\n", fname, buf1);
             errorFlag = 1;
@@ -483,10 +504,9 @@ int read_parameter_file(const char *fname, struct params *run_params)
     }
 #endif
 
-    const char format_names[][MAXTAGLEN] = {"sage_binary", "sage_hdf5", "lhalo_binary_output"};
-    const enum Valid_OutputFormats format_enums[] = {sage_binary, sage_hdf5, lhalo_binary_output};
     const int nvalid_format_types  = sizeof(format_names)/(MAXTAGLEN*sizeof(char));
-    XRETURN(nvalid_format_types == 3, EXIT_FAILURE, "nvalid_format_types = %d should have been 3\n", nvalid_format_types);
+    XRETURN(nvalid_format_types == num_output_format_types, EXIT_FAILURE, "nvalid_format_types = %d should have been %d\n",
+            nvalid_format_types, num_output_format_types);
     CHECK_VALID_ENUM_IN_PARAM_FILE(OutputFormat, nvalid_format_types, format_names, format_enums, my_outputformat);
 
     /* Check that the way forests are distributed over (MPI) tasks is valid */
@@ -515,5 +535,71 @@ int read_parameter_file(const char *fname, struct params *run_params)
 }
 
 
+int update_parameters(struct params *run_params, const int noverrides, const char **names, const char **values)
+{
+    /* Overrides are meant for the (physics) parameters that are stored directly within
+       run_params, plus OutputFormat (e.g., to switch to the in-memory output). The other
+       string-valued enums (TreeType, ForestDistributionScheme) are only parsed and validated
+       within read_parameter_file, so are not allowed here */
+    char my_treetype[MAX_STRING_LEN], my_outputformat[MAX_STRING_LEN], my_forest_dist_scheme[MAX_STRING_LEN];
+    char ParamTag[MAXTAGS][MAXTAGLEN + 1];
+    int  ParamID[MAXTAGS];
+    void *ParamAddr[MAXTAGS];
+
+    const int NParam = setup_parameter_tags(run_params, ParamTag, ParamID, ParamAddr, my_treetype, my_outputformat, my_forest_dist_scheme);
+    for(int k=0; k<noverrides; k++) {
+        int j=-1;
+        for(int i = 0; i < NParam; i++) {
+            if(strncasecmp(names[k], ParamTag[i], MAXTAGLEN) == 0) {
+                j = i;
+                break;
+            }
+        }
+
+        if(j < 0) {
+            fprintf(stderr, "Error: Can not override parameter '%s' -- tag not allowed\n", names[k]);
+            return INVALID_OPTION_IN_PARAMS;
+        }
+        if(ParamAddr[j] == my_outputformat) {
+            const int nvalid_format_types  = sizeof(format_names)/(MAXTAGLEN*sizeof(char));
+            int found = 0;
+            for(int i=0;i<nvalid_format_types;i++) {
+                if(strcasecmp(values[k], format_names[i]) == 0) {
+                    run_params->OutputFormat = format_enums[i];
+                    found = 1;
+                    break;
+                }
+            }
+#ifndef HDF5
+            if(found && run_params->OutputFormat == sage_hdf5) {
+                fprintf(stderr, "You have specified to use HDF5 output format but have not compiled with the HDF5 option enabled.\n");
+                found = 0;
+            }
+#endif
+            if(found == 0) {
+                fprintf(stderr, "Error: Can not override OutputFormat with unsupported value '%s'\n", values[k]);
+                return INVALID_OPTION_IN_PARAMS;
+            }
+            continue;
+        }
+        if(ParamAddr[j] == my_treetype || ParamAddr[j] == my_forest_dist_scheme ||
+           ParamAddr[j] == &(run_params->LastSnapshotNr) || ParamAddr[j] == &(run_params->NumSnapOutputs)) {
+            fprintf(stderr, "Error: Parameter '%s' can only be set within the parameter file\n", names[k]);
+            return INVALID_OPTION_IN_PARAMS;
+        }
+
+        assign_parameter_value(ParamID[j], ParamAddr[j], values[k]);
+    }
+
+    const size_t outlen = strlen(run_params->OutputDir);
+    if(outlen > 0 && outlen < MAX_STRING_LEN - 1) {
+        if(run_params->OutputDir[outlen - 1] != '/')
+            strcat(run_params->OutputDir, "/");
+    }
+
+    return EXIT_SUCCESS;
+}
+
+
 #undef MAXTAGS
 #undef MAXTAGLEN
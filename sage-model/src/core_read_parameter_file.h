@@ -6,6 +6,7 @@ extern "C" {
 
     /* functions in core_read_parameter_file.c */
     extern int read_parameter_file(const char *fname, struct params *run_params);
+    extern int update_parameters(struct params *run_params, const int noverrides, const char **names, const char **values);
 
 #ifdef __cplusplus
 }
@@ -14,6 +14,7 @@
 #include "core_mymalloc.h"
 
 #include "io/save_gals_binary.h"
+#include "io/save_gals_memory.h"
 
 #ifdef HDF5
 #include "io/save_gals_hdf5.h"
@@ -52,6 +53,10 @@ int32_t initialize_galaxy_files(const int rank, const struct forest_info *forest
       break;
 #endif
 
+    case(sage_memory):
+      status = initialize_memory_galaxy_files(forest_info, save_info, run_params);
+      break;
+
     default:
       fprintf(stderr, "Error: Unknown OutputFormat in `initialize_galaxy_files()`.\n");
       status = INVALID_OPTION_IN_PARAMS;
@@ -151,6 +156,10 @@ int32_t save_galaxies(const int64_t task_forestnr, const int numgals, struct hal
         break;
 #endif
 
+    case(sage_memory):
+        status = save_memory_galaxies(numgals, halos, haloaux, halogal, save_info, run_params);
+        break;
+
     default:
         fprintf(stderr, "Uknown OutputFormat in `save_galaxies()`.\n");
         status = INVALID_OPTION_IN_PARAMS;
@@ -182,6 +191,10 @@ int32_t finalize_galaxy_files(const struct forest_info *forest_info, struct save
         break;
 #endif
 
+    case(sage_memory):
+        status = finalize_memory_galaxy_files(forest_info, save_info, run_params);
+        break;
+
     default:
         fprintf(stderr, "Error: Unknown OutputFormat in `finalize_galaxy_files()`.\n");
         status = INVALID_OPTION_IN_PARAMS;
@@ -0,0 +1,236 @@
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <strings.h>
+
+#include "save_gals_memory.h"
+#include "../core_utils.h"
+#include "../macros.h"
+
+/* The 'sage_memory' output format keeps a handful of galaxy properties at each output snapshot
+   in memory, instead of writing full catalogues to disk. The galaxies are kept after the run
+   finishes (i.e., after finalize_sage), until the next run starts or free_memory_output is called,
+   so that they can be handed over directly to the caller (e.g., the python bindings during a calibration).
+
+   Similar to NUM_OUTPUT_FIELDS for the hdf5 output, this is the (intentionally short) list of fields
+   that are kept. The units are identical to those in the hdf5 output */
+#define NUM_MEMORY_OUTPUT_FIELDS 9
+
+enum memory_output_fields {
+    mem_Type = 0,
+    mem_Len,
+    mem_Mvir,
+    mem_StellarMass,
+    mem_BulgeMass,
+    mem_BlackHoleMass,
+    mem_ColdGas,
+    mem_SfrDisk,
+    mem_SfrBulge,
+};
+
+static const char memory_field_names[NUM_MEMORY_OUTPUT_FIELDS][MAX_STRING_LEN] = {"Type", "Len", "Mvir", "StellarMass", "BulgeMass",
+                                                                                  "BlackHoleMass", "ColdGas", "SfrDisk", "SfrBulge"};
+static const int32_t memory_field_is_integer[NUM_MEMORY_OUTPUT_FIELDS] = {1, 1, 0, 0, 0, 0, 0, 0, 0};
+
+/* All fields are 4 bytes (either int32_t or float) */
+union memory_output_value {
+    int32_t i;
+    float f;
+};
+
+struct memory_output_snapshot {
+    int32_t snapnum;
+    int64_t ngals;
+    int64_t capacity;
+    union memory_output_value *fields[NUM_MEMORY_OUTPUT_FIELDS];
+};
+
+static int32_t num_memory_snapshots = 0;
+static struct memory_output_snapshot memory_snapshots[ABSOLUTEMAXSNAPS];
+
+// Local Proto-Types //
+static int32_t grow_memory_snapshot(struct memory_output_snapshot *snap);
+
+// Externally Visible Functions //
+
+int32_t initialize_memory_galaxy_files(const struct forest_info *forest_info, struct save_info *save_info,
+                                       const struct params *run_params)
+{
+    (void) forest_info;
+    (void) save_info;
+
+    /* Release the galaxies from any previous run */
+    free_memory_output();
+
+    for(int32_t snap_idx = 0; snap_idx < run_params->NumSnapOutputs; snap_idx++) {
+        memory_snapshots[snap_idx].snapnum = run_params->ListOutputSnaps[snap_idx];
+        memory_snapshots[snap_idx].ngals = 0;
+        memory_snapshots[snap_idx].capacity = 0;
+        for(int32_t field_idx = 0; field_idx < NUM_MEMORY_OUTPUT_FIELDS; field_idx++) {
+            memory_snapshots[snap_idx].fields[field_idx] = NULL;
+        }
+    }
+    num_memory_snapshots = run_params->NumSnapOutputs;
+
+    return EXIT_SUCCESS;
+}
+
+
+int32_t save_memory_galaxies(const int32_t num_gals, struct halo_data *halos, struct halo_aux_data *haloaux,
+                             struct GALAXY *halogal, struct save_info *save_info, const struct params *run_params)
+{
+    (void) halos;
+    (void) save_info;
+
+    const double sfr_units = run_params->UnitMass_in_g / run_params->UnitTime_in_s * SEC_PER_YEAR / SOLAR_MASS / STEPS;
+    for(int32_t gal_idx = 0; gal_idx < num_gals; gal_idx++) {
+
+        // Only processing galaxies at selected snapshots. This field was generated in `save_galaxies()`.
+        if(haloaux[gal_idx].output_snap_n < 0) {
+            continue;
+        }
+
+        struct memory_output_snapshot *snap = &(memory_snapshots[haloaux[gal_idx].output_snap_n]);
+        if(snap->ngals == snap->capacity) {
+            int32_t status = grow_memory_snapshot(snap);
+            if(status != EXIT_SUCCESS) {
+                return status;
+            }
+        }
+
+        const struct GALAXY *g = &halogal[gal_idx];
+        float tmp_SfrDisk = 0.0;
+        float tmp_SfrBulge = 0.0;
+        // NOTE: in Msun/yr
+        for(int step = 0; step < STEPS; step++) {
+            tmp_SfrDisk += g->SfrDisk[step] * sfr_units;
+            tmp_SfrBulge += g->SfrBulge[step] * sfr_units;
+        }
+
+        const int64_t n = snap->ngals;
+        snap->fields[mem_Type][n].i = g->Type;
+        snap->fields[mem_Len][n].i = g->Len;
+        snap->fields[mem_Mvir][n].f = g->Mvir;
+        snap->fields[mem_StellarMass][n].f = g->StellarMass;
+        snap->fields[mem_BulgeMass][n].f = g->BulgeMass;
+        snap->fields[mem_BlackHoleMass][n].f = g->BlackHoleMass;
+        snap->fields[mem_ColdGas][n].f = g->ColdGas;
+        snap->fields[mem_SfrDisk][n].f = tmp_SfrDisk;
+        snap->fields[mem_SfrBulge][n].f = tmp_SfrBulge;
+        snap->ngals++;
+    }
+
+    return EXIT_SUCCESS;
+}
+
+
+int32_t finalize_memory_galaxy_files(const struct forest_info *forest_info, struct save_info *save_info,
+                                     const struct params *run_params)
+{
+    (void) forest_info;
+    (void) save_info;
+    (void) run_params;
+
+    /* Nothing to do -> the galaxies stay in memory until the next run (or free_memory_output) */
+    return EXIT_SUCCESS;
+}
+
+
+int32_t get_num_memory_output_fields(void)
+{
+    return NUM_MEMORY_OUTPUT_FIELDS;
+}
+
+
+const char * get_memory_output_field_name(const int32_t field_idx)
+{
+    if(field_idx < 0 || field_idx >= NUM_MEMORY_OUTPUT_FIELDS) {
+        return NULL;
+    }
+    return memory_field_names[field_idx];
+}
+
+
+int32_t get_memory_output_field_is_integer(const int32_t field_idx)
+{
+    if(field_idx < 0 || field_idx >= NUM_MEMORY_OUTPUT_FIELDS) {
+        return -1;
+    }
+    return memory_field_is_integer[field_idx];
+}
+
+
+int64_t get_memory_output_ngals(const int32_t snapnum)
+{
+    for(int32_t snap_idx = 0; snap_idx < num_memory_snapshots; snap_idx++) {
+        if(memory_snapshots[snap_idx].snapnum == snapnum) {
+            return memory_snapshots[snap_idx].ngals;
+        }
+    }
+    return -1;
+}
+
+
+/* Copies all the galaxies for the requested field into dest, which must have space
+   for get_memory_output_ngals(snapnum) 4-byte elements */
+int32_t get_memory_output_field(const int32_t snapnum, const char *field_name, void *dest)
+{
+    int32_t field_idx = -1;
+    for(int32_t i = 0; i < NUM_MEMORY_OUTPUT_FIELDS; i++) {
+        if(strcasecmp(field_name, memory_field_names[i]) == 0) {
+            field_idx = i;
+            break;
+        }
+    }
+    if(field_idx < 0) {
+        fprintf(stderr, "Error: Field '%s' is not kept in the in-memory output\n", field_name);
+        return INVALID_OPTION_IN_PARAMS;
+    }
+
+    for(int32_t snap_idx = 0; snap_idx < num_memory_snapshots; snap_idx++) {
+        const struct memory_output_snapshot *snap = &(memory_snapshots[snap_idx]);
+        if(snap->snapnum == snapnum) {
+            if(snap->ngals > 0) {
+                memcpy(dest, snap->fields[field_idx], snap->ngals * sizeof(union memory_output_value));
+            }
+            return EXIT_SUCCESS;
+        }
+    }
+
+    fprintf(stderr, "Error: Snapshot %d was not one of the output snapshots\n", snapnum);
+    return SNAPSHOT_OUT_OF_RANGE;
+}
+
+
+void free_memory_output(void)
+{
+    for(int32_t snap_idx = 0; snap_idx < num_memory_snapshots; snap_idx++) {
+        for(int32_t field_idx = 0; field_idx < NUM_MEMORY_OUTPUT_FIELDS; field_idx++) {
+            free(memory_snapshots[snap_idx].fields[field_idx]);
+            memory_snapshots[snap_idx].fields[field_idx] = NULL;
+        }
+        memory_snapshots[snap_idx].ngals = 0;
+        memory_snapshots[snap_idx].capacity = 0;
+    }
+    num_memory_snapshots = 0;
+}
+
+// Local Functions //
+
+static int32_t grow_memory_snapshot(struct memory_output_snapshot *snap)
+{
+    /* Plain (re)alloc's rather than mymalloc since the galaxies outlive the run */
+    const int64_t new_capacity = snap->capacity > 0 ? 2*snap->capacity:8192;
+    for(int32_t field_idx = 0; field_idx < NUM_MEMORY_OUTPUT_FIELDS; field_idx++) {
+        void *tmp = realloc(snap->fields[field_idx], new_capacity * sizeof(union memory_output_value));
+        if(tmp == NULL) {
+            fprintf(stderr,"Error: Could not allocate memory for %"PRId64" galaxies in snapshot %d (field = '%s')\n",
+                    new_capacity, snap->snapnum, memory_field_names[field_idx]);
+            return MALLOC_FAILURE;
+        }
+        snap->fields[field_idx] = tmp;
+    }
+    snap->capacity = new_capacity;
+
+    return EXIT_SUCCESS;
+}
@@ -0,0 +1,31 @@
+#pragma once
+
+#include <stdint.h>
+
+#ifdef __cplusplus
+extern "C" {
+#endif /* working with c++ compiler */
+
+#include "../core_allvars.h"
+
+    /* Proto-Types */
+    extern int32_t initialize_memory_galaxy_files(const struct forest_info *forest_info, struct save_info *save_info,
+                                                  const struct params *run_params);
+
+    extern int32_t save_memory_galaxies(const int32_t num_gals, struct halo_data *halos, struct halo_aux_data *haloaux,
+                                        struct GALAXY *halogal, struct save_info *save_info, const struct params *run_params);
+
+    extern int32_t finalize_memory_galaxy_files(const struct forest_info *forest_info, struct save_info *save_info,
+                                                const struct params *run_params);
+
+    /* Access to the galaxies kept in memory by the last run (on this task) */
+    extern int32_t get_num_memory_output_fields(void);
+    extern const char * get_memory_output_field_name(const int32_t field_idx);
+    extern int32_t get_memory_output_field_is_integer(const int32_t field_idx);
+    extern int64_t get_memory_output_ngals(const int32_t snapnum);
+    extern int32_t get_memory_output_field(const int32_t snapnum, const char *field_name, void *dest);
+    extern void free_memory_output(void);
+
+#ifdef __cplusplus
+}
+#endif
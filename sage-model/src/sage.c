@@ -31,6 +31,8 @@
 /* main sage -> not exposed externally */
 int32_t sage_per_forest(const int64_t forestnr, struct save_info *save_info,
                         struct forest_info *forest_info, struct params *run_params);
+/* runs the model once the parameters have been set (either from a file or via overrides) */
+int run_sage_from_params(struct params *run_params);
 /* additional functionality to convert *any* support mergertree format into the lhalo-binary format */
 int convert_trees_to_lhalo(const int ThisTask, const int NTasks, struct params *run_params, struct forest_info *forest_info);
 
@@ -53,6 +55,62 @@ int run_sage(const int ThisTask, const int NTasks, const char *param_file, void
         return status;
     }
 
+    return run_sage_from_params(run_params);
+}
+
+
+int read_sage_params(const int ThisTask, const int NTasks, const char *param_file, void **base_params)
+{
+    struct params *run_params = malloc(sizeof(*run_params));
+    if(run_params == NULL) {
+        fprintf(stderr,"Error: On ThisTask = %d (out of NTasks = %d), failed to allocate memory "\
+                "for the C-struct to to hold the base run params. Requested size = %zu bytes...returning\n",
+                ThisTask, NTasks, sizeof(*run_params));
+        return MALLOC_FAILURE;
+    }
+    run_params->ThisTask = ThisTask;
+    run_params->NTasks = NTasks;
+    *base_params = run_params;
+
+    return read_parameter_file(param_file, run_params);
+}
+
+
+int run_sage_with_overrides(const void *base_params, const int noverrides, const char **names, const char **values, void **params)
+{
+    const struct params *base = (const struct params *) base_params;
+    struct params *run_params = malloc(sizeof(*run_params));
+    if(run_params == NULL) {
+        fprintf(stderr,"Error: On ThisTask = %d (out of NTasks = %d), failed to allocate memory "\
+                "for the C-struct to to hold the run params. Requested size = %zu bytes...returning\n",
+                base->ThisTask, base->NTasks, sizeof(*run_params));
+        return MALLOC_FAILURE;
+    }
+    /* The base params are never modified, so the same base can be re-used for any number of runs */
+    memcpy(run_params, base, sizeof(*run_params));
+    *params = run_params;
+
+    int32_t status = update_parameters(run_params, noverrides, names, values);
+    if(status != EXIT_SUCCESS) {
+        return status;
+    }
+
+    return run_sage_from_params(run_params);
+}
+
+
+void free_sage_params(void *base_params)
+{
+    free(base_params);
+}
+
+
+int run_sage_from_params(struct params *run_params)
+{
+    const int ThisTask = run_params->ThisTask;
+    const int NTasks = run_params->NTasks;
+    int32_t status;
+
     /* Now start the model */
     struct timeval tstart;
     gettimeofday(&tstart, NULL);
@@ -16,6 +16,30 @@ extern "C" {
     extern int run_sage(const int ThisTask, const int NTasks, const char *param_file, void **params);
     extern int finalize_sage(void *params);
 
+    /* Read a base set of parameters once and then run sage any number of times with
+       some of those parameters overridden (e.g., from a calibration). The base params
+       are never modified, and must be released with free_sage_params. The params
+       returned by run_sage_with_overrides should be passed to finalize_sage as usual */
+    extern int read_sage_params(const int ThisTask, const int NTasks, const char *param_file, void **base_params);
+    extern int run_sage_with_overrides(const void *base_params, const int noverrides, const char **names,
+                                       const char **values, void **params);
+    extern void free_sage_params(void *base_params);
+
+    /* Opt-in cache of the forests loaded by this task, kept across successive runs within
+       the same process (defined in core_io_tree.c). Only physics parameters should change
+       between runs; the cache is discarded if the trees processed by this task change */
+    extern void enable_forest_cache(const int enable);
+    extern void free_forest_cache(void);
+
+    /* Galaxies kept in memory by the last run with OutputFormat = sage_memory
+       (defined in io/save_gals_memory.c) */
+    extern int32_t get_num_memory_output_fields(void);
+    extern const char * get_memory_output_field_name(const int32_t field_idx);
+    extern int32_t get_memory_output_field_is_integer(const int32_t field_idx);
+    extern int64_t get_memory_output_ngals(const int32_t snapnum);
+    extern int32_t get_memory_output_field(const int32_t snapnum, const char *field_name, void *dest);
+    extern void free_memory_output(void);
+
 #ifdef __cplusplus
 }
 #endif